@@ -1,5 +1,226 @@
+import os
+import signal
+import hashlib
+from collections import deque
+from time import time
+JOB_START = time() # Start of the job, for the walltime. Set before the slow imports below
 from warnings import WarningMessage
 from shenfun import *
+from mpi4py_fft import fftw
+import h5py
+from Transforms import PipelinedTransforms, get_dealiased
+from Threads import ThreadPool
+from Metrics import Metrics
+from CostModel import estimate
+
+class DerivedFields:
+    """Cache of quantities derived from the current solution
+
+    Each quantity is registered with a function that computes it, and is
+    computed at most once for each state of the solution. The solver
+    invalidates the cache each time the solution changes.
+
+    Example
+    -------
+    >>> fields = DerivedFields()
+    >>> fields.register('u', lambda: u_.backward())
+    >>> ub = fields['u'] # computed
+    >>> ub = fields['u'] # cached
+    >>> fields.invalidate()
+    """
+    def __init__(self):
+        self.compute = {}
+        self.cache = {}
+
+    def register(self, name, compute):
+        self.compute[name] = compute
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            self.cache[name] = self.compute[name]()
+        return self.cache[name]
+
+    def invalidate(self):
+        self.cache.clear()
+
+class Walltime:
+    """Decide, on all ranks, when to stop and checkpoint before the walltime
+
+    The time of each step, and of writing a checkpoint, is measured online.
+    The guard expires when the remaining walltime no longer covers the
+    slowest of the recent steps, the slowest checkpoint and a safety margin.
+    It also expires when a signal is received by any rank, or when a file
+    named 'killshenfun' is found. All ranks agree through one allreduce of
+    three numbers per step.
+
+    Parameters
+    ----------
+    walltime : number or str, optional
+        Walltime of the job in seconds, or as 'HH:MM:SS'. Defaults to the
+        environment variable MICROPOLAR_WALLTIME. None for no limit
+    margin : number, optional
+        Seconds reserved for flushing statistics and probes and for exiting
+    signals : sequence of str, optional
+        Signals that stop the solver, like those sent by schedulers ahead
+        of the walltime, e.g., 'sbatch --signal=USR1@300'
+    comm : MPI communicator, optional
+    start : number, optional
+        Time the job started, as returned by time.time(). Defaults to
+        JOB_START, the time this module was first imported, such that
+        imports, setup and all solvers run by the job, like the members of
+        an ensemble, count against the walltime
+
+    Example
+    -------
+    >>> guard = Walltime('01:00:00')
+    >>> while True:
+    ...     step()
+    ...     guard.step()
+    ...     if guard.expired():
+    ...         checkpoint()
+    ...         break
+    """
+    signum = 0 # Shared by all instances, since a signal is meant for the whole process
+
+    def __init__(self, walltime=None, margin=60, signals=('SIGTERM', 'SIGUSR1', 'SIGUSR2'), comm=comm, start=None):
+        self.comm = comm
+        self.start = JOB_START if start is None else start
+        if walltime is None:
+            walltime = os.environ.get('MICROPOLAR_WALLTIME')
+        self.walltime = self.seconds(walltime) if walltime is not None else None
+        self.margin = margin
+        self.reason = None
+        self.steps = deque(maxlen=20)
+        self.io = 0
+        self.last = time()
+        for name in signals:
+            try:
+                signal.signal(getattr(signal, name), self.handler)
+            except (AttributeError, ValueError): # Unknown signal or not main thread
+                pass
+
+    @staticmethod
+    def seconds(walltime):
+        if isinstance(walltime, str) and ':' in walltime:
+            return sum(float(x)*60**i for i, x in enumerate(reversed(walltime.split(':'))))
+        return float(walltime)
+
+    def handler(self, signum, frame):
+        Walltime.signum = signum
+
+    def begin(self):
+        """Register the start of time stepping"""
+        self.last = time()
+
+    def step(self):
+        """Register the end of a time step"""
+        t1 = time()
+        self.steps.append(t1-self.last)
+        self.last = t1
+
+    def add_io(self, seconds):
+        """Register the time spent writing a checkpoint"""
+        self.io = max(self.io, seconds)
+        self.last += seconds # Not part of the time step
+
+    def remaining(self):
+        return np.inf if self.walltime is None else self.walltime-(time()-self.start)
+
+    def expired(self):
+        """Return True on all ranks if the solver should stop now
+
+        Collective, must be called by all ranks.
+        """
+        needed = max(self.steps, default=0)+self.io+self.margin
+        kill = self.comm.Get_rank() == 0 and os.path.exists('killshenfun')
+        flags = self.comm.allreduce(np.array([self.signum, kill, self.remaining() < needed], dtype=float), op=MPI.MAX)
+        if not flags.any():
+            return False
+        if flags[1] and self.comm.Get_rank() == 0:
+            os.remove('killshenfun')
+        self.reason = 'signal %d' % flags[0] if flags[0] else 'killshenfun' if flags[1] else 'walltime'
+        return True
+
+# Phases of a time step that are timed and recorded in the metrics
+PHASES = ('convection', 'rhs', 'solve', 'vw', 'update', 'checkpoint', 'io')
+
+class IMEXRK3LS(IMEXRK3):
+    """Low-storage variant of shenfun's IMEXRK3
+
+    The same scheme, but the right hand side of each stage is assembled in
+    place. The linear terms of all stages are computed straight into the
+    right hand side of the solve, and the nonlinear terms into the register
+    that keeps them for the next stage. Each equation then owns 2 registers,
+    against 6 for IMEXRK3, see TIMESTEPPERS.
+    """
+    def assemble(self):
+        IMEXRK3.assemble(self)
+        self.rhs = (Function(self.T), Function(self.T)) # Nonlinear terms, right hand side of solve
+        self.nonlinear_rhs.output_array = self.rhs[0]
+        for linear_rhs in self.linear_rhs:
+            linear_rhs.output_array = self.rhs[1]
+
+    def compute_rhs(self, rk=0):
+        a, b, _ = self.stages()
+        w0, rhs = self.rhs
+        self.linear_rhs[rk]()
+        if b[rk] != 0:
+            rhs += (self.dt*b[rk])*w0 # Nonlinear terms of the previous stage
+        self.nonlinear_rhs()
+        rhs += (self.dt*a[rk])*w0
+        if self.mask is not None:
+            self.T.mask_nyquist(rhs, self.mask)
+        return self.rhs
+
+# Registers are the full spectral arrays owned by each equation for the stages, as
+# counted by KMM.storage_report and verified in TimeSteppers.py
+TIMESTEPPERS = {'IMEXRK3': 'Spalart, Moser and Rogers, 2nd order (3rd order explicit part), 6 registers',
+                'IMEXRK3LS': 'IMEXRK3 with the stages assembled in place, 2 registers',
+                'IMEXRK222': 'Ascher, Ruuth and Spiteri, 2nd order, 7 registers',
+                'IMEXRK443': 'Ascher, Ruuth and Spiteri, 3rd order, 11 registers'}
+
+def find_arrays(obj, name='self', threshold=0, maxdepth=6):
+    """Return all arrays reachable from the attributes of obj
+
+    Views are counted once, as their base array, under the first name found.
+
+    Returns
+    -------
+    Dict of {id(base): (name, shape, dtype, nbytes)}
+    """
+    found = {}
+    seen = set()
+    def walk(obj, name, depth):
+        if id(obj) in seen or depth > maxdepth:
+            return
+        seen.add(id(obj))
+        if isinstance(obj, np.ndarray):
+            base = obj
+            while isinstance(base.base, np.ndarray):
+                base = base.base
+            if base.nbytes >= threshold and id(base) not in found:
+                found[id(base)] = (name, base.shape, base.dtype, base.nbytes)
+            return
+        if isinstance(obj, dict):
+            items = obj.items()
+        elif isinstance(obj, (list, tuple)):
+            items = enumerate(obj)
+        elif hasattr(obj, '__dict__') and not isinstance(obj, type) and not callable(obj):
+            items = vars(obj).items()
+        else:
+            return
+        for key, val in list(items):
+            walk(val, f'{name}[{key}]' if isinstance(obj, (dict, list, tuple)) else f'{name}.{key}', depth+1)
+    walk(obj, name, 0)
+    return found
+
+def count_registers(arrays, size):
+    """Return number of registers of size bytes in arrays, as returned by find_arrays
+
+    Arrays of the linear solvers are not registers of the time stepper and
+    are not counted.
+    """
+    return sum(nbytes//size for name, shape, dtype, nbytes in arrays.values() if '.solvers' not in name)
 
 class KMM:
     """Navier Stokes channel flow solver
@@ -39,15 +260,60 @@ class KMM:
         Print diagnostics every moderror timestep
     checkpoint : int, optional
         Save required data for restart to hdf5 every checkpoint timestep.
+        If 0, only when the solver stops early, see walltime.
     timestepper : str, optional
-        Choose timestepper
+        Choose timestepper, see TIMESTEPPERS. IMEXRK3LS is a low-storage
+        variant of IMEXRK3 with 2 registers per equation, against 6 for
+        IMEXRK3, 7 for IMEXRK222 and 11 for IMEXRK443, see
+        :meth:`storage_report`
+    comm : MPI communicator, optional
+        Communicator used by the solver. Defaults to all ranks.
+    cache : str, optional
+        Folder used to store FFTW wisdom between runs. Planning of the
+        transforms is then much faster for a repeated configuration.
+    pipeline : int, optional
+        If positive, the transforms of the nonlinear terms are pipelined with
+        this many components in flight, overlapping the MPI exchanges with
+        the serial transforms and pointwise products. See :mod:`Transforms`.
+    threads : int, optional
+        Number of threads per rank, used by the FFTW plans, the pointwise
+        products of the nonlinear terms and the implicit solves. See
+        :mod:`Threads`.
+    walltime : number or str, optional
+        Walltime of the job, in seconds or as 'HH:MM:SS'. Defaults to the
+        environment variable MICROPOLAR_WALLTIME. The solver stops, with a
+        final checkpoint, right before the walltime is reached, or when
+        receiving SIGTERM, SIGUSR1 or SIGUSR2. The walltime is counted from
+        the start of the job, not of this solver. See :class:`Walltime`.
+    metrics : dict, optional
+        Options for the time series of diagnostics, see :mod:`Metrics`.
+        Defaults to {'sinks': ('stdout', 'h5'), 'capacity': 1000,
+        'flushevery': 10}. Diagnostics are recorded every moderror timestep,
+        together with the time per step of each phase and the I/O volume.
+
     Note
     ----
     Simulations may be killed gracefully by placing a file named 'killshenfun'
-    in the folder running the solver from. The solver will then first store
-    the results by checkpointing, before exiting.
+    in the folder running the solver from, or by sending a signal. The solver
+    will then first store the results by checkpointing, before exiting. The
+    file is removed, such that the simulation can be restarted right away.
+
+    The checkpoint f'{filename}.chk.h5' holds the solution in self.checkpoint
+    and, in group 'state', all additional state returned by :meth:`get_state`,
+    like accumulated statistics. It is written to a temporary file that
+    replaces the previous checkpoint only when complete, so a job killed while
+    writing always leaves a consistent checkpoint behind.
+
+    Projections that are not needed by all configurations are registered with
+    :meth:`lazy` and created on first access. Quantities derived from the
+    solution, like the velocity in physical space, should be accessed through
+    self.fields, which computes them only once per time step. The time spent on setting up the
+    solver is collected per component in self.timings, see
+    :meth:`print_timings`.
 
     """
+    conv_methods = (0, 1) # Supported values of conv
+
     def __init__(self,
                  N=(32, 32, 32),
                  domain=((-1, 1), (0, 2*np.pi), (0, np.pi)),
@@ -62,8 +328,30 @@ class KMM:
                  modsave=1e8,
                  moderror=100,
                  checkpoint=1000,
-                 timestepper='IMEXRK3'):
+                 timestepper='IMEXRK3',
+                 comm=comm,
+                 cache=None,
+                 pipeline=0,
+                 threads=1,
+                 walltime=None,
+                 metrics=None):
+        t0 = time()
+        self.timings = {}
         self.N = N
+        self.comm = comm
+        self.cache = cache
+        self.family = family
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+        self.walltime = Walltime(walltime, comm=comm)
+        self.phases = dict.fromkeys(PHASES, 0.0) # Time spent since last record
+        self.phase_steps = 0
+        self.io_bytes = 0                        # Bytes written since last record
+        opts = {'sinks': ('stdout', 'h5')}
+        opts.update(metrics or {})
+        if self.comm.Get_rank() > 0:
+            opts['sinks'] = ()
+        self.lazy('metrics', lambda: Metrics(self.metric_names()+[f'time_{p}' for p in PHASES]+['io_MB'], filename=filename, **opts))
         self.nu = nu
         self.dt = dt
         self.conv = conv
@@ -74,7 +362,11 @@ class KMM:
         self.padding_factor = padding_factor
         self.dpdy = dpdy
         self.PDE = PDE = globals().get(timestepper)
-        self.im1 = None
+        if PDE is None or not hasattr(PDE, 'steps'):
+            raise ValueError(f"Unknown timestepper '{timestepper}', choose one of {', '.join(TIMESTEPPERS)}")
+        if conv not in self.conv_methods:
+            raise ValueError(f"Unknown convection method conv={conv} for {type(self).__name__}, choose one of {self.conv_methods}")
+        self.load_wisdom()
 
         # Regular spaces
         self.B0 = FunctionSpace(N[0], family, bc=(0, 0, 0, 0), domain=domain[0])
@@ -86,53 +378,68 @@ class KMM:
         self.C00 = self.D00.get_orthogonal()
 
         # Regular tensor product spaces
-        self.TB = TensorProductSpace(comm, (self.B0, self.F1, self.F2), collapse_fourier=False, slab=True, modify_spaces_inplace=True) # Wall-normal velocity
-        self.TD = TensorProductSpace(comm, (self.D0, self.F1, self.F2), collapse_fourier=False, slab=True, modify_spaces_inplace=True) # Streamwise velocity
-        self.TC = TensorProductSpace(comm, (self.C0, self.F1, self.F2), collapse_fourier=False, slab=True, modify_spaces_inplace=True) # No bc
+        self.TB = TensorProductSpace(self.comm, (self.B0, self.F1, self.F2), collapse_fourier=False, slab=True, modify_spaces_inplace=True, threads=self.threads) # Wall-normal velocity
+        self.TD = TensorProductSpace(self.comm, (self.D0, self.F1, self.F2), collapse_fourier=False, slab=True, modify_spaces_inplace=True, threads=self.threads) # Streamwise velocity
+        self.TC = TensorProductSpace(self.comm, (self.C0, self.F1, self.F2), collapse_fourier=False, slab=True, modify_spaces_inplace=True, threads=self.threads) # No bc
         self.BD = VectorSpace([self.TB, self.TD, self.TD])  # Velocity vector space
         self.CD = VectorSpace(self.TD)                      # Convection vector space
         self.CC = VectorSpace([self.TD, self.TC, self.TC])  # Curl vector space
 
-        # Padded space for dealiasing
-        self.TDp = self.TD.get_dealiased(padding_factor)
+        # Padded spaces for dealiasing, planned with the threads of the solver. They are cached by
+        # shenfun, so all padded transforms, like u_.backward(padding_factor=...), use them
+        for T in (self.TB, self.TC):
+            get_dealiased(T, padding_factor, threads=self.threads)
+        self.TDp = get_dealiased(self.TD, padding_factor, threads=self.threads)
+        self.pipeline = PipelinedTransforms(padding_factor, pipeline, comm=self.comm, threads=self.threads) if pipeline > 0 else None
+        if self.pipeline is not None:
+            self.pipeline.padded[id(self.TD)] = (self.TD, self.TDp) # Reuse padded space and its plans
+        t0 = self.add_timing('spaces', t0)
 
         self.u_ = Function(self.BD)      # Velocity vector solution
         self.H_ = Function(self.CD)      # convection
         self.curl = Function(self.CC)    # Velocity curl
         self.g_ = self.curl[0]           # g solution is first component of curl
-        self.ub = Array(self.BD)
+        self.lazy('ub', lambda: Array(self.BD))
 
         self.v00 = Function(self.D00)   # For solving 1D problem for Fourier wavenumber 0, 0
         self.w00 = Function(self.D00)
 
         self.work = CachedArrayDict()
         self.mask = self.TB.get_mask_nyquist() # Used to set the Nyquist frequency to zero
-        self.X = self.TD.local_mesh(bcast=True)
-        self.K = self.TD.local_wavenumbers(scaled=True)
+        self.X = self.TD.local_mesh(bcast=False)                   # Broadcastable mesh
+        self.K = self.TD.local_wavenumbers(scaled=True)            # Broadcastable wavenumbers
         self.solP = None
-
-        # Classes for fast projections. All are not used except if self.conv=0
-        self.dudx = Project(Dx(self.u_[0], 0, 1), self.TD)
-        if self.conv == 0:
-            self.dudy = Project(Dx(self.u_[0], 1, 1), self.TB)
-            self.dudz = Project(Dx(self.u_[0], 2, 1), self.TB)
-            self.dvdx = Project(Dx(self.u_[1], 0, 1), self.TC)
-            self.dvdy = Project(Dx(self.u_[1], 1, 1), self.TD)
-            self.dvdz = Project(Dx(self.u_[1], 2, 1), self.TD)
-            self.dwdx = Project(Dx(self.u_[2], 0, 1), self.TC)
-            self.dwdy = Project(Dx(self.u_[2], 1, 1), self.TD)
-            self.dwdz = Project(Dx(self.u_[2], 2, 1), self.TD)
-        self.curly = Project(curl(self.u_)[1], self.TC, output_array=self.curl[1]) # curlx is already in g
-        self.curlz = Project(curl(self.u_)[2], self.TC, output_array=self.curl[2])
-        self.divu = Project(div(self.u_), self.TC)
+        self.keep_gradients = False # Keep padded gradients of convection in self.gradp
+        self.gradp = None
+        self.convected = False      # Convection already computed for the current solution
+
+        t0 = self.add_timing('functions', t0)
+
+        # Classes for fast projections, created on first use. The gradients are only used if self.conv=0
+        self.lazy('dudx', lambda: Project(Dx(self.u_[0], 0, 1), self.TD))
+        for i, ui in enumerate('uvw'):
+            for j, xj in enumerate('xyz'):
+                if (i, j) != (0, 0):
+                    T = (self.TB, self.TD, self.TD)[i] if j > 0 else (self.TD, self.TC, self.TC)[i]
+                    self.lazy(f'd{ui}d{xj}', lambda i=i, j=j, T=T: Project(Dx(self.u_[i], j, 1), T))
+        self.lazy('curly', lambda: Project(curl(self.u_)[1], self.TC, output_array=self.curl[1])) # curlx is already in g
+        self.lazy('curlz', lambda: Project(curl(self.u_)[2], self.TC, output_array=self.curl[2]))
+        self.lazy('divu', lambda: Project(div(self.u_), self.TC))
+
+        # Quantities derived from the solution, computed at most once for each state
+        self.fields = DerivedFields()
+        self.fields.register('u', lambda: self.u_.backward(self.ub))
+        self.fields.register('curl', self.compute_curl)
+        self.fields.register('curlb', lambda: self.fields['curl'].backward())
+        self.fields.register('divu', lambda: self.divu().backward())
 
         # File for storing the results
         self.file_u = ShenfunFile('_'.join((filename, 'U')), self.BD, backend='hdf5', mode='w', mesh='uniform')
 
-        # Create a checkpoint file used to restart simulations
-        self.checkpoint = Checkpoint(filename,
-                                     checkevery=checkpoint,
-                                     data={'0': {'U': [self.u_]}})
+        # Solution stored in the checkpoint file used to restart simulations
+        self.checkevery = checkpoint
+        self.checkpoint = {'U': self.u_}
+        t0 = self.add_timing('files', t0)
 
         # set up equations
         v = TestFunction(self.TB)
@@ -163,13 +470,13 @@ class KMM:
 
         # v and w. Solve divergence constraint for all wavenumbers except 0, 0
         r""":math:`\nabla \cdot \vec{u} = 0`"""
-        K2 = self.K[1]*self.K[1]+self.K[2]*self.K[2]
-        self.K_over_K2 = np.zeros((2,)+self.g_.shape)
+        K2 = self.K[1]*self.K[1]+self.K[2]*self.K[2] # Depends only on the Fourier wavenumbers
+        self.K_over_K2 = np.zeros((2,)+K2.shape)
         for i in range(2):
             self.K_over_K2[i] = self.K[i+1] / np.where(K2 == 0, 1, K2)
 
         # v and w. Momentum equation for Fourier wavenumber 0, 0
-        if comm.Get_rank() == 0:
+        if self.comm.Get_rank() == 0:
             v0 = TestFunction(self.D00)
             self.h1 = Function(self.D00)  # Copy from H_[1, :, 0, 0] (cannot use view since not contiguous)
             self.h2 = Function(self.D00)  # Copy from H_[2, :, 0, 0]
@@ -193,8 +500,132 @@ class KMM:
                           solver=sol,
                           latex=r"\frac{\partial w}{\partial t} = \nu \frac{\partial^2 w}{\partial x^2} - N_z")
             }
+        self.add_timing('equations', t0)
+
+    def lazy(self, name, create):
+        """Register attribute to be created on first access
+
+        Parameters
+        ----------
+        name : str
+            Name of attribute
+        create : callable
+            Function without arguments that returns the attribute
+        """
+        self.__dict__.setdefault('_lazy', {})[name] = create
+        self.__dict__.pop(name, None)
+
+    def memory_report(self, threshold=2**20, verbose=True):
+        """Return and print all large arrays owned by the solver
+
+        The attributes of the solver are searched recursively, including
+        equations, projections and function spaces. Views are counted once,
+        under the first name they are found.
+
+        Parameters
+        ----------
+        threshold : int, optional
+            Only report arrays of at least this many bytes
+        verbose : bool, optional
+            Print report on rank 0, with the total memory per rank
+
+        Returns
+        -------
+        List of (name, shape, dtype, nbytes) for this rank, largest first
+        """
+        found = find_arrays({key: val for key, val in vars(self).items() if key not in ('_lazy', 'fields')}, 'self', threshold)
+        report = sorted(found.values(), key=lambda r: r[3], reverse=True)
+        total = sum(r[3] for r in report)
+        totals = self.comm.gather(total, root=0)
+        if verbose and self.comm.Get_rank() == 0:
+            for name, shape, dtype, nbytes in report:
+                print(f"{name[5:]:<40} {str(shape):>24} {str(dtype):>12} {nbytes/2**20:10.2f} MB")
+            print(f"{'total rank 0':<40} {total/2**20:49.2f} MB")
+            print(f"{'max rank':<40} {max(totals)/2**20:49.2f} MB")
+            print(f"{'all ranks':<40} {sum(totals)/2**20:49.2f} MB")
+        return report
+
+    def storage_report(self, verbose=True):
+        """Return and print the number of registers used by each equation
+
+        A register is an array of the same size as the solution that is owned
+        by the equation, like stored stage right hand sides. Arrays shared
+        with the rest of the solver, like the solution itself, are not
+        counted. The registers depend on the timestepper, see TIMESTEPPERS.
+
+        Returns
+        -------
+        Dict of {equation name: (registers, nbytes)} on this rank
+        """
+        shared = find_arrays({key: val for key, val in vars(self).items() if key not in ('_lazy', 'fields', 'pdes', 'pdes1d')})
+        size = self.g_.nbytes
+        report = {}
+        for name, pde in self.pdes.items():
+            own = {key: val for key, val in find_arrays(pde, name).items() if key not in shared}
+            nbytes = sum(val[3] for val in own.values())
+            report[name] = (count_registers(own, size), nbytes)
+        if verbose and self.comm.Get_rank() == 0:
+            print(f"Timestepper {self.PDE.__name__}: {TIMESTEPPERS.get(self.PDE.__name__, '')}")
+            for name, (n, nbytes) in report.items():
+                print(f"{name:>10} {n:4d} registers {nbytes/2**20:10.2f} MB")
+        return report
+
+    @classmethod
+    def dry_run(cls, **kw):
+        """Predict memory per rank and time per step, see :func:`CostModel.estimate`
+
+        Only a small calibration case is allocated, so this may be called with
+        the parameters of a run that does not fit on the current machine.
+        """
+        return estimate(cls, **kw)
+
+    def __getattr__(self, name):
+        lazy = self.__dict__.get('_lazy', {})
+        if name not in lazy:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        t0 = time()
+        value = lazy.pop(name)()
+        setattr(self, name, value)
+        self.add_timing(name, t0)
+        return value
+
+    def add_timing(self, name, t0):
+        """Add time spent since t0 to component name and return current time"""
+        t1 = time()
+        self.timings[name] = self.timings.get(name, 0) + t1-t0
+        return t1
+
+    def print_timings(self):
+        """Print time spent setting up the solver, maximum over all ranks"""
+        names = self.comm.bcast(sorted(self.timings, key=self.timings.get, reverse=True), root=0)
+        times = self.comm.reduce(np.array([self.timings.get(name, 0) for name in names]), op=MPI.MAX)
+        if self.comm.Get_rank() == 0:
+            for name, ti in zip(names, times):
+                print(f"{name:>20} {ti:2.4e}")
+            print(f"{'total':>20} {np.sum(times):2.4e}")
+
+    def wisdom_file(self):
+        # FFTW plans only depend on the shapes, not on physical parameters like nu and dt
+        key = repr((self.N, self.family, self.padding_factor, self.comm.Get_size(), self.threads))
+        return os.path.join(self.cache, 'fftw_%s.wisdom' % hashlib.md5(key.encode()).hexdigest()[:12])
+
+    def load_wisdom(self):
+        if self.cache is not None and os.path.exists(self.wisdom_file()):
+            fftw.import_wisdom(self.wisdom_file())
+
+    def save_wisdom(self):
+        if self.cache is not None and self.comm.Get_rank() == 0:
+            os.makedirs(self.cache, exist_ok=True)
+            fftw.export_wisdom(self.wisdom_file())
+
+    def compute_curl(self):
+        self.curly() # Compute y-component of curl. Stored in self.curl[1]
+        self.curlz() # Compute z-component of curl. Stored in self.curl[2]
+        return self.curl
 
     def convection(self):
+        if self.pipeline is not None:
+            return self.convection_pipelined()
         H = self.H_.v # .v to access numpy array directly for faster lookup
         self.up = self.u_.backward(padding_factor=self.padding_factor)
         up = self.up.v
@@ -208,23 +639,52 @@ class KMM:
             dwdxp = self.dwdx().backward(padding_factor=self.padding_factor).v
             dwdyp = self.dwdy().backward(padding_factor=self.padding_factor).v
             dwdzp = self.dwdz().backward(padding_factor=self.padding_factor).v
-            H[0] = self.TDp.forward(up[0]*dudxp+up[1]*dudyp+up[2]*dudzp, H[0])
-            H[1] = self.TDp.forward(up[0]*dvdxp+up[1]*dvdyp+up[2]*dvdzp, H[1])
-            H[2] = self.TDp.forward(up[0]*dwdxp+up[1]*dwdyp+up[2]*dwdzp, H[2])
+            if self.keep_gradients:
+                self.gradp = (dudxp, dudyp, dudzp, dvdxp, dvdyp, dvdzp, dwdxp, dwdyp, dwdzp)
+            hp = self.work[(up[0], 0, False)]
+            H[0] = self.TDp.forward(self.pool.dot(hp, up, (dudxp, dudyp, dudzp)), H[0])
+            H[1] = self.TDp.forward(self.pool.dot(hp, up, (dvdxp, dvdyp, dvdzp)), H[1])
+            H[2] = self.TDp.forward(self.pool.dot(hp, up, (dwdxp, dwdyp, dwdzp)), H[2])
         elif self.conv == 1:
-            self.curly() # Compute y-component of curl. Stored in self.curl[1]
-            self.curlz() # Compute z-component of curl. Stored in self.curl[2]
-            curl = self.curl.backward(padding_factor=self.padding_factor).v
+            curl = self.fields['curl'].backward(padding_factor=self.padding_factor).v
             cb = self.work[(up, 1, True)]
-            cb = cross(cb, curl, up)
+            cb = self.pool.cross(cb, curl, up)
             H[0] = self.TDp.forward(cb[0], H[0])
             H[1] = self.TDp.forward(cb[1], H[1])
             H[2] = self.TDp.forward(cb[2], H[2])
         self.H_.mask_nyquist(self.mask)
 
+    def convection_pipelined(self):
+        """Compute convection like :meth:`convection`, with pipelined transforms
+
+        All padded components are transformed in one batch, and each
+        product is computed while the previous one is being exchanged.
+        """
+        P = self.pipeline
+        H = self.H_.v
+        u = self.u_
+        if self.conv == 0:
+            grad = [getattr(self, f'd{ui}d{xj}')() for ui in 'uvw' for xj in 'xyz']
+            bp = P.backward([u[0], u[1], u[2]]+grad, 'convection')
+            self.up = up = bp[:3]
+            gp = bp[3:]
+            if self.keep_gradients:
+                self.gradp = gp
+            hp = self.work[(up[0], 0, False)]
+            P.forward(self.TDp, [lambda i=i: self.pool.dot(hp, up, gp[3*i:3*i+3]) for i in range(3)], H)
+        elif self.conv == 1:
+            curl = self.fields['curl']
+            bp = P.backward([u[0], u[1], u[2], curl[0], curl[1], curl[2]], 'convection')
+            self.up = up = bp[:3]
+            cp = bp[3:]
+            P.forward(self.TDp, [lambda: cp[1]*up[2]-cp[2]*up[1],
+                                 lambda: cp[2]*up[0]-cp[0]*up[2],
+                                 lambda: cp[0]*up[1]-cp[1]*up[0]], H)
+        self.H_.mask_nyquist(self.mask)
+
     def compute_vw(self, rk):
         u = self.u_.v
-        if comm.Get_rank() == 0:
+        if self.comm.Get_rank() == 0:
             self.v00[:] = u[1, :, 0, 0].real
             self.w00[:] = u[2, :, 0, 0].real
             self.h1[:] = self.H_[1, :, 0, 0].real
@@ -233,11 +693,14 @@ class KMM:
         # Find velocity components v and w from f, g and div. constraint
         f = self.dudx() # Note paper uses f=-dudx
         g = self.g_
-        u[1] = 1j*(self.K_over_K2[0]*f + self.K_over_K2[1]*g)
-        u[2] = 1j*(self.K_over_K2[1]*f - self.K_over_K2[0]*g)
+        K = self.K_over_K2
+        def vw(s): # Block of local wavenumbers along y
+            u[1][:, s] = 1j*(K[0][:, s]*f[:, s] + K[1][:, s]*g[:, s])
+            u[2][:, s] = 1j*(K[1][:, s]*f[:, s] - K[0][:, s]*g[:, s])
+        self.pool.map_blocks(vw, u.shape[2])
 
         # Still have to compute for wavenumber = 0, 0
-        if comm.Get_rank() == 0:
+        if self.comm.Get_rank() == 0:
             # v component
             self.pdes1d['v0'].compute_rhs(rk)
             u[1, :, 0, 0] = self.pdes1d['v0'].solve_step(rk)
@@ -254,7 +717,7 @@ class KMM:
             self.d2udx2 = Project(self.nu*Dx(self.u_[0], 0, 2), self.TC)
             d2udx2 = self.d2udx2.output_array
             N0 = self.N0 = FunctionSpace(self.N[0], self.B0.family(), bc={'left': {'N': d2udx2}, 'right': {'N': d2udx2}})
-            TN = self.TN = TensorProductSpace(comm, (N0, self.F1, self.F2), collapse_fourier=False, slab=True, modify_spaces_inplace=True)
+            TN = self.TN = TensorProductSpace(self.comm, (N0, self.F1, self.F2), collapse_fourier=False, slab=True, modify_spaces_inplace=True, threads=self.threads)
             sol = chebyshev.la.Helmholtz if self.B0.family() == 'chebyshev' else la.SolverGeneric1ND
             self.divH = Inner(TestFunction(TN), -div(self.H_))
             self.solP = sol(inner(TestFunction(TN), div(grad(TrialFunction(TN)))))
@@ -267,27 +730,111 @@ class KMM:
 
     def print_energy_and_divergence(self, t, tstep):
         if tstep % self.moderror == 0 and self.moderror > 0:
-            ub = self.u_.backward(self.ub)
+            ub = self.fields['u']
             e0 = inner(1, ub[0]*ub[0])
             e1 = inner(1, ub[1]*ub[1])
             e2 = inner(1, ub[2]*ub[2])
-            divu = self.divu().backward()
+            divu = self.fields['divu']
             e3 = np.sqrt(inner(1, divu*divu))
-            if comm.Get_rank() == 0:
-                print("Time %2.5f Energy %2.6e %2.6e %2.6e div %2.6e" %(t, e0, e1, e2, e3))
-
-    def init_from_checkpoint(self):
-        self.checkpoint.read(self.u_, 'U', step=0)
+            self.record_metrics(t, tstep, uu=e0, vv=e1, ww=e2, div=e3)
+
+    def metric_names(self):
+        """Return names of the diagnostics of :meth:`print_energy_and_divergence`"""
+        return ['uu', 'vv', 'ww', 'div']
+
+    def add_phase(self, name, t0):
+        """Add time spent since t0 to phase name of the time step and return current time"""
+        t1 = time()
+        self.phases[name] += t1-t0
+        return t1
+
+    def record_metrics(self, t, tstep, **values):
+        """Record diagnostics with the timings and I/O since the last record
+
+        Collective. The timings are per step, maximum over ranks, and the
+        I/O volume is summed over ranks. Only the values on rank 0 are used.
+        """
+        times = np.array([self.phases[p] for p in PHASES])/max(self.phase_steps, 1)
+        times = self.comm.reduce(times, op=MPI.MAX)
+        io = self.comm.reduce(self.io_bytes)
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.phase_steps = 0
+        self.io_bytes = 0
+        if self.comm.Get_rank() == 0:
+            values.update({f'time_{p}': ti for p, ti in zip(PHASES, times)})
+            self.metrics.record(t, tstep, io_MB=io/2**20, **values)
+
+    def init_from_checkpoint(self, filename=None):
+        """Initialize solution from checkpoint
+
+        Parameters
+        ----------
+        filename : str, optional
+            Restart from the checkpoint file f'{filename}.chk.h5' instead of
+            the solver's own checkpoint. This file may have been stored with
+            a different resolution N (and domain size). All Chebyshev and
+            Fourier coefficients are then zero-padded or truncated to the
+            resolution of this solver, see :meth:`resample`.
+
+        Note
+        ----
+        The state of :meth:`get_state` is only restored from the solver's own
+        checkpoint, and only if stored with the same number of ranks.
+        """
+        own = filename is None
+        f = h5py.File((self.filename if own else filename)+'.chk.h5', 'r', driver='mpio', comm=self.comm)
+        for name, u in self.checkpoint.items():
+            self.resample(f[name+'/0'], u)
+        tstep = f.attrs['tstep']
+        t = f.attrs['t']
+        if own and 'state' in f:
+            if f.attrs['size'] == self.comm.Get_size():
+                state = {}
+                f[f'state/{self.comm.Get_rank()}'].visititems(lambda key, val: state.__setitem__(key, val[()]) if isinstance(val, h5py.Dataset) else None)
+                self.set_state(state)
+            elif self.comm.Get_rank() == 0:
+                print(f"Checkpoint state stored with {f.attrs['size']} ranks is not restored")
+        f.close()
         self.g_[:] = 1j*self.K[1]*self.u_[2] - 1j*self.K[2]*self.u_[1]
-        self.checkpoint.open()
-        tstep = self.checkpoint.f.attrs['tstep']
-        t = self.checkpoint.f.attrs['t']
-        self.checkpoint.close()
         return t, tstep
 
+    def resample(self, data, u):
+        """Read vector of spectral coefficients of any resolution into u
+
+        Chebyshev coefficients are simply truncated or zero-padded. Fourier
+        coefficients are matched by wavenumber index, dropping the Nyquist
+        mode. A checkpoint stored for another domain size is thus stretched
+        to fit the domain of this solver. Each rank reads only the wavenumbers
+        it owns.
+
+        Parameters
+        ----------
+        data : h5py Dataset
+            Stored coefficients of shape (3, M[0], M[1], M[2]//2+1)
+        u : Function
+            Vector Function to fill
+        """
+        M = (data.shape[1], data.shape[2], 2*(data.shape[3]-1))
+        N = self.N
+        s = self.TD.local_slice(True)[1]
+        k = np.arange(s.start, s.stop)
+        k = np.where(k < N[1]//2, k, k-N[1])                # Local wavenumbers along y
+        k = k[abs(k) < min(N[1], M[1])//2]
+        ky, ky_old = k % N[1] - s.start, k % M[1]           # Local index in u and index in data
+        ky, ky_old = ky[np.argsort(ky_old)], np.sort(ky_old) # h5py requires increasing indices
+        nz = min(N[2], M[2])//2
+        u[:] = 0
+        for i, T in enumerate(u.function_space().flatten()):
+            dim = T.bases[0].dim()
+            n0 = min(dim, M[0]-(N[0]-dim))
+            if len(ky) > 0:
+                u[i][:n0, ky, :nz] = data[i, :n0, list(ky_old), :nz]
+        u.mask_nyquist(self.mask)
+        return u
+
     def initialize(self, from_checkpoint=False):
         if from_checkpoint:
-            return self.init_from_checkpoint()
+            return self.init_from_checkpoint(None if from_checkpoint is True else from_checkpoint)
         raise RuntimeError('Initialize solver in subclass')
 
     def plot(self, t, tstep):
@@ -298,31 +845,121 @@ class KMM:
         self.print_energy_and_divergence(t, tstep)
 
     def tofile(self, tstep):
-        self.file_u.write(tstep, {'u': [self.u_.backward(mesh='uniform')]}, as_scalar=True)
+        ub = self.u_.backward(mesh='uniform')
+        self.file_u.write(tstep, {'u': [ub]}, as_scalar=True)
+        self.io_bytes += ub.nbytes
+
+    def get_state(self):
+        """Return dict of local arrays, besides the solution, required for restart
+
+        Keys may contain '/' to create groups. Subclasses add to this, and
+        restore the same dict in :meth:`set_state`.
+        """
+        return {}
+
+    def set_state(self, state):
+        pass
+
+    def write_checkpoint(self, t, tstep):
+        """Store solution and state in f'{filename}.chk.h5', atomically
+
+        The spectral coefficients are stored as datasets name/0 of global
+        shape (3, N[0], N[1], N[2]//2+1). The state of each rank is stored
+        in group state/rank.
+        """
+        t0 = time()
+        fname = self.filename+'.chk.h5'
+        rank = self.comm.Get_rank()
+        state = {key: np.asarray(val) for key, val in self.get_state().items()}
+        meta = self.comm.allgather({key: (val.shape, val.dtype.str) for key, val in state.items()})
+        f = h5py.File(fname+'.tmp', 'w', driver='mpio', comm=self.comm)
+        f.attrs.create('t', t)
+        f.attrs.create('tstep', tstep)
+        f.attrs.create('size', self.comm.Get_size())
+        s = (slice(None),)+tuple(self.TD.local_slice(True))
+        for name, u in self.checkpoint.items():
+            d = f.create_dataset(name+'/0', shape=(3, self.N[0], self.N[1], self.N[2]//2+1), dtype=u.dtype)
+            d[s] = u.v
+        for r, shapes in enumerate(meta): # Creating datasets is collective
+            for key, (shape, dtype) in shapes.items():
+                f.create_dataset(f'state/{r}/{key}', shape=shape, dtype=dtype)
+        for key, val in state.items():
+            if val.size > 0:
+                f[f'state/{rank}/{key}'][...] = val
+        f.close()
+        self.io_bytes += sum(u.nbytes for u in self.checkpoint.values())+sum(val.nbytes for val in state.values())
+        self.comm.Barrier()
+        if rank == 0:
+            os.replace(fname+'.tmp', fname)
+        self.comm.Barrier()
+        self.walltime.add_io(time()-t0)
+
+    def stop(self, t, tstep):
+        """Return True to end solve before end_time
+
+        Must return the same on all ranks.
+        """
+        return False
+
+    def finalize(self, t, tstep):
+        """Store everything required for a restart, before solve ends early"""
+        self.write_checkpoint(t, tstep)
 
     def prepare_step(self, rk):
+        if rk == 0 and self.convected: # Computed in update, for sampling
+            self.convected = False
+            return
         self.convection()
 
     def assemble(self):
+        t0 = time()
         for pde in self.pdes.values():
             pde.assemble()
-        if comm.Get_rank() == 0:
+        if self.comm.Get_rank() == 0:
             for pde in self.pdes1d.values():
                 pde.assemble()
+        self.add_timing('assemble', t0)
 
     def solve(self, t=0, tstep=0, end_time=1000):
         self.assemble()
+        self.fields.invalidate()
+        self.walltime.begin()
+        tstep0 = tstep
         while t < end_time-1e-8:
             for rk in range(self.PDE.steps()):
+                t0 = time()
                 self.prepare_step(rk)
+                t0 = self.add_phase('convection', t0)
                 for eq in self.pdes.values():
                     eq.compute_rhs(rk)
-                for eq in self.pdes.values():
-                    eq.solve_step(rk)
+                t0 = self.add_phase('rhs', t0)
+                # The implicit solves of the equations are independent
+                self.pool.map(lambda eq: eq.solve_step(rk), self.pdes.values())
+                t0 = self.add_phase('solve', t0)
                 self.compute_vw(rk)
+                self.fields.invalidate()
+                self.add_phase('vw', t0)
             t += self.dt
             tstep += 1
+            self.phase_steps += 1
+            if tstep == tstep0+1:
+                # All transforms have now been planned
+                self.save_wisdom()
+            t0 = time()
             self.update(t, tstep)
-            self.checkpoint.update(t, tstep)
+            t0 = self.add_phase('update', t0)
+            if self.checkevery > 0 and tstep % self.checkevery == 0:
+                self.write_checkpoint(t, tstep)
+            t0 = self.add_phase('checkpoint', t0)
             if tstep % self.modsave == 0:
                 self.tofile(tstep)
+            self.add_phase('io', t0)
+            self.walltime.step()
+            if self.stop(t, tstep) or self.walltime.expired():
+                if self.comm.Get_rank() == 0:
+                    print(f"Stopping at t={t:2.4e}, tstep={tstep}: {self.walltime.reason or 'stop'}")
+                self.finalize(t, tstep)
+                break
+        if self.comm.Get_rank() == 0:
+            self.metrics.flush()
+        return t, tstep
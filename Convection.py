@@ -0,0 +1,119 @@
+"""Benchmark the convection of the micropolar solver
+
+Compares, for the same solution, the convection methods
+
+    conv=1  velocity in vortex form from u and curl(u), angular velocity in
+            advective form from the nine gradients of w, transformed
+            component by component
+    conv=2  velocity in vortex form and angular velocity in divergence form,
+            with u, curl(u) and w in one stacked backward transform and
+            curl(u) x u and the fluxes w_i u_j in one stacked forward
+            transform, each with a single all-to-all exchange, see
+            MicroPolar.convection_fused
+
+For each method the distributed transforms of components, the all-to-all
+exchanges and the projections per call are counted, and the time per call
+measured, with and without pipelined transforms.
+The two methods differ only by the aliasing errors of the two forms, and by
+div(u), which is reported as well. Run as
+
+    mpirun -np 4 python Convection.py
+
+"""
+import os
+import shutil
+import tempfile
+from time import time
+from shenfun import *
+from shenfun.tensorproductspace import Transform
+from MKM_MicroPolar import MKM
+
+class Counter:
+    """Count calls of the method name of class cls while active"""
+    def __init__(self, cls, name='__call__'):
+        self.cls = cls
+        self.name = name
+        self.count = 0
+
+    def __enter__(self):
+        self.method = method = getattr(self.cls, self.name)
+        def counted(obj, *args, **kw):
+            self.count += 1
+            return method(obj, *args, **kw)
+        setattr(self.cls, self.name, counted)
+        return self
+
+    def __exit__(self, *args):
+        setattr(self.cls, self.name, self.method)
+
+def benchmark(N=(64, 64, 32), padding_factor=(1.5, 1.5, 1.5), repeat=5, comm=comm, **kw):
+    """Return dict of counts, time per call and differences for conv=1 and 2
+
+    Parameters
+    ----------
+    N, padding_factor : Parameters of the solver
+    repeat : int, optional
+        Number of timed calls of each convection
+    comm : MPI communicator, optional
+    kw : dict
+        Remaining parameters of MKM
+    """
+    tmp = tempfile.mkdtemp() if comm.Get_rank() == 0 else None
+    tmp = comm.bcast(tmp, root=0)
+    opts = dict(modplot=-1, checkpoint=0, metrics={'sinks': ()})
+    opts.update(kw)
+    result = {}
+    solvers = {}
+    try:
+        for conv in (1, 2):
+            c = solvers[conv] = MKM(N=N, padding_factor=padding_factor, conv=conv, comm=comm,
+                                    filename=os.path.join(tmp, f'conv{conv}'), **opts)
+            if conv == 1:
+                c.initialize()
+                X = c.X
+                wb = Array(c.CD)
+                wb[0] = (1-X[0]**2)*np.sin(X[1])*np.cos(2*X[2])
+                wb[1] = (1-X[0]**2)*X[0]*np.cos(X[1])
+                wb[2] = (1-X[0]**2)*(1+np.sin(X[2]))
+                c.w_ = wb.forward(c.w_)
+            else:
+                c.u_[:] = solvers[1].u_
+                c.g_[:] = solvers[1].g_ # x-component of the curl, not recomputed by compute_curl
+                c.w_[:] = solvers[1].w_
+            c.convection() # Plans transforms and creates projections
+            # Pipelined and stacked transforms bypass Transform, which has one exchange with the slab decomposition
+            P = c.pipeline if c.pipeline is not None else getattr(c, 'stacked', None)
+            before = (P.transforms, P.count+P.blocking) if P is not None else (0, 0)
+            with Counter(Transform) as transforms, Counter(Project) as projections:
+                c.convection()
+            after = (P.transforms, P.count+P.blocking) if P is not None else (0, 0)
+            exchanges = transforms.count+after[1]-before[1]
+            transforms.count += after[0]-before[0]
+            comm.Barrier()
+            t0 = time()
+            for i in range(repeat):
+                c.convection()
+            t = comm.allreduce((time()-t0)/repeat, op=MPI.MAX)
+            result[conv] = {'transforms': transforms.count, 'exchanges': exchanges, 'projections': projections.count, 'time': t}
+        a, b = solvers[1], solvers[2]
+        def rel(x, y):
+            return np.sqrt(comm.allreduce(np.sum(abs(x-y)**2))/max(comm.allreduce(np.sum(abs(x)**2)), 1e-300))
+        result['H'] = rel(a.H_.v, b.H_.v)
+        result['HW'] = rel(a.HW_.v, b.HW_.v)
+        divu = a.divu().backward()
+        result['divu'] = np.sqrt(comm.allreduce(np.sum(divu**2))/np.prod(N))
+    finally:
+        comm.Barrier()
+        if comm.Get_rank() == 0:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return result
+
+if __name__ == '__main__':
+    for pipeline in (0, 3):
+        r = benchmark(pipeline=pipeline)
+        if comm.Get_rank() == 0:
+            print(f"pipeline={pipeline}")
+            print(f"{'conv':>6}{'transforms':>12}{'exchanges':>11}{'projections':>13}{'s/call':>12}")
+            for conv in (1, 2):
+                print(f"{conv:>6}{r[conv]['transforms']:>12d}{r[conv]['exchanges']:>11d}{r[conv]['projections']:>13d}{r[conv]['time']:12.4e}")
+            print(f"Speedup {r[1]['time']/r[2]['time']:2.2f}, relative difference H {r['H']:2.4e} HW {r['HW']:2.4e}, rms div(u) {r['divu']:2.4e}")
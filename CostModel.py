@@ -0,0 +1,205 @@
+"""Dry-run prediction of memory per rank and time per step
+
+The solver class is built at a small calibration resolution on a single
+rank, and run for a few steps. This allocates, at small scale, every buffer
+the configuration needs: padded arrays, projections, stage registers of the
+equations, statistics, correlations, spectra and so on. All axes of all
+arrays are identified by their length, and scaled to the requested
+resolution. Arrays distributed by the slab decomposition are divided by the
+number of ranks. Temporaries, like those of the statistics, are not owned by
+the solver. Their peak is traced with tracemalloc during the calibration run
+and scaled with the number of physical points.
+
+The time per step is modelled as
+
+    t = (t_fft*Np*log(Np) + t_lin*S + t_phys*R)/P + E*alpha*(P-1) + V*beta*B/P
+
+where Np, S and R are the numbers of padded, spectral and physical points,
+P the number of ranks, E the number of all-to-all exchanges per step, and V
+the number of padded transforms per step, each exchanging B bytes. E is
+smaller than V when the components are exchanged together, with conv=2.
+t_fft, t_lin and t_phys are measured phase times of the calibration run,
+and alpha and beta are measured with an all-to-all benchmark on the
+communicator, if it has more than one rank.
+
+Example
+
+    >>> from MKM_MicroPolar import MKM
+    >>> report = MKM.dry_run(N=(256, 256, 128), mem_per_rank=4)
+
+or for the default MKM configuration
+
+    mpirun -np 4 python CostModel.py
+
+"""
+import os
+import inspect
+import shutil
+import tempfile
+import tracemalloc
+from time import time
+import numpy as np
+from mpi4py import MPI
+
+__all__ = ['estimate', 'alltoall_cost']
+
+# The derived axis lengths, see axis_lengths, are distinct for padding factors 1,
+# 1.5 and 2, and between 37 and 1000. So they differ from the sizes independent
+# of N, like the 36 helicity and 32 joint PDF bins, the number of components or
+# the 1000 tracers and metrics records, which are not scaled
+CALIBRATE_N = (44, 76, 92)
+
+def axis_lengths(N, padding_factor):
+    """Return all characteristic axis lengths of arrays for resolution N"""
+    Np = [int(np.floor(p*n)) for p, n in zip(padding_factor, N)]
+    return [N[0], N[0]-2, N[0]-4, N[1], N[1]//2, N[2], N[2]//2, N[2]//2+1,
+            Np[0], Np[1], Np[2], Np[2]//2+1]
+
+def alltoall_cost(comm, repeat=10):
+    """Return latency per peer (alpha) and time per byte (beta) of Alltoall"""
+    P = comm.Get_size()
+    if P == 1:
+        return 2e-6, 1/5e9, False # Typical of InfiniBand, not measured
+    times = []
+    for nbytes in (8, 2**20//P):
+        a = np.zeros(nbytes*P//8)
+        b = np.zeros_like(a)
+        comm.Alltoall(a, b)
+        comm.Barrier()
+        t0 = time()
+        for i in range(repeat):
+            comm.Alltoall(a, b)
+        times.append(comm.allreduce((time()-t0)/repeat, op=MPI.MAX))
+    alpha = times[0]/(P-1)
+    beta = max(times[1]-times[0], 0)/(2**20)
+    return alpha, beta, True
+
+def exchanges(cls, conv):
+    """Return number of all-to-alls and of padded transforms per stage of the nonlinear terms"""
+    if conv == 2: # Stacked: u, curl u, w backward and curl u x u, w_i u_j forward
+        return 2, 9+12
+    n = (12 if conv == 0 else 6)+3 # backward + forward of velocity convection
+    if 'MicroPolar' in [c.__name__ for c in cls.__mro__]:
+        n += 9+3 # gradients of w and u.grad(w)
+    return n, n
+
+def calibrate(cls, padding_factor, steps, N=CALIBRATE_N, **kw):
+    """Build and run cls at resolution N on this rank only
+
+    Returns
+    -------
+    arrays : list of (name, shape, nbytes)
+    transient : peak bytes of temporaries
+    phases : dict of median time per step of each phase
+    stages : number of stages per time step
+    """
+    params = inspect.signature(cls.__init__).parameters
+    opts = dict(modplot=-1, modsave=1e8, moderror=1, checkpoint=0, metrics={'sinks': ()})
+    if 'sample_stats' in params:
+        opts['sample_stats'] = 1
+    opts.update(kw)
+    tmp = tempfile.mkdtemp()
+    try:
+        c = cls(N=N, padding_factor=padding_factor, comm=MPI.COMM_SELF,
+                filename=os.path.join(tmp, 'dryrun'), **opts)
+        try:
+            c.initialize()
+        except RuntimeError: # No initial condition in base class, zero is fine
+            pass
+        c.solve(t=0, tstep=0, end_time=c.dt) # Creates lazy attributes and plans
+        tracemalloc.start()
+        with np.errstate(all='ignore'):
+            c.solve(t=c.dt, tstep=1, end_time=(steps+1.5)*c.dt)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        arrays = [(name, shape, nbytes) for name, shape, dtype, nbytes in c.memory_report(threshold=0, verbose=False)]
+        phases = {name[5:]: np.median(c.metrics.history(name)[1:]) for name in c.metrics.columns if name.startswith('time_')}
+        stages = c.PDE.steps()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return arrays, peak-current, phases, stages
+
+def estimate(cls, N=(32, 32, 32), padding_factor=(1, 1.5, 1.5), conv=0, ranks=None, mem_per_rank=None,
+             steps=3, comm=MPI.COMM_WORLD, verbose=True, **kw):
+    """Predict memory per rank and time per step of solver cls
+
+    Parameters
+    ----------
+    cls : class
+        KMM, MicroPolar, MKM or any subclass
+    N, padding_factor, conv : Parameters of the solver
+    ranks : sequence of ints, optional
+        Rank counts to predict for. Defaults to powers of 2 up to the
+        largest count allowed by the slab decomposition
+    mem_per_rank : number, optional
+        Available memory per rank in GB, used to find the smallest
+        feasible rank count
+    steps : int, optional
+        Number of time steps of the calibration run
+    comm : MPI communicator, optional
+        Used for the all-to-all benchmark. The calibration run is on rank 0
+    verbose : bool, optional
+        Print table on rank 0
+    kw : dict
+        Remaining parameters of the solver, like timestepper
+
+    Returns
+    -------
+    Dict with the predictions for each rank count, on all ranks
+    """
+    alpha, beta, measured = alltoall_cost(comm)
+    calib = None
+    if comm.Get_rank() == 0:
+        calib = calibrate(cls, padding_factor, steps, conv=conv, **kw)
+    arrays, transient, phases, stages = comm.bcast(calib, root=0)
+
+    # Scale calibration arrays to resolution N. Other lengths, like the
+    # number of components, bins or probes, are independent of N
+    lengths = dict(zip(axis_lengths(CALIBRATE_N, padding_factor), axis_lengths(N, padding_factor)))
+    distributed = 0 # bytes, before division by number of ranks
+    replicated = 0
+    for name, shape, nbytes in arrays:
+        scale = np.prod([lengths[n]/n for n in shape if n in lengths])
+        if any(n in lengths for n in shape):
+            distributed += nbytes*scale
+        else:
+            replicated += nbytes
+
+    Nc = CALIBRATE_N
+    Npc = np.prod([int(np.floor(p*n)) for p, n in zip(padding_factor, Nc)])
+    Np = np.prod([int(np.floor(p*n)) for p, n in zip(padding_factor, N)])
+    S, Sc = N[0]*N[1]*(N[2]//2+1), Nc[0]*Nc[1]*(Nc[2]//2+1)
+    R, Rc = np.prod(N), np.prod(Nc)
+    t_fft = phases['convection']*(Np*np.log2(Np))/(Npc*np.log2(Npc))
+    t_lin = (phases['rhs']+phases['solve']+phases['vw'])*S/Sc
+    t_phys = phases['update']*R/Rc
+    E, V = [stages*n for n in exchanges(cls, conv)]
+    B = Np/N[2]*(int(np.floor(padding_factor[2]*N[2]))//2+1)*16 # padded complex array
+
+    Pmax = min(N[0], N[1]) # Slab: at least one plane per rank in physical and spectral space
+    if ranks is None:
+        ranks = [2**i for i in range(int(np.log2(Pmax))+1)]
+    report = {'ranks': {}, 'max_ranks': Pmax, 'alltoall_measured': measured}
+    for P in ranks:
+        mem = ((distributed+transient*R/Rc)/P+replicated)/2**30
+        t = (t_fft+t_lin+t_phys)/P + E*alpha*(P-1) + V*beta*B/P
+        report['ranks'][P] = {'memory_GB': mem, 'time_per_step': t, 'fits': mem_per_rank is None or mem <= mem_per_rank}
+    fits = [P for P, r in report['ranks'].items() if r['fits'] and P <= Pmax]
+    report['min_ranks'] = min(fits) if fits else None
+
+    if verbose and comm.Get_rank() == 0:
+        print(f"Dry run {cls.__name__} N={tuple(N)} padding={tuple(padding_factor)} conv={conv}, {E} all-to-alls of {V} transforms per step")
+        if not measured:
+            print("All-to-all cost assumed (alpha=2us, 5GB/s), run with several ranks to measure it")
+        print(f"{'ranks':>8}{'GB/rank':>12}{'s/step':>12}")
+        for P, r in report['ranks'].items():
+            print(f"{P:>8d}{r['memory_GB']:12.3f}{r['time_per_step']:12.4e}" + ('' if r['fits'] else '  out of memory'))
+        print(f"Largest rank count for slab decomposition: {Pmax}")
+        if mem_per_rank is not None:
+            print(f"Smallest rank count within {mem_per_rank} GB/rank: {report['min_ranks']}")
+    return report
+
+if __name__ == '__main__':
+    from MKM_MicroPolar import MKM
+    MKM.dry_run(N=(128, 128, 64), padding_factor=(1.5, 1.5, 1.5), conv=1, mem_per_rank=4,
+                timestepper='IMEXRK222')
@@ -0,0 +1,113 @@
+"""Run an ensemble of MKM cases, e.g., a parameter sweep, in one MPI job
+
+The ranks of MPI.COMM_WORLD are split into groups using sub-communicators.
+Each group runs its share of the cases one after another, with its own
+filenames, checkpoints and statistics.
+
+Example, 8 cases of 64x64x32 run by 4 groups of ranks
+
+    mpirun -np 16 python Ensemble.py
+
+"""
+import itertools
+from time import time
+import numpy as np
+from mpi4py import MPI
+from MKM_MicroPolar import MKM
+
+def sweep(**params):
+    """Return list of parameter dicts for all combinations of params
+
+    Example
+    -------
+    >>> sweep(m=[0.001, 0.01], Re=[180.])
+    [{'m': 0.001, 'Re': 180.0}, {'m': 0.01, 'Re': 180.0}]
+    """
+    keys = list(params.keys())
+    return [dict(zip(keys, p)) for p in itertools.product(*params.values())]
+
+def run_ensemble(cases, groups=None, end_time=1, from_checkpoint=False,
+                 filename='MKM_ensemble', **kw):
+    """Run all cases using sub-communicators of MPI.COMM_WORLD
+
+    Parameters
+    ----------
+    cases : sequence of dicts
+        Keyword arguments to :class:`.MKM` for each member of the ensemble
+    groups : int, optional
+        Number of sub-communicators. Defaults to one per case, but no more
+        than the number of ranks.
+    end_time : number, optional
+        End time for each member
+    from_checkpoint : bool, optional
+        Restart each member from its own checkpoint
+    filename : str, optional
+        Members that do not set their own filename use f'{filename}_{i:03d}'
+        for case number i
+    kw : dict
+        Keyword arguments to :class:`.MKM` shared by all members
+
+    Note
+    ----
+    All members share the walltime of the job. A group that is stopped by the
+    walltime, a signal or killshenfun does not start its remaining cases.
+
+    Returns
+    -------
+    On rank 0 of MPI.COMM_WORLD a list of dicts with the throughput of all
+    members, ordered as cases. None on all other ranks.
+    """
+    world = MPI.COMM_WORLD
+    size, rank = world.Get_size(), world.Get_rank()
+    groups = min(len(cases), size) if groups is None else groups
+    assert groups <= size
+    color = rank*groups//size
+    comm = world.Split(color, rank)
+    results = []
+    for i in range(color, len(cases), groups):
+        d = dict(kw)
+        d['filename'] = f'{filename}_{i:03d}'
+        d.update(cases[i])
+        d['comm'] = comm
+        t0 = time()
+        c = MKM(**d)
+        t, tstep = c.initialize(from_checkpoint=from_checkpoint)
+        t1 = time()
+        t_end, tstep_end = c.solve(t=t, tstep=tstep, end_time=end_time)
+        t2 = time()
+        steps = tstep_end-tstep
+        results.append({'case': i,
+                        'filename': d['filename'],
+                        'ranks': comm.Get_size(),
+                        'setup': t1-t0,
+                        'solve': t2-t1,
+                        'steps': steps,
+                        'steps/s': steps/(t2-t1) if steps > 0 else 0,
+                        'points*steps/s': np.prod(c.N)*steps/(t2-t1) if steps > 0 else 0})
+        if c.walltime.reason is not None: # Walltime, signal or killshenfun, leave the remaining cases
+            break
+    results = world.gather(results if comm.Get_rank() == 0 else [], root=0)
+    comm.Free()
+    if rank == 0:
+        results = sorted(itertools.chain(*results), key=lambda r: r['case'])
+        print(f"{'case':>5} {'ranks':>6} {'setup':>10} {'solve':>10} {'steps':>7} {'steps/s':>10} {'pts*steps/s':>12}  filename")
+        for r in results:
+            print(f"{r['case']:5d} {r['ranks']:6d} {r['setup']:10.3e} {r['solve']:10.3e} {r['steps']:7d} {r['steps/s']:10.3e} {r['points*steps/s']:12.3e}  {r['filename']}")
+        return results
+    return None
+
+if __name__ == '__main__':
+    cases = sweep(m=[0.001, 0.01], J=[1e-5, 1e-4], NP=[8.3e4, 8.3e3])
+    N = (64, 64, 32)
+    run_ensemble(cases,
+                 end_time=1,
+                 N=N,
+                 Re=180.,
+                 dt=0.001,
+                 conv=1,
+                 modplot=-1,
+                 moderror=100,
+                 checkpoint=100,
+                 sample_stats=100,
+                 padding_factor=(1.5, 1.5, 1.5),
+                 timestepper='IMEXRK222')
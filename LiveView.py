@@ -0,0 +1,164 @@
+"""Live monitoring of a running solver from a separate process
+
+The solver publishes already computed arrays into named blocks of shared
+memory using :class:`Publisher`. Publishing is a plain memory copy that never
+waits for a viewer, and nothing is lost if no viewer is running. A viewer
+started at any time attaches to the blocks and plots the latest data
+
+    python LiveView.py MKM_MP_128_128_64
+
+where the argument is the filename of the solver. The viewer is the only
+process that imports matplotlib.
+
+Each block starts with a header of int64 numbers (seq, ndim, shape...),
+followed by the float64 data. seq is odd while the data are written, such
+that the viewer can detect and skip a torn read.
+"""
+import sys
+import atexit
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+__all__ = ['Publisher', 'Viewer']
+
+INDEX_SIZE = 4096
+
+def _blockname(name, key):
+    return f"{name.replace('/', '_')}_{key}"
+
+def _attach(blockname):
+    shm = shared_memory.SharedMemory(name=blockname)
+    # Do not let the tracker of the viewer remove blocks owned by the solver
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+class Publisher:
+    """Publish arrays to shared memory
+
+    Parameters
+    ----------
+    name : str
+        Name used to identify the solver, typically its filename
+    """
+    def __init__(self, name):
+        self.name = name
+        self.shm = {}
+        self.index = self._create('index', INDEX_SIZE)
+        atexit.register(self.close)
+
+    def _create(self, key, size):
+        blockname = _blockname(self.name, key)
+        try:
+            shm = shared_memory.SharedMemory(name=blockname, create=True, size=size)
+        except FileExistsError: # Left over from a previous run
+            shm = shared_memory.SharedMemory(name=blockname)
+            shm.close()
+            shm.unlink()
+            shm = shared_memory.SharedMemory(name=blockname, create=True, size=size)
+        return shm
+
+    def publish(self, key, a):
+        """Publish array a under the name key"""
+        a = np.asarray(a, dtype=float)
+        nh = 2+a.ndim
+        if key not in self.shm:
+            self.shm[key] = self._create(key, 8*nh+a.nbytes)
+            keys = ','.join(self.shm.keys()).encode()
+            self.index.buf[:len(keys)+1] = keys+b'\0'
+        shm = self.shm[key]
+        header = np.ndarray((nh,), dtype=np.int64, buffer=shm.buf)
+        header[0] += 1
+        header[1] = a.ndim
+        header[2:] = a.shape
+        np.ndarray(a.shape, dtype=float, buffer=shm.buf, offset=8*nh)[...] = a
+        header[0] += 1
+
+    def close(self):
+        if self.index is None:
+            return
+        for shm in list(self.shm.values())+[self.index]:
+            shm.close()
+            shm.unlink()
+        self.shm = {}
+        self.index = None
+
+class Viewer:
+    """Read the arrays published by a :class:`Publisher`
+
+    Parameters
+    ----------
+    name : str
+        Name used by the Publisher
+    """
+    def __init__(self, name):
+        self.name = name
+        self.shm = {}
+        self.seq = {}
+
+    def keys(self):
+        try:
+            index = _attach(_blockname(self.name, 'index'))
+        except FileNotFoundError:
+            return []
+        keys = bytes(index.buf).split(b'\0')[0].decode()
+        index.close()
+        return keys.split(',') if keys else []
+
+    def read(self, key):
+        """Return latest array published as key, or None if not new"""
+        if key not in self.shm:
+            try:
+                self.shm[key] = _attach(_blockname(self.name, key))
+            except FileNotFoundError:
+                return None
+        buf = self.shm[key].buf
+        seq = int(np.ndarray((1,), dtype=np.int64, buffer=buf)[0])
+        if seq % 2 == 1 or seq == self.seq.get(key):
+            return None
+        ndim = int(np.ndarray((2,), dtype=np.int64, buffer=buf)[1])
+        shape = tuple(np.ndarray((2+ndim,), dtype=np.int64, buffer=buf)[2:])
+        a = np.ndarray(shape, dtype=float, buffer=buf, offset=8*(2+ndim)).copy()
+        if int(np.ndarray((1,), dtype=np.int64, buffer=buf)[0]) != seq:
+            return None # Written to while reading
+        self.seq[key] = seq
+        return a
+
+    def run(self, interval=1):
+        """Plot published slices and profiles until interrupted
+
+        Arrays with keys starting with 'profile' are plotted as lines
+        against the published wall-normal mesh 'x'. All other 2D arrays are
+        plotted as contours.
+        """
+        import matplotlib.pyplot as plt
+        figs = {}
+        x = None
+        plt.ion()
+        while True:
+            for key in self.keys():
+                if key == 'x':
+                    x = self.read(key) if x is None else x
+                    continue
+                a = self.read(key)
+                if a is None:
+                    continue
+                if key not in figs:
+                    figs[key] = plt.figure(figsize=(6, 3))
+                    figs[key].suptitle(key)
+                fig = figs[key]
+                fig.clf()
+                fig.suptitle(key)
+                ax = fig.gca()
+                if key.startswith('profile'):
+                    a = np.atleast_2d(a).T
+                    if x is None or len(x) != a.shape[0]:
+                        ax.plot(a)
+                    else:
+                        ax.plot(x, a)
+                elif a.ndim == 2:
+                    im = ax.contourf(a, 32)
+                    fig.colorbar(im)
+            plt.pause(interval)
+
+if __name__ == '__main__':
+    Viewer(sys.argv[1]).run(*map(float, sys.argv[2:]))
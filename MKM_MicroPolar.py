@@ -1,6 +1,10 @@
-import matplotlib.pyplot as plt
+from time import time
 from shenfun import *
 from MicroPolar import MicroPolar
+from LiveView import Publisher
+from POD import StreamingPOD
+from Tracers import Tracers
+from TimeAverage import TimeAverage
 import h5py
 
 
@@ -26,29 +30,86 @@ class MKM(MicroPolar):
                  checkpoint=1000,
                  timestepper='IMEXRK3',
                  probes=None,
-                 rand=1e-7):
+                 rand=1e-7,
+                 spectra=False,
+                 convergence=None,
+                 budgets=False,
+                 conditional=None,
+                 pod=None,
+                 tracers=None,
+                 average=None,
+                 comm=comm,
+                 cache=None,
+                 pipeline=0,
+                 threads=1,
+                 walltime=None,
+                 metrics=None):
         MicroPolar.__init__(self, N=N, domain=domain, Re=Re, J=J, m=m, NP=NP, dt=dt, conv=conv, utau=utau, modplot=modplot,
                             modsave=modsave, moderror=moderror, filename=filename, family=family,
-                            padding_factor=padding_factor, checkpoint=checkpoint, timestepper=timestepper)
+                            padding_factor=padding_factor, checkpoint=checkpoint, timestepper=timestepper, comm=comm, cache=cache,
+                            pipeline=pipeline, threads=threads, walltime=walltime, metrics=metrics)
+        t0 = time()
         self.rand = rand
+        self.live = None
         self.Volume = inner(1, Array(self.TD, val=1))
+        self.Lyz = (self.F1.domain[1]-self.F1.domain[0])*(self.F2.domain[1]-self.F2.domain[0])
         self.flux = np.array([2486.56]) # Re_tau=180. This is 16*np.pi**2*15.67, where 15.67 = Umean/utau
+        self.dflux = 0
         self.sample_stats = sample_stats
-        self.stats = Stats(N, self.B0.mesh(), self.TD.local_slice(False), filename=filename+'_stats')
-        self.probes = Probe(probes, {'u': self.u_, 'w': self.w_}, filename=filename) if probes is not None else None
+        self.stats = Stats(N, self.B0.mesh(bcast=False), self.TD.local_slice(False), filename=filename+'_stats', comm=self.comm,
+                           pool=self.pool if threads > 1 else None, conditional=conditional)
+        self.probes = Probe(probes, {'u': self.u_, 'w': self.w_}, filename=filename, comm=self.comm) if probes is not None else None
+        self.spectra = Spectra(N, (self.F1.domain[1]-self.F1.domain[0], self.F2.domain[1]-self.F2.domain[0]),
+                               {'U': self.u_, 'W': self.w_}, twod=spectra == '2D', filename=filename+'_spectra',
+                               comm=self.comm) if spectra else None
+        self.monitor = ConvergenceMonitor(self.stats, **convergence) if convergence is not None else None
+        self.budgets = Budgets(self.TDp.shape(False), self.TDp.bases[0].mesh(bcast=False), self.TDp.local_slice(False),
+                               self.TDp.bases[0].get_orthogonal(), filename=filename+'_budgets', comm=self.comm,
+                               pool=self.pool if threads > 1 else None) if budgets else None
+        if isinstance(tracers, dict):
+            tracers = [tracers]
+        self.tracers = [Tracers(self.TDp, domain, filename=f'{filename}_tracers{i}', comm=self.comm, **opts)
+                        for i, opts in enumerate(tracers or [])]
+        self.pod = StreamingPOD({'U': self.u_, 'W': self.w_}, filename=filename+'_pod', comm=self.comm, **pod) if pod is not None else None
+        self.average = TimeAverage({'U': self.u_, 'W': self.w_, 'curl': self.curl}, filename=filename+'_average',
+                                   comm=self.comm, **average) if average is not None else None
+        for j, xj in enumerate('xyz'):
+            self.lazy(f'dpd{xj}', lambda j=j: Project(Dx(self.p_, j, 1), self.TC)) # p_ is created by compute_pressure
+        self.lazy('TL', self.get_wall_space) # Use this space to get dvdx on the walls
+        self.lazy('dvdxw', lambda: Project(grad(self.u_[1])[0], self.TL)) # This is a class used to compute dvdx on GL points
+        self.add_timing('statistics', t0)
+
+    def get_wall_space(self):
         TL = self.TC.get_unplanned()
-        TL[0].quad = 'GL'
-        self.TL = TensorProductSpace(comm, TL, slab=True) # Use this space to get dvdx on the walls. GL is Gauss-Lobatto, which includes the wall
-        self.dvdx = Project(grad(self.u_[1])[0], self.TL) # This is a class used to compute dvdx on GL points
-
-    def initialize(self, from_checkpoint=False):
+        TL[0].quad = 'GL' # GL is Gauss-Lobatto, which includes the wall
+        return TensorProductSpace(self.comm, TL, slab=True, threads=self.threads)
+
+    def initialize(self, from_checkpoint=False, mean='parabolic', stats=None):
+        """Initialize solution
+
+        Parameters
+        ----------
+        from_checkpoint : bool or str, optional
+            If True, restart from the solver's own checkpoint. If str, restart
+            from the checkpoint f'{from_checkpoint}.chk.h5', which may be of
+            a different resolution. Use this to spin up a flow on a coarse
+            grid and continue on a finer one.
+        mean : str, optional
+            Mean profiles of velocity and angular velocity, see
+            :meth:`mean_profiles`. Perturbations are superposed, scaled
+            with the centerline velocity
+        stats : str, optional
+            Stats file used by mean='stats' and mean='profile'
+        """
         if from_checkpoint:
-            return self.init_from_checkpoint()
+            return self.init_from_checkpoint(None if from_checkpoint is True else from_checkpoint)
 
-        X = self.X
+        X = self.X # Broadcastable, not full arrays
         Y = np.where(X[0] < 0, 1+X[0], 1-X[0])
         utau = self.nu*self.Re
-        Um = 46.9091*utau # For Re=180
+        V, Wz = self.mean_profiles(mean, stats)
+        x0 = self.TD.local_slice(False)[0]
+        Um = 46.9091*utau if mean == 'parabolic' else 2*V.max() # For Re=180
         Re = self.Re
         Xplus = Y*Re
         Yplus = X[1]*Re
@@ -59,8 +120,8 @@ class MKM(MicroPolar):
         sigma = 0.00055 # 0.00055
         epsilon = Um/200.   #Um/200.
         U = Array(self.BD)
-        U[1] = Um*(Y-0.5*Y**2)
-        dev = 1+self.rand*np.random.randn(Y.shape[0], Y.shape[1], Y.shape[2])
+        U[1] = V[x0, None, None]
+        dev = 1+self.rand*np.random.randn(*U.shape[1:])
         #dev = np.fromfile('dev.dat').reshape((64, 64, 64))
         dd = utau*duplus/2.0*Xplus/40.*np.exp(-sigma*Xplus**2+0.5)*np.cos(betaplus*Zplus)*dev[:, slice(0, 1), :]
         U[1] += dd
@@ -70,59 +131,137 @@ class MKM(MicroPolar):
         U = u_.backward(U)
         u_ = U.forward(self.u_)
         self.g_[:] = 1j*self.K[1]*u_[2] - 1j*self.K[2]*u_[1]
+        if mean != 'parabolic':
+            W = Array(self.CD)
+            W[2] = Wz[x0, None, None]
+            W.forward(self.w_)
+            self.w_.mask_nyquist(self.mask)
         return 0, 0
 
-    def init_plots(self):
-        ub = self.u_.backward(self.ub)
-        self.im1 = 1
-        if comm.Get_rank() == 0:
-
-            plt.figure(1, figsize=(6, 3))
-            self.im1 = plt.contourf(self.X[1][:, :, 0], self.X[0][:, :, 0], ub[0, :, :, 0], 100)
-            plt.colorbar(self.im1)
-            plt.draw()
-
-            plt.figure(2, figsize=(6, 3))
-            self.im2 = plt.contourf(self.X[1][:, :, 0], self.X[0][:, :, 0], ub[1, :, :, 0], 100)
-            plt.colorbar(self.im2)
-            plt.draw()
-
-            plt.figure(3, figsize=(6, 3))
-            self.im3 = plt.contourf(self.X[2][:, 0, :], self.X[0][:, 0, :], ub[0, :, 0, :], 100)
-            plt.colorbar(self.im3)
-            plt.draw()
-
-            if comm.Get_size() == 1:
-                plt.figure(4, figsize=(6, 3))
-                self.im4 = plt.plot(self.X[0][:, 0, 0], ub[0, :, 0, 0])[0]
-                plt.draw()
-
+    def mean_profiles(self, mean='mixing', stats=None, relax=0.5, tol=1e-8, maxiter=2000):
+        """Return mean streamwise velocity and spanwise angular velocity
+
+        The profiles are at the wall-normal mesh of D00. The steady mean
+        equations of the (0, 0) modes are
+
+            0 = nu V'' + utau^2 - m nu Wz' + (nut V')'
+            0 = kappa Wz'' - 2 NP kappa Wz + kappa NP V' + (nut Wz')'
+
+        where nut is an eddy viscosity, and are solved by fixed point
+        iterations with the variable part of nut explicit.
+
+        Parameters
+        ----------
+        mean : str, optional
+            - 'parabolic' - the laminar-like profile tuned for Re=180, no angular velocity
+            - 'mixing' - solve with mixing length eddy viscosity (van Driest damped Nikuradse)
+            - 'stats' - solve with the eddy viscosity -<u'v'>/V' of a stats file,
+              for example from a run with other micropolar parameters at the same Re
+            - 'profile' - the profiles of a stats file, interpolated and scaled to the flux
+        stats : str, optional
+            Stats file for 'stats' and 'profile'
+        relax : number, optional
+            Underrelaxation of the fixed point iterations
+        tol : number, optional
+            Relative tolerance of the iterations
+        maxiter : int, optional
+            Maximum number of iterations
+        """
+        x = self.D00.mesh()
+        V = Wz = None
+        if self.comm.Get_rank() == 0:
+            Y = 1-np.abs(x)
+            if mean == 'parabolic':
+                Um = 46.9091*self.nu*self.Re
+                V, Wz = Um*(Y-0.5*Y**2), np.zeros_like(x)
+            elif mean == 'profile':
+                xs, Vs, Ws, uv = self.read_stats_profiles(stats)
+                V, Wz = np.interp(x, xs, Vs), np.interp(x, xs, Ws)
+                q = inner(1, Array(self.D00, buffer=V))*self.Lyz
+                V, Wz = V*self.flux[0]/q, Wz*self.flux[0]/q
+            else:
+                nut = self.mixing_length
+                if mean == 'stats':
+                    xs, Vs, Ws, uv = self.read_stats_profiles(stats)
+                    dV = np.gradient(Vs, xs)
+                    nus = np.maximum(-uv*dV/(dV**2+(0.01*np.abs(dV).max())**2), 0)
+                    nut = lambda V: np.interp(x, xs, nus)
+                V, Wz = self.solve_mean(nut, relax, tol, maxiter)
+        return self.comm.bcast((V, Wz), root=0)
+
+    def mixing_length(self, V):
+        """Return mixing length eddy viscosity of mean velocity V"""
+        x = self.D00.mesh()
+        Y = 1-np.abs(x)
+        l = (0.14-0.08*(1-Y)**2-0.06*(1-Y)**4)*(1-np.exp(-Y*self.utau/self.nu/26))
+        return l**2*np.abs(self.ddx(V))
+
+    def ddx(self, f, k=1):
+        """Return k'th wall-normal derivative of 1D profile f on the mesh of D00"""
+        C = self.C00
+        return project(Dx(Array(C, buffer=f).forward(), 0, k), C).backward().copy()
+
+    def solve_mean(self, nut, relax=0.5, tol=1e-8, maxiter=2000):
+        """Solve for steady mean profiles with eddy viscosity nut(V), see :meth:`mean_profiles`"""
+        D = self.D00
+        x = D.mesh()
+        v, u = TestFunction(D), TrialFunction(D)
+        A = inner(v, div(grad(u)))
+        B = inner(v, u)
+        nu, kappa, NP, m = self.nu, self.kappa, self.NP, self.m
+        Ub = 1.5*self.flux[0]/(2*self.Lyz)
+        V = Ub*(1-x**2)
+        Wz = 0.5*self.ddx(V)
+        V_hat, W_hat = Function(D), Function(D)
+        for it in range(maxiter):
+            nt = nut(V)
+            c = nt.max()
+            f = -self.utau**2+m*nu*self.ddx(Wz)-self.ddx(nt*self.ddx(V))+c*self.ddx(V, 2)
+            Vn = la.Solver((nu+c)*A)(inner(v, Array(D, buffer=f)), V_hat).backward()
+            g = -kappa*NP*self.ddx(Vn)-self.ddx(nt*self.ddx(Wz))+c*self.ddx(Wz, 2)
+            Wn = la.Solver((kappa+c)*A-2*NP*kappa*B)(inner(v, Array(D, buffer=g)), W_hat).backward()
+            dV = np.abs(Vn-V).max()/np.abs(Vn).max()
+            V = V+relax*(Vn-V)
+            Wz = Wz+relax*(Wn-Wz)
+            if dV < tol:
+                break
+        print(f"Mean profiles after {it+1} iterations, change {dV:2.4e}, centerline velocity {V.max():2.4e}")
+        return V, Wz
+
+    @staticmethod
+    def read_stats_profiles(filename):
+        """Return ascending mesh, mean V, mean Wz and <u'v'> from stats file"""
+        with h5py.File(filename if filename.endswith('.h5') else filename+'.h5', 'r') as f:
+            x = np.array(f['x'])
+            U = f['Average Velocity'] if 'Average Velocity' in f else f['Average']
+            V, U0 = np.array(U['V']), np.array(U['U'])
+            Wz = np.array(f['Average Angular Velocity/W']) if 'Average Angular Velocity' in f else np.zeros_like(x)
+            R = f['Reynolds Stress Velocity'] if 'Reynolds Stress Velocity' in f else f['Reynolds Stress']
+            uv = np.array(R['UV'])-U0*V
+        i = np.argsort(x)
+        return x[i], V[i], Wz[i], uv[i]
 
     def plot(self, t, tstep):
-        if self.im1 is None and self.modplot > 0:
-            self.init_plots()
+        """Publish slices of the velocity for a live viewer
 
+        Rank 0 copies its part of the slices into shared memory, which never
+        blocks the solver. Run 'python LiveView.py filename' in a separate
+        process to see the plots.
+        """
         if tstep % self.modplot == 0 and self.modplot > 0:
-            ub = self.u_.backward(self.ub)
-            if comm.Get_rank() == 0:
-                X = self.X
-                self.im1.axes.contourf(X[1][:, :, 0], X[0][:, :, 0], ub[0, :, :, 0], 100)
-                self.im1.autoscale()
-                plt.figure(1)
-                plt.pause(1e-6)
-                self.im2.axes.contourf(X[1][:, :, 0], X[0][:, :, 0], ub[1, :, :, 0], 100)
-                self.im2.autoscale()
-                plt.figure(2)
-                plt.pause(1e-6)
-                self.im3.axes.contourf(X[2][:, 0, :], X[0][:, 0, :], ub[0, :, 0, :], 100)
-                self.im3.autoscale()
-                plt.figure(3)
-                plt.pause(1e-6)
+            ub = self.fields['u']
+            if self.comm.Get_rank() == 0:
+                if self.live is None:
+                    self.live = Publisher(self.filename)
+                    self.live.publish('x', self.B0.mesh(bcast=False))
+                self.live.publish('u0 xy', ub[0, :, :, 0])
+                self.live.publish('u1 xy', ub[1, :, :, 0])
+                self.live.publish('u0 xz', ub[0, :, 0, :])
 
     def print_energy_and_divergence(self, t, tstep):
         if tstep % self.moderror == 0 and self.moderror > 0:
-            ub = self.u_.backward(self.ub)
-            wb = self.w_.backward(self.wb)
+            ub = self.fields['u']
+            wb = self.fields['w']
             e0 = inner(1, ub[0]*ub[0])
             e1 = inner(1, ub[1]*ub[1])
             e2 = inner(1, ub[2]*ub[2])
@@ -130,57 +269,199 @@ class MKM(MicroPolar):
             d1 = inner(1, wb[1]*wb[1])
             d2 = inner(1, wb[2]*wb[2])
             q = inner(1, ub[1])
-            divu = self.divu().backward()
+            divu = self.fields['divu']
             e3 = np.sqrt(inner(1, divu*divu))
             # Find utau
-            dvdx = self.dvdx().backward()
+            dvdx = self.dvdxw().backward()
             utau0 = 0 # at x = -1
             utau1 = 0 # at x = 1
             if self.TL.local_slice(False)[0].start == 0: # The processor that owns the plane x = -1
                 utau0 = np.mean(np.sqrt(np.abs(self.nu*dvdx[0])))
             if self.TL.local_slice(False)[0].stop == self.N[0]: # The processors that owns the plane x = 1
                 utau1 = np.mean(np.sqrt(np.abs(self.nu*dvdx[-1])))
-            utau = comm.reduce(utau0+utau1)
-            if comm.Get_rank() == 0:
-                utau = utau/2
-                if tstep % (10*self.moderror) == 0 or tstep == 0:
-                    print(f"{'Time':^11}{'uu':^11}{'vv':^11}{'ww':^11}{'a0*a0':^11}{'a1*a1':^11}{'a2*a2':^11}{'flux':^11}{'div':^11}{'utau':^11}")
-                print(f"{t:2.4e} {e0:2.4e} {e1:2.4e} {e2:2.4e} {d0:2.4e} {d1:2.4e} {d2:2.4e} {q:2.4e} {e3:2.4e} {utau:2.4e}")
+            utau = self.comm.reduce(utau0+utau1)
+            self.record_metrics(t, tstep, uu=e0, vv=e1, ww=e2, a0a0=d0, a1a1=d1, a2a2=d2, flux=q, div=e3,
+                                utau=utau/2 if utau is not None else None, dflux=self.dflux)
+
+    def metric_names(self):
+        return ['uu', 'vv', 'ww', 'a0a0', 'a1a1', 'a2a2', 'flux', 'div', 'utau', 'dflux']
+
+    def steady_report(self, names=('dflux', 'utau'), window=10, tol=0.02, verbose=True):
+        """Return time at which diagnostics became statistically steady
+
+        The recorded history of each diagnostic, see :mod:`Metrics`, is split
+        into windows of `window` records. A diagnostic is steady from the
+        first window after which all window means stay within tol of the
+        mean of the last window, relative to the rms of the last window
+        (the rms is used since dflux fluctuates around zero).
+
+        Returns
+        -------
+        Dict of time or None, if not yet steady, on rank 0, else None
+        """
+        if self.comm.Get_rank() > 0:
+            return None
+        t = self.metrics.history('t')
+        steady = {}
+        for name in names:
+            a = self.metrics.history(name)
+            nw = len(a)//window
+            steady[name] = None
+            if nw < 3:
+                continue
+            a = a[len(a)-nw*window:].reshape(nw, window)
+            means = a.mean(axis=1)
+            scale = np.sqrt(np.mean(a[-1]**2))
+            bad = np.where(np.abs(means-means[-1]) > tol*scale)[0]
+            first = bad[-1]+1 if len(bad) > 0 else 0
+            if first < nw-2: # Require at least two steady windows before the last
+                steady[name] = t[len(t)-nw*window+first*window]
+            if verbose:
+                print(f"{name} statistically steady from t = {steady[name]:2.4e}" if steady[name] is not None else
+                      f"{name} not yet statistically steady at t = {t[-1]:2.4e}")
+        return steady
 
     def update(self, t, tstep):
+        self.adjust_flux()
         self.plot(t, tstep)
         self.print_energy_and_divergence(t, tstep)
         if self.probes is not None:
             self.probes()
-
-        if tstep % self.sample_stats == 0:        
-            ub = self.u_.backward(self.ub)
-            wb = self.w_.backward(self.wb)
-            self.curly() # Compute y-component of curl. Stored in self.curl[1]
-            self.curlz() # Compute z-component of curl. Stored in self.curl[2]
-            curl = self.curl.backward()
+        if self.pod is not None and tstep % self.pod.every == 0:
+            self.pod()
+        for tracers in self.tracers:
+            if tstep % tracers.every == 0:
+                tracers.tofile(tstep)
+        if self.average is not None and tstep % self.average.every == 0:
+            self.fields['curl'] # Updates all components of self.curl
+            self.average(t, {'U': self.fields['u'], 'W': self.fields['w'], 'curl': self.fields['curlb']}
+                         if self.average.second_moments else None)
+
+        if tstep % self.sample_stats == 0:
+            ub = self.fields['u']
+            wb = self.fields['w']
+            curl = self.fields['curlb']
             self.stats(ub, wb, curl)
+            self.stats.tofile()
+            if self.budgets is not None:
+                self.sample_budgets()
+                self.budgets.tofile()
+            if self.monitor is not None:
+                self.monitor(t)
             if self.probes is not None:
                 self.probes.tofile()
+            if self.spectra is not None:
+                self.spectra()
+                self.spectra.tofile()
 
-            if comm.Get_size() == 1 and self.modplot > 0:
+            if self.modplot > 0:
                 stats = self.stats.get_stats()
-                u0, w0 = stats[:2]
-                x = c.B0.mesh(bcast=False)
-                self.im4.axes.plot(x, u0[1], 'b')
-                self.im4.axes.plot(x, w0[2], 'r')
-                plt.figure(4)
-                plt.pause(1e-6)
-
-        # Dynamically adjust flux
-        if tstep % 1 == 0:
-            ub1 = self.u_[1].backward(self.ub[1])
-            beta = inner(1, ub1)
+                if self.comm.Get_rank() == 0 and self.live is not None:
+                    u0, w0 = stats[:2]
+                    self.live.publish('profile mean V', u0[1])
+                    self.live.publish('profile mean Wz', w0[2])
+
+    def prepare_step(self, rk):
+        MicroPolar.prepare_step(self, rk)
+        if rk == 0 and len(self.tracers) > 0:
+            self.advance_tracers()
+
+    def advance_tracers(self):
+        """Advance particles with the solution at the start of the step
+
+        Uses the padded velocity of the convection, so only the angular
+        velocity requires additional transforms, if interpolated.
+        """
+        wp = self.wp # Computed by the fused convection
+        if wp is None and any(tr.micro and tr.method == 'linear' for tr in self.tracers):
+            wp = self.w_.backward(padding_factor=self.padding_factor)
+        for tracers in self.tracers:
+            tracers(self.dt, up=self.up, wp=wp, u_=self.u_, w_=self.w_)
+
+    def sample_budgets(self):
+        """Sample budgets of the current solution
+
+        The convection of the current solution is computed here, keeping the
+        padded gradients, and reused by the first stage of the next step.
+        """
+        self.keep_gradients = True
+        self.convection()
+        self.keep_gradients = False
+        self.convected = True
+        pf = self.padding_factor
+        U = self.up
+        G = self.gradp
+        if G is None: # Not computed by vortex form convection
+            G = [getattr(self, f'd{ui}d{xj}')().backward(padding_factor=pf) for ui in 'uvw' for xj in 'xyz']
+        W = self.w_.backward(padding_factor=pf)
+        Gw = self.gradwp
+        if Gw is None: # Not computed by fused convection
+            Gw = [getattr(self, f'dw{i}d{xj}')().backward(padding_factor=pf) for i in range(3) for xj in 'xyz']
+        p = self.compute_pressure().backward(padding_factor=pf)
+        dP = [getattr(self, f'dpd{xj}')().backward(padding_factor=pf) for xj in 'xyz']
+        if self.conv > 0: # With vortex form convection the pressure solved for is p+|u|^2/2
+            p = p-0.5*np.sum(U*U, axis=0)
+            dP = [dP[j]-sum(U[k]*G[3*k+j] for k in range(3)) for j in range(3)]
+        self.budgets(U, G, p, dP, W, Gw)
+        self.gradp = self.gradwp = None
+
+    def adjust_flux(self):
+        """Dynamically adjust flux
+
+        The flux is computed from the 1D mean profile, which is owned by rank 0.
+        Everything derived from the solution in update is computed after the
+        adjustment, such that the first stage of the next step can reuse it.
+        """
+        if self.comm.Get_rank() == 0:
+            self.v00[:] = self.u_[1, :, 0, 0].real
+            beta = inner(1, self.v00.backward())*self.Lyz
             q = (self.flux[0] - beta)
-            if comm.Get_rank() == 0:
-                #self.u_[1, 0, 0, 0] += q/self.Volume
-                self.u_[1, :, 0, 0] *= (1+q/self.Volume/self.u_[1, 0, 0, 0])
-
+            self.dflux = q/self.flux[0] # Relative correction, zero when the flux is steady
+            #self.u_[1, 0, 0, 0] += q/self.Volume
+            self.u_[1, :, 0, 0] *= (1+q/self.Volume/self.u_[1, 0, 0, 0])
+        self.fields.invalidate()
+
+    def stop(self, t, tstep):
+        return self.monitor is not None and self.monitor.converged
+
+    def stateful(self):
+        """Return (name, object) of everything with a state required for restart"""
+        return [('stats', self.stats), ('probes', self.probes), ('spectra', self.spectra), ('monitor', self.monitor),
+                ('budgets', self.budgets), ('pod', self.pod), ('average', self.average)]+[(f'tracers{i}', tr) for i, tr in enumerate(self.tracers)]
+
+    def get_state(self):
+        """Return flux and the accumulated state of statistics, probes etc."""
+        state = MicroPolar.get_state(self)
+        state['flux'] = self.flux
+        for name, obj in self.stateful():
+            if obj is not None:
+                state.update({f'{name}/{key}': val for key, val in obj.get_state().items()})
+        return state
+
+    def set_state(self, state):
+        MicroPolar.set_state(self, state)
+        self.flux[:] = state['flux']
+        for name, obj in self.stateful():
+            sub = {key[len(name)+1:]: val for key, val in state.items() if key.startswith(name+'/')}
+            if obj is not None and len(sub) > 0:
+                obj.set_state(sub)
+
+    def write_checkpoint(self, t, tstep):
+        MicroPolar.write_checkpoint(self, t, tstep)
+        if self.pod is not None:
+            self.pod.tofile()
+        if self.average is not None:
+            self.average.tofile()
+
+    def finalize(self, t, tstep):
+        MicroPolar.finalize(self, t, tstep)
+        self.stats.tofile()
+        if self.budgets is not None:
+            self.budgets.tofile()
+        if self.probes is not None:
+            self.probes.tofile()
+        if self.spectra is not None:
+            self.spectra.tofile()
 
 class Probe:
     """Class for probing
@@ -196,6 +477,8 @@ class Probe:
         h5-file f'{fromprobes}_probes.h5'
     filename : str, optional
         Name of file (f'{filename}_probes.h5') used to store probe values.
+    comm : MPI communicator, optional
+        Communicator of the Functions in u
 
     Note
     ----
@@ -216,30 +499,41 @@ class Probe:
     >>> print(p).U['u']
     [array([-0.6,  0.6]), array([-0.6,  0.6]), array([-0.6,  0.6])]
     """
-    def __init__(self, probes, u, fromprobes="", filename=""):
+    def __init__(self, probes, u, fromprobes="", filename="", comm=comm):
         assert isinstance(u, dict)
+        self.comm = comm
         self.x = probes
         self.u = u
         self.fname = filename
         self.U = {name: [] for name in u} # store as lists because they are fast to append
         if fromprobes:
-            self.fromfile(filename)
+            self.fromfile(fromprobes)
 
-    def fromfile(self):
-        if comm.Get_rank() == 0:
-            f0 = h5py.File(self.fname+'_probes.h5', "r", driver="mpio", comm=MPI.COMM_SELF)
-            for key, val in self.U:
-                val[:] = f0[key]
+    def fromfile(self, filename):
+        if self.comm.Get_rank() == 0:
+            f0 = h5py.File(filename+'_probes.h5', "r", driver="mpio", comm=MPI.COMM_SELF)
+            for key, val in self.U.items():
+                val[:] = f0[key][:].tolist()
             f0.close()
 
+    def get_state(self):
+        """Return probe positions and the history, which is owned by rank 0"""
+        return {'x': self.x, **{key: np.array(val) for key, val in self.U.items()}}
+
+    def set_state(self, state):
+        self.x = state['x']
+        if self.comm.Get_rank() == 0:
+            for key, val in self.U.items():
+                val[:] = state[key].tolist()
+
     def __call__(self):
         for key, val in self.u.items():
             p = val.eval(self.x).tolist()
-            if comm.Get_rank() == 0:
+            if self.comm.Get_rank() == 0:
                 self.U[key].append(p)
 
     def tofile(self):
-        if comm.Get_rank() == 0:
+        if self.comm.Get_rank() == 0:
             f0 = h5py.File(self.fname+'_probes.h5', "w", driver="mpio", comm=MPI.COMM_SELF)
             f0.create_dataset('probes', shape=self.x.shape, dtype=float, data=self.x)
             for key, val in self.u.items():
@@ -248,10 +542,39 @@ class Probe:
             f0.close()
 
 class Stats:
+    """Statistics accumulated per wall-normal plane
 
-    def __init__(self, N, x, s, fromstats="", filename=""):
+    Parameters
+    ----------
+    N : 3-tuple of ints
+        The global shape
+    x : array
+        The wall-normal mesh
+    s : 3-tuple of slices
+        The local slice
+    fromstats : str, optional
+        Restart from statistics in file f'{fromstats}.h5'
+    filename : str, optional
+        Statistics are stored in f'{filename}.h5'
+    comm : MPI communicator, optional
+    pool : ThreadPool, optional
+        Used to accumulate blocks of planes in parallel
+    conditional : dict, optional
+        Enables conditional sampling, see :meth:`condition`, with keys
+
+        - holes : sequence of hole sizes of the quadrant analysis (0, 1, 2, 4)
+        - bins : number of bins of the joint PDFs in each direction (32)
+        - range : the joint PDFs cover +/- range times the rms (5)
+        - pairs : dict of name: ((field, component), (field, component))
+          for joint PDFs, where field is 'U' or 'W'. Defaults to the
+          streamwise and wall-normal velocity 'uv', and the streamwise
+          velocity and spanwise angular velocity 'uaz'
+    """
+    def __init__(self, N, x, s, fromstats="", filename="", comm=comm, pool=None, conditional=None):
+        self.comm = comm
+        self.pool = pool # ThreadPool used to accumulate blocks of planes in parallel
         self.N = N # global shape
-        self.x = x # mesh
+        self.x = np.ravel(x) # wall-normal mesh
         self.s = s # local slice
         M = self.s[0].stop-self.s[0].start # local x shape
         self.Q = (self.s[1].stop-self.s[1].start)*(self.s[2].stop-self.s[2].start)
@@ -278,6 +601,30 @@ class Stats:
         self.H_micro_var = np.zeros(M)
         self.H_micro_prime_var = np.zeros(M)
         self.bins = np.linspace(-1, 1, 37)
+        self.conditional = conditional = dict({'holes': (0, 1, 2, 4), 'bins': 32, 'range': 5,
+                                               'pairs': {'uv': (('U', 1), ('U', 0)), 'uaz': (('U', 1), ('W', 2))}},
+                                              **conditional) if conditional is not None else None
+        if conditional is not None:
+            nh, nb = len(conditional['holes']), conditional['bins']
+            self.quadrant_uv = np.zeros((nh, 4, M))     # Sum of u'v' in quadrants Q1-Q4
+            self.quadrant_count = np.zeros((nh, 4, M))  # Number of points in quadrants
+            self.quadrant_W = np.zeros((nh, 4, 3, M))   # Sum of angular velocity fluctuations in quadrants
+            self.joint_pdf = {name: np.zeros((M, nb, nb)) for name in conditional['pairs']}
+            self.away = np.where(self.x[s[0]] < 0, 1, -1)  # Sign of the wall-normal velocity away from the nearest wall
+        # Name and wall-normal axis of all accumulated arrays, in the order returned by get_stats
+        self.accumulators = {'Umean': -1, 'Wmean': -1, 'UU': -1, 'WW': -1, 'UW': -1, 'Ry': -1, 'Rz': -1,
+                             'helicity_pdf': 0, 'H_mean': -1, 'H_var': -1,
+                             'helicity_prime_pdf': 0, 'H_prime_mean': -1, 'H_prime_var': -1,
+                             'helicity_micro_pdf': 0, 'H_micro_mean': -1, 'H_micro_var': -1,
+                             'helicity_micro_prime_pdf': 0, 'H_micro_prime_mean': -1, 'H_micro_prime_var': -1,
+                             'Curlmean': -1, 'Curlvar': -1}
+        if conditional is not None:
+            self.accumulators.update({'quadrant_uv': -1, 'quadrant_count': -1, 'quadrant_W': -1})
+            for name, pdf in self.joint_pdf.items():
+                setattr(self, 'joint_pdf_'+name, pdf)
+                self.accumulators['joint_pdf_'+name] = 0
+        self.M = self.comm.allgather(M)               # local x shape on all ranks
+        self.starts = self.comm.allgather(s[0].start) # start of local x slice on all ranks
         self.symind = ((0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2))
         self.num_samples = 0
         self.fname = filename
@@ -286,7 +633,7 @@ class Stats:
             self.fromfile(filename=fromstats)
 
     def create_statsfile(self):
-        self.f0 = h5py.File(self.fname+".h5", "w", driver="mpio", comm=comm)
+        self.f0 = h5py.File(self.fname+".h5", "w", driver="mpio", comm=self.comm)
         self.f0.create_dataset('x', shape=(self.N[0],), dtype=float, data=self.x)
         self.f0.create_group("Average Velocity")
         self.f0.create_group("Reynolds Stress Velocity")
@@ -334,49 +681,56 @@ class Stats:
         self.f0["Helicity_Micro_Prime"].create_dataset("Hmean", shape=(self.N[0],), dtype=float)
         self.f0["Helicity_Micro_Prime"].create_dataset("Hvar", shape=(self.N[0],), dtype=float)
 
+        if self.conditional is not None:
+            nh, nb = len(self.conditional['holes']), self.conditional['bins']
+            g = self.f0.create_group("Quadrants")
+            g.attrs.create("holes", self.conditional['holes'])
+            g.create_dataset("uv", shape=(nh, 4, self.N[0]), dtype=float)
+            g.create_dataset("count", shape=(nh, 4, self.N[0]), dtype=float)
+            g.create_dataset("W", shape=(nh, 4, 3, self.N[0]), dtype=float)
+            g = self.f0.create_group("Joint PDF")
+            g.attrs.create("range", self.conditional['range'])
+            for name in self.joint_pdf:
+                g.create_dataset(name, shape=(self.N[0], nb, nb), dtype=float)
 
 
     def __call__(self, U, W, curl):
         self.num_samples += 1
-        self.Umean += np.sum(U, axis=(2, 3))
-        self.Wmean += np.sum(W, axis=(2, 3))
-        self.UU[0] += np.sum(U[0]*U[0], axis=(1, 2))
-        self.UU[1] += np.sum(U[1]*U[1], axis=(1, 2))
-        self.UU[2] += np.sum(U[2]*U[2], axis=(1, 2))
-        self.UU[3] += np.sum(U[0]*U[1], axis=(1, 2))
-        self.UU[4] += np.sum(U[0]*U[2], axis=(1, 2))
-        self.UU[5] += np.sum(U[1]*U[2], axis=(1, 2))
-        self.WW[0] += np.sum(W[0]*W[0], axis=(1, 2))
-        self.WW[1] += np.sum(W[1]*W[1], axis=(1, 2))
-        self.WW[2] += np.sum(W[2]*W[2], axis=(1, 2))
-        self.WW[3] += np.sum(W[0]*W[1], axis=(1, 2))
-        self.WW[4] += np.sum(W[0]*W[2], axis=(1, 2))
-        self.WW[5] += np.sum(W[1]*W[2], axis=(1, 2))
-        self.UW[0] += np.sum(U[0]*W[0], axis=(1, 2))
-        self.UW[1] += np.sum(U[0]*W[1], axis=(1, 2))
-        self.UW[2] += np.sum(U[0]*W[2], axis=(1, 2))
-        self.UW[3] += np.sum(U[1]*W[0], axis=(1, 2))
-        self.UW[4] += np.sum(U[1]*W[1], axis=(1, 2))
-        self.UW[5] += np.sum(U[1]*W[2], axis=(1, 2))
-        self.UW[6] += np.sum(U[2]*W[0], axis=(1, 2))
-        self.UW[7] += np.sum(U[2]*W[1], axis=(1, 2))
-        self.UW[8] += np.sum(U[2]*W[2], axis=(1, 2))
+        if self.pool is None:
+            self.accumulate(U, W, curl, slice(None))
+        else:
+            # All statistics are accumulated per wall-normal plane, so blocks of planes are independent
+            self.pool.map_blocks(lambda s: self.accumulate(U, W, curl, s), U.shape[1])
+
+    def accumulate(self, U, W, curl, s):
+        """Accumulate statistics for the planes s of the local wall-normal mesh"""
+        U, W, curl = U[:, s], W[:, s], curl[:, s]
+        self.Umean[:, s] += np.sum(U, axis=(2, 3))
+        self.Wmean[:, s] += np.sum(W, axis=(2, 3))
+        for j, (k, l) in enumerate(self.symind):
+            self.UU[j, s] += np.sum(U[k]*U[l], axis=(1, 2))
+            self.WW[j, s] += np.sum(W[k]*W[l], axis=(1, 2))
+        for k in range(3):
+            for l in range(3):
+                self.UW[3*k+l, s] += np.sum(U[k]*W[l], axis=(1, 2))
         for i in (0, 1): # y/z directions
             for j in range(6): # UU, VV, WW, UV, UW, VW
                 R = self.R[i][j]
                 k, l = self.symind[j]
                 for n in range(R.shape[0]): # n*dy/n*dz
-                    R[n] += np.sum(U[k].take(range(0, self.N[i+1]), axis=i+1, mode='wrap')*U[l].take(range(n, self.N[i+1]+n), axis=i+1, mode='wrap'), axis=(1, 2))
+                    R[n, s] += np.sum(U[k].take(range(0, self.N[i+1]), axis=i+1, mode='wrap')*U[l].take(range(n, self.N[i+1]+n), axis=i+1, mode='wrap'), axis=(1, 2))
 
         Nd = self.num_samples*self.Q
-        self.Curlmean += np.sum(curl, axis=(2, 3))
-        self.Curlvar += np.sum(curl*curl, axis=(0, 2, 3))
+        self.Curlmean[:, s] += np.sum(curl, axis=(2, 3))
+        self.Curlvar[s] += np.sum(curl*curl, axis=(0, 2, 3))
 
         ###########-- Fluctuations --############################
-        Up = U-self.Umean[:, :, None, None]/Nd          #Hydrod. Velocity fluct.
-        Vorp = curl-self.Curlmean[:, :, None, None]/Nd  #Vorticity fluct.
-        Wp = W - self.Wmean[:, :, None, None]/Nd        #Microp. Velocity fluct.
-        
+        Up = U-self.Umean[:, s, None, None]/Nd          #Hydrod. Velocity fluct.
+        Vorp = curl-self.Curlmean[:, s, None, None]/Nd  #Vorticity fluct.
+        Wp = W - self.Wmean[:, s, None, None]/Nd        #Microp. Velocity fluct.
+        if self.conditional is not None:
+            self.condition(Up, Wp, s)
+
         ###########-- Helicity Density --#########################
         H = np.sum(U*curl, axis=0)          #Hydrod. Helicity Density
         Hm = np.sum(U*W, axis=0)            #Microp. Helicity Density
@@ -394,143 +748,193 @@ class Stats:
 
         ###########-- Theta Values --#########################
         theta = H / (Umag*Vormag)
+        pdf = self.helicity_pdf[s]
         for i in range(theta.shape[0]):
-            self.helicity_pdf[i] += np.histogram(theta[i], self.bins)[0]
-        self.H_mean += np.sum(H, axis=(1, 2))
-        self.H_var += np.sum(H**2, axis=(1, 2))
-        self.get_stats()
+            pdf[i] += np.histogram(theta[i], self.bins)[0]
+        self.H_mean[s] += np.sum(H, axis=(1, 2))
+        self.H_var[s] += np.sum(H**2, axis=(1, 2))
 
         theta_prime = H_prime / (Upmag*Vorpmag)
+        pdf = self.helicity_prime_pdf[s]
         for i in range(theta_prime.shape[0]):
-            self.helicity_prime_pdf[i] += np.histogram(theta_prime[i], self.bins)[0]
-        self.H_prime_mean += np.sum(H_prime, axis=(1, 2))
-        self.H_prime_var += np.sum(H_prime**2, axis=(1, 2))
-        self.get_stats()
+            pdf[i] += np.histogram(theta_prime[i], self.bins)[0]
+        self.H_prime_mean[s] += np.sum(H_prime, axis=(1, 2))
+        self.H_prime_var[s] += np.sum(H_prime**2, axis=(1, 2))
 
         theta_micro = Hm / (Umag*Wmag)
+        pdf = self.helicity_micro_pdf[s]
         for i in range(theta_micro.shape[0]):
-            self.helicity_micro_pdf[i] += np.histogram(theta_micro[i], self.bins)[0]
-        self.H_micro_mean += np.sum(Hm, axis=(1, 2))
-        self.H_micro_var += np.sum(Hm**2, axis=(1, 2))
-        self.get_stats()
+            pdf[i] += np.histogram(theta_micro[i], self.bins)[0]
+        self.H_micro_mean[s] += np.sum(Hm, axis=(1, 2))
+        self.H_micro_var[s] += np.sum(Hm**2, axis=(1, 2))
 
         theta_micro_prime = Hm_prime / (Upmag*Wpmag)
+        pdf = self.helicity_micro_prime_pdf[s]
         for i in range(theta_micro_prime.shape[0]):
-            self.helicity_micro_prime_pdf[i] += np.histogram(theta_micro_prime[i], self.bins)[0]
-        self.H_micro_prime_mean += np.sum(Hm_prime, axis=(1, 2))
-        self.H_micro_prime_var += np.sum(Hm_prime**2, axis=(1, 2))
-        self.get_stats()
+            pdf[i] += np.histogram(theta_micro_prime[i], self.bins)[0]
+        self.H_micro_prime_mean[s] += np.sum(Hm_prime, axis=(1, 2))
+        self.H_micro_prime_var[s] += np.sum(Hm_prime**2, axis=(1, 2))
 
         #########################################################
 
 
 
-    def get_stats(self, tofile=True):
+    def condition(self, Up, Wp, s):
+        """Accumulate quadrant analysis and joint PDFs for the planes s
+
+        The quadrants of u'v' use the streamwise velocity u = U[1] and the
+        wall-normal velocity v pointing away from the nearest wall, such that
+        Q2 are ejections and Q4 sweeps in both halves of the channel. A point
+        belongs to hole size H if |u'v'| > H u_rms v_rms. The angular
+        velocity fluctuations are summed in each quadrant, for conditional
+        means. Joint PDFs are histograms of the fluctuations normalized by
+        their rms, where values outside the range are counted in the outer
+        bins. The wall-normal velocity points away from the nearest wall
+        here as well, such that both halves of the channel contribute the
+        same joint PDFs. The remaining components are binned as they are.
+        The rms are those of all samples so far.
+        """
+        Nd = self.num_samples*self.Q
+        c = self.conditional
+        Mb = Up.shape[1]
+        rms = {'U': np.sqrt(np.maximum(self.UU[:3, s]/Nd-(self.Umean[:, s]/Nd)**2, 1e-300)),
+               'W': np.sqrt(np.maximum(self.WW[:3, s]/Nd-(self.Wmean[:, s]/Nd)**2, 1e-300))}
+        fluct = {'U': Up, 'W': Wp}
+        plane = np.broadcast_to(np.arange(Mb)[:, None, None], Up.shape[1:])
+        u = Up[1]
+        away = self.away[s][:, None, None]
+        sign = {('U', 0): away}
+        v = Up[0]*away
+        uv = u*v
+        q = np.where(v > 0, np.where(u > 0, 0, 1), np.where(u < 0, 2, 3)) # Q1, Q2, Q3, Q4
+        index = (4*plane+q).ravel()
+        hole = np.abs(uv)/(rms['U'][1]*rms['U'][0])[:, None, None]
+        for h, H in enumerate(c['holes']):
+            event = (hole > H).ravel()
+            count = lambda w: np.bincount(index, weights=w, minlength=4*Mb).reshape(Mb, 4).T
+            self.quadrant_count[h, :, s] += count(event.astype(float))
+            self.quadrant_uv[h, :, s] += count(uv.ravel()*event)
+            for i in range(3):
+                self.quadrant_W[h, :, i, s] += count(Wp[i].ravel()*event)
+        nb = c['bins']
+        for name, ((f0, i0), (f1, i1)) in c['pairs'].items():
+            b = [np.clip(((fluct[f][i]*sign.get((f, i), 1)/rms[f][i][:, None, None]/c['range']+1)*nb/2).astype(int), 0, nb-1)
+                 for f, i in ((f0, i0), (f1, i1))]
+            index = ((plane*nb+b[0])*nb+b[1]).ravel()
+            self.joint_pdf[name][s] += np.bincount(index, minlength=Mb*nb*nb).reshape(Mb, nb, nb)
+
+    def tofile(self):
+        """Store statistics in the file f'{filename}.h5'"""
         s = self.s[0]
         Nd = self.num_samples*self.Q
-        comm.barrier()
-        if tofile:
-            if self.f0 is None:
-                self.create_statsfile()
-            else:
-                self.f0 = h5py.File(self.fname+".h5", "a", driver="mpio", comm=comm)
-
-            for i, name in enumerate(("U", "V", "W")):
-                self.f0["Average Velocity/"+name][s] = self.Umean[i]/Nd
-                self.f0["Average Angular Velocity/"+name][s] = self.Wmean[i]/Nd
-                self.f0["Curl/"+name][s] = self.Curlmean[i]/Nd
-            self.f0["Curl/Var"][s] = self.Curlvar/Nd
-
-            sl = (slice(None), s)
-            for i, name in enumerate(("UU", "VV", "WW", "UV", "UW", "VW")):
-                self.f0["Reynolds Stress Velocity/"+name][s] = self.UU[i]/Nd
-                self.f0["Reynolds Stress Angular Velocity/"+name][s] = self.WW[i]/Nd
-                self.f0["Two-point Y Correlations Velocity/"+name][sl] = self.Ry[i]/Nd
-                self.f0["Two-point Z Correlations Velocity/"+name][sl] = self.Rz[i]/Nd
-
-            for i, name in enumerate(("UU", "UV", "UW", "VU", "VV", "VW", "WU", "WV", "WW")):
-                self.f0["Cross Velocity Angular Velocity/"+name][s] = self.UW[i]/Nd
-
-            self.f0["Helicity/PDF"][s] = self.helicity_pdf/Nd
-            self.f0["Helicity/Hmean"][s] = self.H_mean/Nd
-            self.f0["Helicity/Hvar"][s] = self.H_var/Nd
-
-            self.f0["Helicity_Prime/PDF"][s] = self.helicity_prime_pdf/Nd
-            self.f0["Helicity_Prime/Hmean"][s] = self.H_prime_mean/Nd
-            self.f0["Helicity_Prime/Hvar"][s] = self.H_prime_var/Nd
-
-            self.f0["Helicity_Micro/PDF"][s] = self.helicity_micro_pdf/Nd
-            self.f0["Helicity_Micro/Hmean"][s] = self.H_micro_mean/Nd
-            self.f0["Helicity_Micro/Hvar"][s] = self.H_micro_var/Nd
-
-            self.f0["Helicity_Micro_Prime/PDF"][s] = self.helicity_micro_prime_pdf/Nd
-            self.f0["Helicity_Micro_Prime/Hmean"][s] = self.H_micro_prime_mean/Nd
-            self.f0["Helicity_Micro_Prime/Hvar"][s] = self.H_micro_prime_var/Nd
-
-
-            self.f0["Curl/Var"][s] = self.Curlvar/Nd
-
-            self.f0.attrs.create("num_samples", self.num_samples)
-            self.f0.close()
-
-        if comm.Get_size() == 1:
-            return self.Umean/Nd, self.Wmean/Nd, self.UU/Nd, self.WW/Nd, self.UW/Nd
-
-        if comm.Get_rank() == 0:
-            # Return the whole, collected array on rank 0
-            f0 = h5py.File(self.fname+".h5", "r", driver='mpio', comm=MPI.COMM_SELF)
-            data = (np.array([f0[f'Average Velocity/{name}'] for name in 'UVW']),
-                    np.array([f0[f'Average Angular Velocity/{name}'] for name in 'UVW']),
-                    np.array([f0[f'Reynolds Stress Velocity/{name}'] for name in ('UU', 'VV', 'WW', 'UV', 'UW', 'VW')]),
-                    np.array([f0[f'Reynolds Stress Angular Velocity/{name}'] for name in ('UU', 'VV', 'WW', 'UV', 'UW', 'VW')]),
-                    np.array([f0[f'Cross Velocity Angular Velocity/{name}'] for name in ('UU', 'UV', 'UW', 'VU', 'VV', 'VW', 'WU', 'WV', 'WW')]),
-                    np.array([f0[f'Two-point Y Correlations Velocity/{name}'] for name in ('UU', 'VV', 'WW', 'UV', 'UW', 'VW')]),
-                    np.array([f0[f'Two-point Z Correlations Velocity/{name}'] for name in ('UU', 'VV', 'WW', 'UV', 'UW', 'VW')]),
-                    np.array([f0['Helicity/PDF']]),
-                    np.array([f0['Helicity/Hmean']]),
-                    np.array([f0['Helicity/Hvar']]),
-                    np.array([f0['Helicity_Prime/PDF']]),
-                    np.array([f0['Helicity_Prime/Hmean']]),
-                    np.array([f0['Helicity_Prime/Hvar']]),
-                    np.array([f0['Helicity_Micro/PDF']]),
-                    np.array([f0['Helicity_Micro/Hmean']]),
-                    np.array([f0['Helicity_Micro/Hvar']]),
-                    np.array([f0['Helicity_Micro_Prime/PDF']]),
-                    np.array([f0['Helicity_Micro_Prime/Hmean']]),
-                    np.array([f0['Helicity_Micro_Prime/Hvar']]),
-                    np.array([f0[f'Curl/{name}'] for name in 'UVW']),
-                    np.array([f0['Curl/Var']]))
+        if self.f0 is None:
+            self.create_statsfile()
+        else:
+            self.f0 = h5py.File(self.fname+".h5", "a", driver="mpio", comm=self.comm)
 
-            f0.close()
-            return data
+        for i, name in enumerate(("U", "V", "W")):
+            self.f0["Average Velocity/"+name][s] = self.Umean[i]/Nd
+            self.f0["Average Angular Velocity/"+name][s] = self.Wmean[i]/Nd
+            self.f0["Curl/"+name][s] = self.Curlmean[i]/Nd
+        self.f0["Curl/Var"][s] = self.Curlvar/Nd
+
+        sl = (slice(None), s)
+        for i, name in enumerate(("UU", "VV", "WW", "UV", "UW", "VW")):
+            self.f0["Reynolds Stress Velocity/"+name][s] = self.UU[i]/Nd
+            self.f0["Reynolds Stress Angular Velocity/"+name][s] = self.WW[i]/Nd
+            self.f0["Two-point Y Correlations Velocity/"+name][sl] = self.Ry[i]/Nd
+            self.f0["Two-point Z Correlations Velocity/"+name][sl] = self.Rz[i]/Nd
+
+        for i, name in enumerate(("UU", "UV", "UW", "VU", "VV", "VW", "WU", "WV", "WW")):
+            self.f0["Cross Velocity Angular Velocity/"+name][s] = self.UW[i]/Nd
+
+        self.f0["Helicity/PDF"][s] = self.helicity_pdf/Nd
+        self.f0["Helicity/Hmean"][s] = self.H_mean/Nd
+        self.f0["Helicity/Hvar"][s] = self.H_var/Nd
+
+        self.f0["Helicity_Prime/PDF"][s] = self.helicity_prime_pdf/Nd
+        self.f0["Helicity_Prime/Hmean"][s] = self.H_prime_mean/Nd
+        self.f0["Helicity_Prime/Hvar"][s] = self.H_prime_var/Nd
+
+        self.f0["Helicity_Micro/PDF"][s] = self.helicity_micro_pdf/Nd
+        self.f0["Helicity_Micro/Hmean"][s] = self.H_micro_mean/Nd
+        self.f0["Helicity_Micro/Hvar"][s] = self.H_micro_var/Nd
+
+        self.f0["Helicity_Micro_Prime/PDF"][s] = self.helicity_micro_prime_pdf/Nd
+        self.f0["Helicity_Micro_Prime/Hmean"][s] = self.H_micro_prime_mean/Nd
+        self.f0["Helicity_Micro_Prime/Hvar"][s] = self.H_micro_prime_var/Nd
+
+        if self.conditional is not None:
+            self.f0["Quadrants/uv"][..., s] = self.quadrant_uv/Nd
+            self.f0["Quadrants/count"][..., s] = self.quadrant_count/Nd
+            self.f0["Quadrants/W"][..., s] = self.quadrant_W/Nd
+            for name, pdf in self.joint_pdf.items():
+                self.f0["Joint PDF/"+name][s] = pdf/Nd
+
+        self.f0.attrs.create("num_samples", self.num_samples)
+        self.f0.close()
+
+    def gather(self, a, axis=-1, root=0):
+        """Return global array from local array a, distributed along axis
+
+        Parameters
+        ----------
+        a : array
+            Local array of float
+        axis : int, optional
+            The wall-normal axis of a
+        root : int or None, optional
+            Return global array on this rank, and None on all others. If
+            None, return global array on all ranks.
+        """
+        b = np.ascontiguousarray(np.moveaxis(a, axis, 0))
+        rest = b[0].size
+        counts = [m*rest for m in self.M]
+        displs = [start*rest for start in self.starts]
+        if root is None:
+            c = np.empty((self.N[0],)+b.shape[1:])
+            self.comm.Allgatherv(b, [c, counts, displs, MPI.DOUBLE])
+        else:
+            c = np.empty((self.N[0],)+b.shape[1:]) if self.comm.Get_rank() == root else None
+            self.comm.Gatherv(b, [c, counts, displs, MPI.DOUBLE] if c is not None else None, root=root)
+            if c is None:
+                return None
+        return np.moveaxis(c, 0, axis)
+
+    def get_stats(self, root=0):
+        """Return global statistics collected with MPI
+
+        Parameters
+        ----------
+        root : int or None, optional
+            Return statistics on this rank, and None on all others. If None,
+            return statistics on all ranks.
+
+        Note
+        ----
+        The statistics are not stored to file. Use :meth:`tofile` for that.
+        """
+        Nd = self.num_samples*self.Q
+        data = tuple(self.gather(getattr(self, name)/Nd, axis, root) for name, axis in self.accumulators.items())
+        return None if data[0] is None else data
+
+    def get_state(self):
+        """Return the local accumulated sums"""
+        return {'num_samples': self.num_samples, **{name: getattr(self, name) for name in self.accumulators}}
+
+    def set_state(self, state):
+        self.num_samples = int(state['num_samples'])
+        for name in self.accumulators:
+            getattr(self, name)[:] = state[name]
 
     def reset_stats(self):
         self.num_samples = 0
-        self.Umean[:] = 0
-        self.Wmean[:] = 0
-        self.UU[:] = 0
-        self.WW[:] = 0
-        self.UW[:] = 0
-        self.Ry[:] = 0
-        self.Rz[:] = 0
-        self.helicity_pdf[:] = 0
-        self.H_mean[:] = 0
-        self.H_var[:] = 0
-        self.helicity_prime_pdf[:] = 0
-        self.H_prime_mean[:] = 0
-        self.H_prime_var[:] = 0
-        self.helicity_micro_pdf[:] = 0
-        self.H_micro_mean[:] = 0
-        self.H_micro_var[:] = 0
-        self.helicity_micro_prime_pdf[:] = 0
-        self.H_micro_prime_mean[:] = 0
-        self.H_micro_prime_var[:] = 0
-        self.Curlmean[:] = 0
-        self.Curlvar[:] = 0
+        for name in self.accumulators:
+            getattr(self, name)[:] = 0
 
     def fromfile(self, filename="stats"):
         self.fname = filename
-        self.f0 = h5py.File(filename+".h5", "a", driver="mpio", comm=comm)
+        self.f0 = h5py.File(filename+".h5", "a", driver="mpio", comm=self.comm)
         self.num_samples = self.f0.attrs["num_samples"]
         M = (self.s[1].stop-self.s[1].start)*(self.s[2].stop-self.s[2].start)
         Nd = self.num_samples*M
@@ -560,8 +964,485 @@ class Stats:
         self.H_micro_prime_mean[:] = self.f0['Helicity_Micro_Prime/Hmean'][s]*Nd
         self.H_micro_prime_var[:] = self.f0['Helicity_Micro_Prime/Hvar'][s]*Nd
         self.Curlvar[:] = self.f0['Curl/Var'][s]*Nd
+        if self.conditional is not None and 'Quadrants' in self.f0:
+            self.quadrant_uv[:] = self.f0['Quadrants/uv'][..., s]*Nd
+            self.quadrant_count[:] = self.f0['Quadrants/count'][..., s]*Nd
+            self.quadrant_W[:] = self.f0['Quadrants/W'][..., s]*Nd
+            for name, pdf in self.joint_pdf.items():
+                pdf[:] = self.f0['Joint PDF/'+name][s]*Nd
+        self.f0.close()
+
+class Budgets(Stats):
+    """In-situ budgets of the second moments of velocity and angular velocity
+
+    Raw moments are accumulated per wall-normal plane on the padded grid of
+    the nonlinear terms. The velocity and angular velocity gradients are
+    those computed by the convection, and the pressure is computed by
+    :meth:`KMM.compute_pressure`. The budget terms, with fluctuations about
+    the mean over all samples, follow from the raw moments and are returned
+    by :meth:`get_budgets`.
+
+    Parameters
+    ----------
+    N : 3-tuple of ints
+        The global padded shape
+    x : array
+        The padded wall-normal mesh
+    s : 3-tuple of slices
+        The local padded slice
+    space : FunctionSpace
+        Orthogonal 1D space with mesh x, used for wall-normal derivatives
+    filename : str, optional
+        Raw moments are stored in f'{filename}.h5'
+    comm : MPI communicator, optional
+    pool : ThreadPool, optional
+        Used to accumulate blocks of planes in parallel
+    """
+    def __init__(self, N, x, s, space, filename="", comm=comm, pool=None):
+        self.comm = comm
+        self.pool = pool
+        self.N = N
+        self.x = np.ravel(x) # wall-normal mesh
+        self.s = s
+        self.space = space
+        M = self.s[0].stop-self.s[0].start
+        self.Q = (self.s[1].stop-self.s[1].start)*(self.s[2].stop-self.s[2].start)
+        # Number of components of all accumulated arrays. u is velocity, w angular velocity,
+        # p pressure, dU, dW and dP gradients (i major) and cU, cW curls
+        self.components = {'U': 3, 'W': 3, 'P': 1, 'PP': 1, 'dU': 9, 'dW': 9, 'dP': 3,
+                             'UU': 6,    # <u_i u_j>
+                             'WW': 6,    # <w_i w_j>
+                             'UW': 9,    # <u_i w_j>
+                             'UUx': 6,   # <u_i u_j u_x>
+                             'WWx': 6,   # <w_i w_j u_x>
+                             'dUdU': 6,  # <du_i/dx_k du_j/dx_k>
+                             'dWdW': 6,  # <dw_i/dx_k dw_j/dx_k>
+                             'PU': 3,    # <p u_i>
+                             'UdP': 9,   # <u_i dp/dx_j>
+                             'PdU': 9,   # <p du_i/dx_j>
+                             'UcW': 9,   # <u_i cW_j>
+                             'WcU': 9}   # <w_i cU_j>
+        self.accumulators = dict.fromkeys(self.components, -1) # Wall-normal axis, see Stats
+        for name, n in self.components.items():
+            setattr(self, name, np.zeros((n, M)))
+        self.M = self.comm.allgather(M)
+        self.starts = self.comm.allgather(s[0].start)
+        self.symind = ((0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2))
+        self.num_samples = 0
+        self.fname = filename
+        self.created = False
+
+    def __call__(self, U, G, p, dP, W, Gw):
+        """Accumulate one sample
+
+        Parameters
+        ----------
+        U, W : sequences of 3 padded arrays
+            Velocity and angular velocity
+        G, Gw : sequences of 9 padded arrays
+            Gradients du_i/dx_j and dw_i/dx_j, in the order i*3+j
+        p : padded array
+            Pressure
+        dP : sequence of 3 padded arrays
+            Pressure gradient
+        """
+        self.num_samples += 1
+        if self.pool is None:
+            self.accumulate(U, G, p, dP, W, Gw, slice(None))
+        else:
+            self.pool.map_blocks(lambda s: self.accumulate(U, G, p, dP, W, Gw, s), p.shape[0])
+
+    @staticmethod
+    def curl(G):
+        return [G[7]-G[5], G[2]-G[6], G[3]-G[1]]
+
+    def accumulate(self, U, G, p, dP, W, Gw, s):
+        """Accumulate raw moments for the planes s of the local wall-normal mesh"""
+        U, G, dP, W, Gw = ([a[s] for a in b] for b in (U, G, dP, W, Gw))
+        p = p[s]
+        cU, cW = self.curl(G), self.curl(Gw)
+        mean = lambda a: np.sum(a, axis=(1, 2))
+        for i in range(3):
+            self.U[i, s] += mean(U[i])
+            self.W[i, s] += mean(W[i])
+            self.dP[i, s] += mean(dP[i])
+            self.PU[i, s] += mean(p*U[i])
+            for j in range(3):
+                self.dU[3*i+j, s] += mean(G[3*i+j])
+                self.dW[3*i+j, s] += mean(Gw[3*i+j])
+                self.UW[3*i+j, s] += mean(U[i]*W[j])
+                self.UdP[3*i+j, s] += mean(U[i]*dP[j])
+                self.PdU[3*i+j, s] += mean(p*G[3*i+j])
+                self.UcW[3*i+j, s] += mean(U[i]*cW[j])
+                self.WcU[3*i+j, s] += mean(W[i]*cU[j])
+        self.P[0, s] += mean(p)
+        self.PP[0, s] += mean(p*p)
+        for n, (i, j) in enumerate(self.symind):
+            uu = U[i]*U[j]
+            ww = W[i]*W[j]
+            self.UU[n, s] += mean(uu)
+            self.WW[n, s] += mean(ww)
+            self.UUx[n, s] += mean(uu*U[0])
+            self.WWx[n, s] += mean(ww*U[0])
+            self.dUdU[n, s] += mean(sum(G[3*i+k]*G[3*j+k] for k in range(3)))
+            self.dWdW[n, s] += mean(sum(Gw[3*i+k]*Gw[3*j+k] for k in range(3)))
+
+    def ddx(self, f, k=1):
+        """Return k'th wall-normal derivative of global profile f"""
+        f_hat = Array(self.space, buffer=f).forward()
+        return project(Dx(f_hat, 0, k), self.space).backward()
+
+    def get_budgets(self, nu, kappa, NP, m, root=0):
+        """Return budget terms of the second moments
+
+        Parameters
+        ----------
+        nu, kappa, NP, m : numbers
+            Parameters of the micropolar model, see :class:`MicroPolar`
+        root : int or None, optional
+            Return budgets on this rank, and None on all others. If None,
+            return budgets on all ranks.
+
+        Returns
+        -------
+        Dict with pressure statistics, and for 'uu' and 'ww' a dict of
+        budget terms for each of the components 'uu', 'vv', 'ww', 'uv',
+        'uw' and 'vw'. The terms of each component sum to its rate of change.
+        """
+        data = self.get_stats(root)
+        if data is None:
+            return None
+        a = dict(zip(self.accumulators, data))
+        U, W, dP = a['U'], a['W'], a['dP']
+        P = a['P'][0]
+        dU, dW = a['dU'].reshape(3, 3, -1), a['dW'].reshape(3, 3, -1)
+        cU, cW = np.array(self.curl(a['dU'])), np.array(self.curl(a['dW']))
+        sym = {}
+        for n, (i, j) in enumerate(self.symind):
+            sym[i, j] = sym[j, i] = n
+        UU = lambda i, j: a['UU'][sym[i, j]]
+        WW = lambda i, j: a['WW'][sym[i, j]]
+        UW = lambda i, j: a['UW'][3*i+j]
+        uu = np.array([[UU(i, j)-U[i]*U[j] for j in range(3)] for i in range(3)])
+        ww = np.array([[WW(i, j)-W[i]*W[j] for j in range(3)] for i in range(3)])
+        uw = np.array([[UW(i, j)-U[i]*W[j] for j in range(3)] for i in range(3)])
+        up = a['PU']-P*U
+        udp = a['UdP'].reshape(3, 3, -1)-U[:, None]*dP[None]
+        pdu = a['PdU'].reshape(3, 3, -1)-P*dU
+        ucw = a['UcW'].reshape(3, 3, -1)-U[:, None]*cW[None]
+        wcu = a['WcU'].reshape(3, 3, -1)-W[:, None]*cU[None]
+        budgets = {'x': self.x, 'p_mean': P, 'p_var': a['PP'][0]-P**2, 'up': up, 'udpdx': udp, 'uu': {}, 'ww': {}}
+        for n, (i, j) in enumerate(self.symind):
+            name = 'uvw'[i]+'uvw'[j]
+            uux = a['UUx'][n]-U[i]*UU(j, 0)-U[j]*UU(i, 0)-U[0]*UU(i, j)+2*U[i]*U[j]*U[0]
+            wwx = a['WWx'][n]-W[i]*UW(0, j)-W[j]*UW(0, i)-U[0]*WW(i, j)+2*W[i]*W[j]*U[0]
+            eps = a['dUdU'][n]-sum(dU[i, k]*dU[j, k] for k in range(3))
+            epsw = a['dWdW'][n]-sum(dW[i, k]*dW[j, k] for k in range(3))
+            budgets['uu'][name] = {
+                'stress': uu[i, j],
+                'production': -sum(uu[i, k]*dU[j, k]+uu[j, k]*dU[i, k] for k in range(3)),
+                'dissipation': -2*nu*eps,
+                'turbulent_transport': -self.ddx(uux),
+                'viscous_diffusion': nu*self.ddx(uu[i, j], 2),
+                'velocity_pressure_gradient': -(udp[i, j]+udp[j, i]),
+                'pressure_strain': pdu[i, j]+pdu[j, i],
+                'pressure_diffusion': -self.ddx(up[i]*(j == 0)+up[j]*(i == 0)),
+                'coupling': m*nu*(ucw[i, j]+ucw[j, i])}
+            budgets['ww'][name] = {
+                'stress': ww[i, j],
+                'production': -sum(uw[k, i]*dW[j, k]+uw[k, j]*dW[i, k] for k in range(3)),
+                'dissipation': -2*kappa*epsw,
+                'turbulent_transport': -self.ddx(wwx),
+                'viscous_diffusion': kappa*self.ddx(ww[i, j], 2),
+                'coupling': kappa*NP*(wcu[i, j]+wcu[j, i])-4*NP*kappa*ww[i, j]}
+        return budgets
+
+    def tofile(self):
+        """Store the means of the raw moments in the file f'{filename}.h5'"""
+        s = self.s[0]
+        Nd = self.num_samples*self.Q
+        f = h5py.File(self.fname+".h5", "a" if self.created else "w", driver="mpio", comm=self.comm)
+        if not self.created:
+            f.create_dataset('x', shape=(self.N[0],), dtype=float, data=self.x)
+            for name, n in self.components.items():
+                f.create_dataset(name, shape=(n, self.N[0]), dtype=float)
+            self.created = True
+        for name in self.accumulators:
+            f[name][:, s] = getattr(self, name)/Nd
+        f.attrs.create("num_samples", self.num_samples)
+        f.close()
+
+    def fromfile(self, filename="budgets"):
+        self.fname = filename
+        f = h5py.File(filename+".h5", "r", driver="mpio", comm=self.comm)
+        self.num_samples = f.attrs["num_samples"]
+        Nd = self.num_samples*self.Q
+        for name in self.accumulators:
+            getattr(self, name)[:] = f[name][:, self.s[0]]*Nd
+        f.close()
+        self.created = True
+
+class Spectra:
+    """Time averaged 1D and 2D spectra as functions of the wall distance
+
+    The spectra are computed directly from the spectral coefficients of the
+    velocity and angular velocity, which are Fourier coefficients in y and z.
+    Only the Chebyshev direction is transformed, using a matrix product with
+    the basis functions evaluated at the quadrature points. The mean (0, 0)
+    mode is not included.
+
+    Parameters
+    ----------
+    N : 3-tuple of ints
+        The global shape in physical space
+    L : 2-tuple of numbers
+        Domain length in y and z directions
+    u : dict
+        Vector Functions (velocity and angular velocity), {'U': u_, 'W': w_}
+    twod : bool, optional
+        Whether to also accumulate 2D spectra E(x, ky, kz) of the energy.
+        These are of the same size as a 3D Function for each component.
+    filename : str, optional
+        Name of file (f'{filename}.h5') used to store the spectra
+    comm : MPI communicator, optional
+        Communicator of the Functions in u
+
+    Note
+    ----
+    The spectra of the pair of components i and j are sums over the other
+    Fourier direction of Re(u_i u_j^*). Summed over all wavenumbers the
+    spectra of the diagonal components equal the Reynolds stresses.
+    """
+    def __init__(self, N, L, u, twod=False, filename="", comm=comm):
+        self.N = N
+        self.L = L
+        self.u = u
+        self.twod = twod
+        self.fname = filename
+        self.comm = comm
+        self.f0 = None
+        self.num_samples = 0
+        self.names = {}
+        self.pairs = {}
+        self.V = {}
+        for name, ui in u.items():
+            self.V[name] = []
+            for T in ui.function_space().flatten():
+                B = T.bases[0]
+                x = B.points_and_weights()[0]
+                self.V[name].append(np.array([B.evaluate_basis(x, i=j) for j in range(B.dim())]).T)
+        self.s = s = ui.function_space().flatten()[0].local_slice(True)
+        names = list(u.keys())
+        for name in names:
+            self.pairs[name] = [(name, i, name, j) for (i, j) in ((0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2))]
+            self.names[name] = ("UU", "VV", "WW", "UV", "UW", "VW")
+        for a, b in zip(names[:-1], names[1:]):
+            self.pairs[a+b] = [(a, i, b, j) for i in range(3) for j in range(3)]
+            self.names[a+b] = ("UU", "UV", "UW", "VU", "VV", "VW", "WU", "WV", "WW")
+        M = (s[1].stop-s[1].start, N[2]//2+1)
+        self.Ey = {key: np.zeros((len(p), N[0], M[0])) for key, p in self.pairs.items()}
+        self.Ez = {key: np.zeros((len(p), N[0], M[1])) for key, p in self.pairs.items()}
+        self.E2 = {name: np.zeros((3, N[0])+M) for name in names} if twod else {}
+        # Real transform in z. All modes except kz=0 and Nyquist represent two complex conjugate modes
+        self.wz = np.full(M[1], 2.)
+        self.wz[0] = 1
+        self.wz[N[2]//2] = 0
+
+    def __call__(self):
+        self.num_samples += 1
+        a = {}
+        for name, ui in self.u.items():
+            a[name] = []
+            for i in range(3):
+                V = self.V[name][i]
+                a[name].append(np.tensordot(V, ui[i, :V.shape[1]], axes=(1, 0)))
+                if self.s[1].start == 0:
+                    a[name][i][:, 0, 0] = 0 # Remove mean
+        for key, pairs in self.pairs.items():
+            for n, (p, i, q, j) in enumerate(pairs):
+                E = (a[p][i]*a[q][j].conj()).real*self.wz
+                self.Ey[key][n] += E.sum(axis=2)
+                self.Ez[key][n] += E.sum(axis=1)
+                if key in self.E2 and n < 3:
+                    self.E2[key][n] += E
+
+    def get_state(self):
+        state = {'num_samples': self.num_samples}
+        for name in ('Ey', 'Ez', 'E2'):
+            state.update({f'{name}/{key}': val for key, val in getattr(self, name).items()})
+        return state
+
+    def set_state(self, state):
+        self.num_samples = int(state['num_samples'])
+        for name in ('Ey', 'Ez', 'E2'):
+            for key, val in getattr(self, name).items():
+                val[:] = state[f'{name}/{key}']
+
+    def create_spectrafile(self):
+        N = self.N
+        self.f0 = h5py.File(self.fname+".h5", "w", driver="mpio", comm=self.comm)
+        self.f0.create_dataset('ky', data=2*np.pi/self.L[0]*np.fft.fftfreq(N[1], 1/N[1]))
+        self.f0.create_dataset('kz', data=2*np.pi/self.L[1]*np.arange(N[2]//2+1))
+        for key, names in self.names.items():
+            group = "Spectra " + {'U': "Velocity", 'W': "Angular Velocity"}.get(key, "Cross Velocity Angular Velocity")
+            self.f0.create_group(group)
+            for name in names:
+                self.f0[group].create_dataset('Ey/'+name, shape=(N[0], N[1]), dtype=float)
+                self.f0[group].create_dataset('Ez/'+name, shape=(N[0], N[2]//2+1), dtype=float)
+                if key in self.E2 and name in ("UU", "VV", "WW"):
+                    self.f0[group].create_dataset('E2/'+name, shape=(N[0], N[1], N[2]//2+1), dtype=float)
+
+    def tofile(self):
+        if self.num_samples == 0:
+            return
+        if self.f0 is None:
+            self.create_spectrafile()
+        else:
+            self.f0 = h5py.File(self.fname+".h5", "a", driver="mpio", comm=self.comm)
+        s = self.s[1]
+        n = self.num_samples
+        for key, names in self.names.items():
+            group = "Spectra " + {'U': "Velocity", 'W': "Angular Velocity"}.get(key, "Cross Velocity Angular Velocity")
+            Ez = np.zeros_like(self.Ez[key])
+            self.comm.Reduce(self.Ez[key], Ez, op=MPI.SUM, root=0)
+            for i, name in enumerate(names):
+                self.f0[f'{group}/Ey/{name}'][:, s] = self.Ey[key][i]/n
+                if self.comm.Get_rank() == 0:
+                    self.f0[f'{group}/Ez/{name}'][:] = Ez[i]/n
+                if key in self.E2 and i < 3:
+                    self.f0[f'{group}/E2/{name}'][:, s] = self.E2[key][i]/n
+        self.f0.attrs.create("num_samples", self.num_samples)
         self.f0.close()
 
+class ConvergenceMonitor:
+    """Monitor statistical convergence of Stats using batch means
+
+    The samples of some key profiles are averaged in batches. The batch
+    means are treated as independent, which is checked through their lag-1
+    autocorrelation. If the batch means are correlated, neighbouring batches
+    are merged, doubling the batch size. The half-width of the confidence
+    interval of a profile is z times the standard error of the batch means.
+    The second moments are monitored as central moments, like the Reynolds
+    stress <v'v'>, by subtracting the product of the mean profiles of each
+    batch from the raw moments of the batch. The mean profiles are also
+    compared with their mirror images across the channel center.
+
+    Parameters
+    ----------
+    stats : Stats
+        The statistics to monitor. Must be called after each call to stats.
+    tol : number, optional
+        Required relative half-width of the confidence intervals, relative
+        to the maximum of each profile
+    symtol : number, optional
+        Required relative deviation from symmetry (or antisymmetry)
+    batch_size : int, optional
+        Initial number of samples in each batch
+    min_batches : int, optional
+        Minimum number of batches used for an estimate
+    z : number, optional
+        Number of standard errors in the confidence interval
+    maxcorr : number, optional
+        Merge batches if lag-1 autocorrelation of the batch means is larger
+    verbose : bool, optional
+        Print estimates each time a batch is completed
+    """
+    # name: (accumulator, component, parity, components of the means subtracted).
+    # Parity 0 means no symmetry check
+    quantities = {'V': ('Umean', 1, 1, None),
+                  'uu': ('UU', 0, 1, (0, 0)),
+                  'vv': ('UU', 1, 1, (1, 1)),
+                  'ww': ('UU', 2, 1, (2, 2)),
+                  'uv': ('UU', 3, -1, (0, 1)),
+                  'Wz': ('Wmean', 2, -1, None),
+                  'axax': ('WW', 0, 1, (0, 0)),
+                  'ayay': ('WW', 1, 1, (1, 1)),
+                  'azaz': ('WW', 2, 1, (2, 2)),
+                  'H': ('H_mean', None, 0, None),
+                  'Hm': ('H_micro_mean', None, 0, None)}
+    means = {'UU': 'Umean', 'WW': 'Wmean'}
+
+    def __init__(self, stats, tol=0.01, symtol=0.02, batch_size=10, min_batches=10, z=2, maxcorr=0.2, verbose=True):
+        self.stats = stats
+        self.tol = tol
+        self.symtol = symtol
+        self.batch_size = batch_size
+        self.min_batches = min_batches
+        self.z = z
+        self.maxcorr = maxcorr
+        self.verbose = verbose
+        self.prev = self.raw()
+        self.batch = np.zeros_like(self.prev)
+        self.count = 0
+        self.batches = []
+        self.error = {}
+        self.converged = False
+
+    def get_state(self):
+        return {'prev': self.prev, 'batch': self.batch, 'count': self.count, 'batch_size': self.batch_size,
+                'batches': np.array(self.batches), 'converged': self.converged}
+
+    def set_state(self, state):
+        self.prev[:] = state['prev']
+        self.batch[:] = state['batch']
+        self.count = int(state['count'])
+        self.batch_size = int(state['batch_size'])
+        self.batches = list(state['batches'])
+        self.converged = bool(state['converged'])
+
+    def raw(self):
+        """Return local accumulated sums of monitored quantities, followed by those of Umean and Wmean"""
+        a = []
+        for name, i, parity, pair in self.quantities.values():
+            x = getattr(self.stats, name)
+            a.append(x if i is None else x[i])
+        return np.concatenate((np.array(a), self.stats.Umean, self.stats.Wmean))
+
+    def central(self, b):
+        """Return monitored quantities of batch means b of :meth:`raw`, with central second moments"""
+        n = len(self.quantities)
+        q = b[:n].copy()
+        mean = {'Umean': b[n:n+3], 'Wmean': b[n+3:n+6]}
+        for j, (name, i, parity, pair) in enumerate(self.quantities.values()):
+            if pair is not None:
+                m = mean[self.means[name]]
+                q[j] -= m[pair[0]]*m[pair[1]]
+        return q
+
+    def __call__(self, t=0):
+        cur = self.raw()
+        self.batch += (cur-self.prev)/self.stats.Q
+        self.prev = cur
+        self.count += 1
+        if self.count == self.batch_size:
+            self.batches.append(self.stats.gather(self.central(self.batch/self.count), root=None))
+            self.batch[:] = 0
+            self.count = 0
+            if len(self.batches) >= self.min_batches:
+                self.estimate(t)
+
+    def estimate(self, t=0):
+        B = np.array(self.batches)
+        m = B.mean(axis=0)
+        d = B-m
+        r1 = np.sum(d[1:]*d[:-1], axis=0)/np.maximum(np.sum(d*d, axis=0), 1e-300)
+        if np.max(np.median(r1, axis=-1)) > self.maxcorr and len(B) >= 2*self.min_batches:
+            # Batches are too short to be independent
+            nb = len(B)//2
+            self.batches = list(0.5*(B[:2*nb:2]+B[1:2*nb:2]))
+            self.batch_size *= 2
+            return self.estimate(t)
+        scale = np.maximum(np.max(abs(m), axis=-1), 1e-300)
+        halfwidth = self.z*B.std(axis=0, ddof=1)/np.sqrt(len(B))
+        ci = np.max(halfwidth, axis=-1)/scale
+        sym = np.array([np.max(abs(mi-parity*mi[::-1]))/(2*si) if parity != 0 else 0
+                        for mi, si, (_, _, parity, _) in zip(m, scale, self.quantities.values())])
+        self.error = {name: (c, s) for name, c, s in zip(self.quantities, ci, sym)}
+        self.converged = bool(np.all(ci <= self.tol) and np.all(sym <= self.symtol))
+        if self.verbose and self.stats.comm.Get_rank() == 0:
+            worst = max(self.error, key=lambda name: self.error[name][0])
+            print(f"Time {t:2.4e} batches {len(B)}x{self.batch_size} max ci {ci.max():2.4e} ({worst}) max sym {sym.max():2.4e} converged {self.converged}")
+
 if __name__ == '__main__':
     from time import time
     from mpi4py_fft import generate_xdmf
@@ -583,19 +1464,39 @@ if __name__ == '__main__':
         'sample_stats': 100,
         'padding_factor': (1.5, 1.5, 1.5),
         'probes': None, #np.array([[0.1, 0.2], [0, 0], [0, 0]]), # Two probes at (0.1, 0, 0) and (0.2, 0, 0).
-        'timestepper': 'IMEXRK222', # IMEXRK222, IMEXRK443, IMEXRK3
+        'timestepper': 'IMEXRK222', # IMEXRK222, IMEXRK443, IMEXRK3, IMEXRK3LS (low-storage)
+        'cache': '.cache', # Store FFTW wisdom for faster startup
+        'spectra': False, # True for 1D spectra, '2D' to also store 2D spectra
+        'convergence': None, # For example {'tol': 0.01} to stop when statistics are converged
+        'budgets': False, # True to sample budgets of the second moments with the statistics
+        'conditional': None, # For example {'holes': (0, 2)} for quadrant analysis and joint PDFs
+        'tracers': None, # For example {'number': 100000} for tracers, add 'tau': 0.1 for inertial particles
+        'pod': None, # For example {'rank': 20, 'every': 50, 'wavenumbers': 'all'} for streaming POD, see POD.py
+        'average': None, # For example {'every': 10} for time averaged 3D mean and rms fields, see TimeAverage.py
+        'pipeline': 0, # For example 3 to overlap MPI exchanges of 3 components with computations
+        'threads': 1, # Threads per rank, for runs with fewer ranks than cores
+        'walltime': None, # E.g., '24:00:00', or set MICROPOLAR_WALLTIME. Checkpoints right before it
+        'metrics': {'sinks': ('stdout', 'h5'), 'flushevery': 10}, # Add 'csv' or 'udp://localhost:9999' for dashboards
         }
     c = MKM(**d)
-    t, tstep = c.initialize(from_checkpoint=True)
-    c.solve(t=0, tstep=0, end_time=30)
+    t, tstep = c.initialize(from_checkpoint=True) # Restores statistics and probes as well
+    #t, tstep = c.initialize(mean='mixing') # New run, starting close to the turbulent mean profiles
+    c.solve(t=t, tstep=tstep, end_time=30)
+    c.steady_report()
+    c.print_timings()
+    c.memory_report()
+    if c.pipeline is not None:
+        c.pipeline.report()
     #print('Computing time %2.4f'%(time()-t0))
     #print(c.TB.local_slice(False), c.ub.shape)
     if comm.Get_rank() == 0:
         generate_xdmf('_'.join((d['filename'], 'U'))+'.h5')
         generate_xdmf('_'.join((d['filename'], 'W'))+'.h5')
     stats = c.stats.get_stats()
+    budgets = c.budgets.get_budgets(c.nu, c.kappa, c.NP, c.m) if c.budgets is not None else None
     if comm.Get_rank() == 0:
-        u0, w0, uu, ww, uw = stats
+        import matplotlib.pyplot as plt
+        u0, w0, uu, ww, uw = stats[:5]
         x = c.B0.mesh(bcast=False)
         plt.figure()
         plt.semilogx((1-x[:32])*180, u0[1, :32], 'r', (1+x[32:])*180, u0[1, 32:], 'b')
@@ -0,0 +1,163 @@
+"""Buffered time series of scalar diagnostics
+
+Scalars like energies, flux, divergence, timings and I/O volumes are recorded
+into a preallocated ring buffer, which costs a few array assignments per
+record. The buffer is flushed in bulk to one or more sinks every flushevery
+records, or when full. Sinks are created from short specifications
+
+    'csv'                      f'{filename}_metrics.csv', appended
+    'h5'                       f'{filename}_metrics.h5', dataset 'metrics' appended
+    'stdout'                   formatted table, printed in one call per flush
+    'udp://localhost:9999'     JSON lines sent as UDP datagrams
+    'unix:///tmp/metrics'      JSON lines sent to a unix datagram socket
+
+Socket sinks never block and silently drop data if nobody is listening, so
+a dashboard may be attached and detached at any time. The most recent
+records are available in memory through :meth:`Metrics.history`.
+"""
+import os
+import json
+import socket
+import numpy as np
+import h5py
+
+__all__ = ['Metrics', 'CSVSink', 'HDF5Sink', 'SocketSink', 'StdoutSink', 'make_sink']
+
+class CSVSink:
+    def __init__(self, filename):
+        self.filename = filename
+
+    def write(self, columns, rows):
+        header = not os.path.exists(self.filename)
+        with open(self.filename, 'a') as f:
+            if header:
+                f.write(','.join(columns)+'\n')
+            np.savetxt(f, rows, delimiter=',', fmt='%.10g')
+
+class HDF5Sink:
+    def __init__(self, filename):
+        self.filename = filename
+
+    def write(self, columns, rows):
+        with h5py.File(self.filename, 'a') as f:
+            if 'metrics' not in f:
+                d = f.create_dataset('metrics', shape=(0, len(columns)), maxshape=(None, len(columns)), dtype=float, chunks=True)
+                d.attrs['columns'] = columns
+            d = f['metrics']
+            assert list(d.attrs['columns']) == list(columns), 'Cannot append to metrics with other columns'
+            n = d.shape[0]
+            d.resize(n+len(rows), axis=0)
+            d[n:] = rows
+
+class SocketSink:
+    def __init__(self, address):
+        if address.startswith('unix://'):
+            self.address = address[7:]
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        else:
+            host, port = address[6:].rsplit(':', 1)
+            self.address = (host, int(port))
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def write(self, columns, rows):
+        for row in rows:
+            try:
+                self.sock.sendto(json.dumps(dict(zip(columns, row.tolist()))).encode(), self.address)
+            except OSError: # Nobody listening, or buffer full
+                pass
+
+class StdoutSink:
+    def __init__(self, header=20):
+        self.header = header
+        self.count = 0
+
+    def write(self, columns, rows):
+        lines = []
+        for row in rows:
+            if self.count % self.header == 0:
+                lines.append(''.join(f'{name:^11}' for name in columns))
+            lines.append(' '.join(f'{int(x):10d}' if name == 'tstep' else f'{x:2.4e}' for name, x in zip(columns, row)))
+            self.count += 1
+        print('\n'.join(lines), flush=True)
+
+def make_sink(spec, filename):
+    """Return sink from specification, see module documentation"""
+    if not isinstance(spec, str):
+        return spec
+    if spec == 'csv':
+        return CSVSink(filename+'_metrics.csv')
+    if spec == 'h5':
+        return HDF5Sink(filename+'_metrics.h5')
+    if spec == 'stdout':
+        return StdoutSink()
+    if spec.startswith(('udp://', 'unix://')):
+        return SocketSink(spec)
+    raise ValueError(f'Unknown metrics sink {spec}')
+
+class Metrics:
+    """Ring buffer of scalar time series with bulk flushes to sinks
+
+    Parameters
+    ----------
+    columns : sequence of str
+        Names of the recorded scalars. The columns 't' and 'tstep' are added
+        in front
+    sinks : sequence, optional
+        Sinks, or specifications of sinks, see :func:`make_sink`
+    filename : str, optional
+        Filenames of sinks start with this name
+    capacity : int, optional
+        Number of records kept in memory
+    flushevery : int, optional
+        Flush to the sinks every flushevery records
+
+    Example
+    -------
+    >>> m = Metrics(['energy'], sinks=('csv',), filename='KMM')
+    >>> m.record(0.1, 1, energy=0.5)
+    >>> m.history('energy')
+    array([0.5])
+    >>> m.flush()
+    """
+    def __init__(self, columns, sinks=(), filename='', capacity=1000, flushevery=10):
+        self.columns = ['t', 'tstep']+list(columns)
+        self.index = {name: i for i, name in enumerate(self.columns)}
+        self.buffer = np.full((capacity, len(self.columns)), np.nan)
+        self.sinks = [make_sink(s, filename) for s in sinks]
+        self.flushevery = min(flushevery, capacity)
+        self.total = 0   # Number of records
+        self.flushed = 0 # Number of records flushed to sinks
+
+    def record(self, t, tstep, **values):
+        row = self.buffer[self.total % len(self.buffer)]
+        row[:] = np.nan
+        row[0] = t
+        row[1] = tstep
+        for name, val in values.items():
+            row[self.index[name]] = val
+        self.total += 1
+        if self.total-self.flushed >= self.flushevery:
+            self.flush()
+
+    def rows(self, start):
+        """Return records start, ..., self.total-1, which must still be in the buffer"""
+        C = len(self.buffer)
+        assert self.total-start <= C
+        i0, i1 = start % C, self.total % C
+        if self.total-start == 0:
+            return self.buffer[:0]
+        if i0 < i1:
+            return self.buffer[i0:i1]
+        return np.vstack((self.buffer[i0:], self.buffer[:i1]))
+
+    def history(self, name):
+        """Return the most recent values of column name, oldest first"""
+        return self.rows(max(0, self.total-len(self.buffer)))[:, self.index[name]].copy()
+
+    def flush(self):
+        rows = self.rows(self.flushed)
+        if len(rows) > 0:
+            for sink in self.sinks:
+                sink.write(self.columns, rows)
+        self.flushed = self.total
@@ -1,6 +1,8 @@
 from random import sample
+from time import time
 from shenfun import *
 from ChannelFlow import KMM
+from Transforms import StackedTransforms
 
 class MicroPolar(KMM):
     """Micropolar channel flow solver
@@ -19,9 +21,12 @@ class MicroPolar(KMM):
     NP : number
         model parameter
     dt : Timestep
-    conv : Choose velocity convection method
+    conv : Choose convection method
         - 0 - Standard convection
         - 1 - Vortex type
+        - 2 - Vortex type, with the angular velocity convection in
+              divergence form, all in one fused pass. See
+              :meth:`convection_fused`
     filename : str, optional
         Filenames are started with this name
     family : str, optional
@@ -43,7 +48,22 @@ class MicroPolar(KMM):
         Choose timestepper
         - 'IMEXRK222'
         - 'IMEXRK3'
+        - 'IMEXRK3LS' (IMEXRK3 with 2 instead of 6 registers per equation)
         - 'IMEXRK443'
+    comm : MPI communicator, optional
+        Communicator used by the solver. Defaults to all ranks.
+    cache : str, optional
+        Folder used to store FFTW wisdom between runs
+    pipeline : int, optional
+        Number of components in flight for pipelined transforms of the
+        nonlinear terms. 0 for regular, blocking transforms
+    threads : int, optional
+        Number of threads per rank
+    walltime : number or str, optional
+        Walltime of the job, in seconds or 'HH:MM:SS'. The solver stops
+        and checkpoints right before it
+    metrics : dict, optional
+        Options for the time series of diagnostics, see :mod:`Metrics`
 
     Note
     ----
@@ -52,6 +72,8 @@ class MicroPolar(KMM):
     the results by checkpointing, before exiting.
 
     """
+    conv_methods = (0, 1, 2)
+
     def __init__(self,
                  N=(32, 32, 32),
                  domain=((-1, 1), (0, 2*np.pi), (0, np.pi)),
@@ -69,45 +91,62 @@ class MicroPolar(KMM):
                  modsave=1e8,
                  moderror=100,
                  checkpoint=1000,
-                 timestepper='IMEXRK3'):
+                 timestepper='IMEXRK3',
+                 comm=comm,
+                 cache=None,
+                 pipeline=0,
+                 threads=1,
+                 walltime=None,
+                 metrics=None):
         KMM.__init__(self, N=N, domain=domain, nu=utau/Re, dt=dt, conv=conv,
                      filename=filename, family=family, padding_factor=padding_factor,
                      modplot=modplot, modsave=modsave, moderror=moderror, dpdy=-utau**2,
-                     checkpoint=checkpoint, timestepper=timestepper)
+                     checkpoint=checkpoint, timestepper=timestepper, comm=comm, cache=cache,
+                     pipeline=pipeline, threads=threads, walltime=walltime, metrics=metrics)
         self.Re = Re
         self.J = J
         self.m = m
         self.NP = NP
         self.utau = utau
 
+        t0 = time()
+
         # New spaces and Functions used by micropolar model
         self.WC = VectorSpace(self.TC)   # Curl curl vector space
         self.w_ = Function(self.CD)      # Angular velocity solution
         self.HW_ = Function(self.CD)     # convection angular velocity
+        self.cwx_ = Function(self.TD)    # x-component of curl of angular velocity
+        self.ccw_ = Function(self.TC)    # x-component of curl curl of angular velocity
         self.wz = Function(self.D00)
         self.wy = Function(self.D00)
-        self.ub = Array(self.BD)
-        self.wb = Array(self.CD)
-        self.cb = Array(self.BD)
-
-        # Classes for fast projections used by convection
-        self.dw0dx = Project(Dx(self.w_[0], 0, 1), self.TC)
-        self.dw0dy = Project(Dx(self.w_[0], 1, 1), self.TD)
-        self.dw0dz = Project(Dx(self.w_[0], 2, 1), self.TD)
-        self.dw1dx = Project(Dx(self.w_[1], 0, 1), self.TC)
-        self.dw1dy = Project(Dx(self.w_[1], 1, 1), self.TD)
-        self.dw1dz = Project(Dx(self.w_[1], 2, 1), self.TD)
-        self.dw2dx = Project(Dx(self.w_[2], 0, 1), self.TC)
-        self.dw2dy = Project(Dx(self.w_[2], 1, 1), self.TD)
-        self.dw2dz = Project(Dx(self.w_[2], 2, 1), self.TD)
-        self.curlwx = Project(curl(self.w_)[0], self.TD)
-        self.curlcurlwx = Project(curl(curl(self.w_))[0], self.TC)
+        self.lazy('wb', lambda: Array(self.CD))
+        self.gradwp = None # Padded gradients of w, kept by convection if self.keep_gradients
+        t0 = self.add_timing('functions', t0)
+
+        # Classes for fast projections used by convection, created on first use
+        for i in range(3):
+            for j, xj in enumerate('xyz'):
+                self.lazy(f'dw{i}d{xj}', lambda i=i, j=j: Project(Dx(self.w_[i], j, 1), self.TD if j > 0 else self.TC))
+        self.lazy('curlwx', lambda: Project(curl(self.w_)[0], self.TD, output_array=self.cwx_))
+        self.lazy('curlcurlwx', lambda: Project(curl(curl(self.w_))[0], self.TC, output_array=self.ccw_))
+        self.fields.register('w', lambda: self.w_.backward(self.wb))
+
+        # Stacked transforms of the fused convection, conv=2
+        if conv == 2:
+            self.stacked = StackedTransforms(padding_factor, comm=self.comm, threads=self.threads)
+            self.stacked.padded[id(self.TD)] = (self.TD, self.TDp) # Reuse padded space and its plans
+            self.nlh_ = Function(CompositeSpace([self.TD]*12)) # u x curl u and fluxes w_i u_j
+            self.lazy('nlp', lambda: np.zeros((12,)+Array(self.TDp).shape))
+            for i in range(3):
+                self.lazy(f'dF{i}dx', lambda i=i: Project(Dx(self.nlh_[3+3*i], 0, 1), self.TD, output_array=self.HW_[i]))
+        self.wp = None # Padded angular velocity, kept by the fused convection
 
         # File for storing the results
         self.file_w = ShenfunFile('_'.join((filename, 'W')), self.CD, backend='hdf5', mode='w', mesh='uniform')
 
-        # Create a checkpoint file used to restart simulations
-        self.checkpoint.data['0']['W'] = [self.w_]
+        # Store angular velocity in the checkpoint as well
+        self.checkpoint['W'] = self.w_
+        t0 = self.add_timing('files', t0)
 
         h = TestFunction(self.TD)
 
@@ -116,16 +155,16 @@ class MicroPolar(KMM):
 
         # Modify u equation
         nu = self.nu
-        cwx_ = self.curlwx.output_array
+        cwx_ = self.cwx_
         self.pdes['u'].N = [self.pdes['u'].N, m*nu*div(grad(cwx_))]
         self.pdes['u'].latex += r'+m \nu \nabla^2 (\nabla \times \vec{w})_x'
 
         # Modify g equation
-        ccw_ = self.curlcurlwx.output_array
+        ccw_ = self.ccw_
         self.pdes['g'].N = [self.pdes['g'].N, m*nu*Expr(ccw_)]
         self.pdes['g'].latex += r'+m \nu (\nabla \times \nabla \times \vec{w})_x'
 
-        if comm.Get_rank() == 0:
+        if self.comm.Get_rank() == 0:
             # Modify v0 and w0 equations
             self.pdes1d['v0'].N.append(-m*nu*Dx(self.wz, 0, 1))
             self.pdes1d['w0'].N = [self.pdes1d['w0'].N, m*nu*Dx(self.wy, 0, 1)]
@@ -157,23 +196,25 @@ class MicroPolar(KMM):
                                    dt=self.dt,
                                    solver=sol2,
                                    latex=r"\frac{\partial w_z}{\partial t} +\vec{u} \cdot \nabla w_z = \kappa \nabla^2 w_z + \kappa N (\nabla \times \vec{u})_z")
-
-    def init_from_checkpoint(self):
-        self.checkpoint.read(self.u_, 'U', step=0)
-        self.checkpoint.read(self.w_, 'W', step=0)
-        self.g_[:] = 1j*self.K[1]*self.u_[2] - 1j*self.K[2]*self.u_[1]
-        self.checkpoint.open()
-        tstep = self.checkpoint.f.attrs['tstep']
-        t = self.checkpoint.f.attrs['t']
-        self.checkpoint.close()
-        return t, tstep
+        self.add_timing('equations', t0)
 
     def convection(self):
         self.curlwx()
         self.curlcurlwx()
+        if self.conv == 2:
+            return self.convection_fused()
         KMM.convection(self)
         HW = self.HW_
         up = self.up
+        if self.pipeline is not None:
+            P = self.pipeline
+            dwp = P.backward([getattr(self, f'dw{i}d{xj}')() for i in range(3) for xj in 'xyz'], 'dw')
+            if self.keep_gradients:
+                self.gradwp = dwp
+            hp = self.work[(up[0], 0, False)]
+            P.forward(self.TDp, [lambda i=i: self.pool.dot(hp, up, dwp[3*i:3*i+3]) for i in range(3)], HW.v)
+            HW.mask_nyquist(self.mask)
+            return
         dw0dxp = self.dw0dx().backward(padding_factor=self.padding_factor)
         dw0dyp = self.dw0dy().backward(padding_factor=self.padding_factor)
         dw0dzp = self.dw0dz().backward(padding_factor=self.padding_factor)
@@ -183,17 +224,69 @@ class MicroPolar(KMM):
         dw2dxp = self.dw2dx().backward(padding_factor=self.padding_factor)
         dw2dyp = self.dw2dy().backward(padding_factor=self.padding_factor)
         dw2dzp = self.dw2dz().backward(padding_factor=self.padding_factor)
-        HW[0] = self.TDp.forward(up[0]*dw0dxp+up[1]*dw0dyp+up[2]*dw0dzp, HW[0])
-        HW[1] = self.TDp.forward(up[0]*dw1dxp+up[1]*dw1dyp+up[2]*dw1dzp, HW[1])
-        HW[2] = self.TDp.forward(up[0]*dw2dxp+up[1]*dw2dyp+up[2]*dw2dzp, HW[2])
+        if self.keep_gradients:
+            self.gradwp = (dw0dxp, dw0dyp, dw0dzp, dw1dxp, dw1dyp, dw1dzp, dw2dxp, dw2dyp, dw2dzp)
+        hp = self.work[(up[0], 0, False)]
+        HW[0] = self.TDp.forward(self.pool.dot(hp, up, (dw0dxp, dw0dyp, dw0dzp)), HW[0])
+        HW[1] = self.TDp.forward(self.pool.dot(hp, up, (dw1dxp, dw1dyp, dw1dzp)), HW[1])
+        HW[2] = self.TDp.forward(self.pool.dot(hp, up, (dw2dxp, dw2dyp, dw2dzp)), HW[2])
         HW.mask_nyquist(self.mask)
 
+    def convection_fused(self):
+        """Compute H_ and HW_ with one stacked backward and one stacked forward transform
+
+        u, curl(u) and w are transformed together, with one all-to-all
+        exchange for all nine components, see :class:`StackedTransforms`,
+        and the twelve products are transformed back with one exchange. With
+        pipeline > 0 the components are pipelined instead.
+
+        The velocity convection is computed in vortex form, curl(u) x u, and
+        the angular velocity convection in divergence form
+
+            u . grad(w_i) = d(u_x w_i)/dx + d(u_y w_i)/dy + d(u_z w_i)/dz
+
+        since div(u) = 0. Only u, curl(u) and w are needed in physical space,
+        instead of nine gradients of w. The nine fluxes w_i u_j are
+        differentiated in spectral space. The padded gradients are not
+        computed, so keep_gradients is ignored.
+        """
+        u, c, w = self.u_, self.fields['curl'], self.w_
+        if self.pipeline is not None:
+            P = self.pipeline
+            bp = P.backward([u[0], u[1], u[2], c[0], c[1], c[2], w[0], w[1], w[2]], 'convection')
+            up, cp, wp = bp[:3], bp[3:6], bp[6:]
+            P.forward(self.TDp, [lambda: cp[1]*up[2]-cp[2]*up[1],
+                                 lambda: cp[2]*up[0]-cp[0]*up[2],
+                                 lambda: cp[0]*up[1]-cp[1]*up[0]]+
+                                [lambda i=i, j=j: wp[i]*up[j] for i in range(3) for j in range(3)], self.nlh_.v)
+        else:
+            S = self.stacked
+            bp = S.backward([u[0], u[1], u[2], c[0], c[1], c[2], w[0], w[1], w[2]], 'convection')
+            up, cp, wp = bp[:3], bp[3:6], bp[6:]
+            nlp = self.nlp
+            self.pool.cross(nlp[:3], cp, up)
+            self.pool.outer(nlp[3:].reshape((3, 3)+up.shape[1:]), wp, up)
+            S.forward(self.TDp, nlp, self.nlh_.v)
+        self.up = up
+        self.wp = wp
+        F = self.nlh_.v
+        self.H_.v[:] = F[:3]
+        for i in range(3):
+            getattr(self, f'dF{i}dx')() # d(u_x w_i)/dx, stored in HW_[i]
+        K = self.K
+        HW = self.HW_.v
+        HW += 1j*(K[1]*F[4::3]+K[2]*F[5::3])
+        self.H_.mask_nyquist(self.mask)
+        self.HW_.mask_nyquist(self.mask)
+
     def tofile(self, tstep):
-        self.file_u.write(tstep, {'u': [self.u_.backward(mesh='uniform')]}, as_scalar=True)
-        self.file_w.write(tstep, {'w': [self.w_.backward(mesh='uniform')]}, as_scalar=True)
+        KMM.tofile(self, tstep)
+        wb = self.w_.backward(mesh='uniform')
+        self.file_w.write(tstep, {'w': [wb]}, as_scalar=True)
+        self.io_bytes += wb.nbytes
 
     def compute_vw(self, rk):
-        if comm.Get_rank() == 0:
+        if self.comm.Get_rank() == 0:
             self.wy[:] = self.w_[1, :, 0, 0].real
             self.wz[:] = self.w_[2, :, 0, 0].real
         KMM.compute_vw(self, rk)
@@ -0,0 +1,240 @@
+"""Streaming proper orthogonal decomposition with an incremental SVD
+
+Snapshots of the spectral velocity and angular velocity are added one at a
+time to a truncated singular value decomposition (Brand's update). Only the
+r leading modes and singular values are kept, so memory is bounded by r
+times the size of a snapshot, regardless of the number of snapshots.
+
+The snapshots are evaluated at the wall-normal quadrature points, with the
+Fourier coefficients kept in y and z, and weighted such that the Euclidean
+inner product of two snapshots is the energy inner product over the channel.
+The modes are written without the weights.
+
+Two decompositions are supported
+
+    - global: one decomposition of the full, distributed snapshots. Inner
+      products are reduced over all ranks
+    - per wavenumber pair: since the flow is homogeneous in y and z, each
+      Fourier wavenumber pair has its own decomposition of the wall-normal
+      profiles. These are independent, local to the ranks, and updated in
+      one batch.
+
+The mean flow is contained in the wavenumber pair (0, 0). With subtract_mean
+this pair is set to zero, such that the modes describe fluctuations about
+the plane averages.
+"""
+import numpy as np
+from numpy.polynomial import legendre
+import h5py
+from mpi4py import MPI
+
+__all__ = ['StreamingPOD', 'integration_weights', 'incremental_svd']
+
+def integration_weights(x):
+    """Return weights w such that sum(w*f(x)) is the integral of f over (-1, 1)
+
+    The weights are exact for polynomials of degree len(x)-1, for any
+    distinct points x.
+    """
+    V = legendre.legvander(x, len(x)-1).T
+    b = np.zeros(len(x))
+    b[0] = 2
+    return np.linalg.solve(V, b)
+
+def incremental_svd(U, S, X, rank, reduce=None):
+    """Return truncated SVD (U, S) of [U*S, X], for stacks of matrices
+
+    Parameters
+    ----------
+    U : array of shape (nb, n, k)
+        Orthonormal left singular vectors. k may be 0
+    S : array of shape (nb, k)
+        Singular values
+    X : array of shape (nb, n, b)
+        New columns
+    rank : int
+        Maximum number of singular values kept
+    reduce : callable, optional
+        Sums an array over all ranks, if the rows of U and X are distributed
+    """
+    reduce = reduce or (lambda a: a)
+    UH = U.conj().transpose(0, 2, 1)
+    # Project twice for orthogonality to U
+    C = reduce(UH @ X)
+    R = X - U @ C
+    C2 = reduce(UH @ R)
+    R -= U @ C2
+    C += C2
+    # Orthonormal basis Q of the residual through the eigenvalues of its Gram matrix
+    lam, V = np.linalg.eigh(reduce(R.conj().transpose(0, 2, 1) @ R))
+    lam = np.maximum(lam, 0)
+    tol = 1e-14*np.maximum(lam.max(axis=-1, keepdims=True), np.finfo(float).tiny)
+    Q = (R @ V)/np.sqrt(np.maximum(lam, tol))[:, None, :]
+    k, b = S.shape[-1], X.shape[-1]
+    K = np.zeros((X.shape[0], k+b, k+b), dtype=np.result_type(X, U))
+    K[:, np.arange(k), np.arange(k)] = S
+    K[:, :k, k:] = C
+    K[:, k:, k:] = np.sqrt(lam)[:, :, None]*V.conj().transpose(0, 2, 1)
+    Uk, Sk, _ = np.linalg.svd(K)
+    r = min(rank, k+b)
+    return np.concatenate((U, Q), axis=2) @ Uk[:, :, :r], Sk[:, :r]
+
+class StreamingPOD:
+    """POD of spectral vector Functions, updated in situ
+
+    Parameters
+    ----------
+    u : dict
+        Name: spectral vector Function, like {'U': u_, 'W': w_}. All must
+        have the same distribution
+    filename : str, optional
+        Modes and singular values are stored in f'{filename}.h5'
+    rank : int, optional
+        Number of modes kept
+    every : int, optional
+        Sample every this many time steps
+    wavenumbers : None, 'all' or sequence of 2-tuples, optional
+        None for a global decomposition, 'all' for a decomposition for each
+        wavenumber pair, or a sequence of global indices (iy, iz) of the
+        wavenumber pairs to decompose
+    subtract_mean : bool, optional
+        Leave out the wavenumber pair (0, 0)
+    comm : MPI communicator, optional
+
+    Example
+    -------
+    >>> pod = StreamingPOD({'U': u_, 'W': w_}, 'MKM_pod', rank=20, wavenumbers=[(1, 2), (0, 4)])
+    >>> pod() # Add a snapshot
+    >>> pod.tofile()
+    """
+    def __init__(self, u, filename='', rank=10, every=100, wavenumbers=None, subtract_mean=True, comm=MPI.COMM_WORLD):
+        self.u = u
+        self.fname = filename
+        self.rank = rank
+        self.every = every
+        self.wavenumbers = wavenumbers
+        self.subtract_mean = subtract_mean
+        self.comm = comm
+        self.num_samples = 0
+        T = list(u.values())[0].function_space().flatten()[0]
+        self.N = T.shape(True)
+        self.s = s = T.local_slice(True)
+        self.V = []
+        for ui in u.values():
+            for Ti in ui.function_space().flatten():
+                B = Ti.bases[0]
+                x = B.points_and_weights()[0]
+                self.V.append(np.array([B.evaluate_basis(x, i=j) for j in range(B.dim())]).T)
+        # Energy weights. Real transform in z: all modes except kz=0 and Nyquist represent two modes
+        wz = np.full(self.N[2], 2.)
+        wz[0] = 1
+        if T.bases[2].N % 2 == 0:
+            wz[-1] = 0
+        self.weight = np.sqrt(integration_weights(x)[:, None, None]*wz[None, None, s[2]])
+        self.nc = len(self.V)
+        ny = s[1].stop-s[1].start
+        if wavenumbers is None:
+            self.rows = None
+            nb, n = 1, self.nc*self.N[0]*ny*self.N[2]
+        elif isinstance(wavenumbers, str) and wavenumbers == 'all':
+            self.rows = slice(None)
+            nb, n = ny*self.N[2], self.nc*self.N[0]
+        else:
+            # Local (flattened) and global positions of the selected wavenumber pairs on this rank
+            self.selected = [(m, iy, iz) for m, (iy, iz) in enumerate(wavenumbers) if s[1].start <= iy < s[1].stop]
+            self.rows = np.array([(iy-s[1].start)*self.N[2]+iz for m, iy, iz in self.selected], dtype=int)
+            nb, n = len(self.rows), self.nc*self.N[0]
+        self.U = np.zeros((nb, n, 0), dtype=complex)
+        self.S = np.zeros((nb, 0))
+
+    def reduce(self, a):
+        return self.comm.allreduce(a)
+
+    def snapshot(self):
+        """Return weighted snapshot of shape (nc, N[0], local ny, nz)"""
+        a = np.empty((self.nc, self.N[0], self.s[1].stop-self.s[1].start, self.N[2]), dtype=complex)
+        k = 0
+        for ui in self.u.values():
+            for i in range(3):
+                V = self.V[k]
+                a[k] = np.tensordot(V, ui[i, :V.shape[1]], axes=(1, 0))
+                k += 1
+        a *= self.weight
+        if self.subtract_mean and self.s[1].start == 0:
+            a[:, :, 0, 0] = 0
+        return a
+
+    def __call__(self):
+        """Add a snapshot of the current solution"""
+        self.num_samples += 1
+        a = self.snapshot()
+        if self.rows is None:
+            X = a.reshape(1, -1, 1)
+            self.U, self.S = incremental_svd(self.U, self.S, X, self.rank, self.reduce)
+        else:
+            X = a.reshape(self.nc*self.N[0], -1).T[self.rows, :, None]
+            self.U, self.S = incremental_svd(self.U, self.S, X, self.rank)
+
+    def modes(self):
+        """Return local modes without weights
+
+        Of shape (nc, N[0], local ny, nz, r) for the global decomposition,
+        and (number of local wavenumber pairs, nc, N[0], r) otherwise.
+        """
+        r = self.S.shape[-1]
+        w = self.weight.copy()
+        w[w == 0] = 1
+        ny = self.s[1].stop-self.s[1].start
+        if self.rows is None:
+            return self.U.reshape((self.nc, self.N[0], ny, self.N[2], r))/w[..., None]
+        wr = np.broadcast_to(w, (1, self.N[0], ny, self.N[2])).reshape(self.N[0], -1).T[self.rows]
+        return self.U.reshape(-1, self.nc, self.N[0], r)/wr[:, None, :, None]
+
+    def get_state(self):
+        return {'num_samples': self.num_samples, 'U': self.U, 'S': self.S}
+
+    def set_state(self, state):
+        self.num_samples = int(state['num_samples'])
+        self.U = np.array(state['U'], dtype=complex)
+        self.S = np.array(state['S'])
+
+    def tofile(self):
+        """Store modes and singular values in f'{filename}.h5'
+
+        The modes are stored as 'modes' with shape
+
+            - (r, nc, N[0], N[1], N[2]//2+1) for the global decomposition
+            - (N[1], N[2]//2+1, r, nc, N[0]) for all wavenumber pairs
+            - (len(wavenumbers), r, nc, N[0]) for selected wavenumber pairs
+
+        where nc is the number of components, and the singular values as 'S'
+        with the leading shape of the modes.
+        """
+        r = self.rank
+        nc, N = self.nc, self.N
+        f = h5py.File(self.fname+'.h5', 'w', driver='mpio', comm=self.comm)
+        f.attrs.create('num_samples', self.num_samples)
+        f.attrs.create('components', [f'{name}{i}' for name in self.u for i in range(3)])
+        k = self.S.shape[-1] # Less than rank for fewer samples
+        modes = self.modes()
+        if self.rows is None:
+            f.create_dataset('S', shape=(r,), dtype=float)
+            d = f.create_dataset('modes', shape=(r, nc, N[0], N[1], N[2]), dtype=complex)
+            d[:k, :, :, self.s[1]] = np.moveaxis(modes, -1, 0)
+            if self.comm.Get_rank() == 0:
+                f['S'][:k] = self.S[0]
+        elif isinstance(self.rows, slice):
+            ny = self.s[1].stop-self.s[1].start
+            f.create_dataset('S', shape=(N[1], N[2], r), dtype=float)
+            d = f.create_dataset('modes', shape=(N[1], N[2], r, nc, N[0]), dtype=complex)
+            d[self.s[1], :, :k] = np.moveaxis(modes, -1, 1).reshape(ny, N[2], k, nc, N[0])
+            f['S'][self.s[1], :, :k] = self.S.reshape(ny, N[2], k)
+        else:
+            M = len(self.wavenumbers)
+            f.create_dataset('wavenumbers', data=np.array(self.wavenumbers))
+            f.create_dataset('S', shape=(M, r), dtype=float)
+            d = f.create_dataset('modes', shape=(M, r, nc, N[0]), dtype=complex)
+            for j, (m, iy, iz) in enumerate(self.selected):
+                d[m, :k] = np.moveaxis(modes[j], -1, 0)
+                f['S'][m, :k] = self.S[j]
+        f.close()
@@ -0,0 +1,82 @@
+"""Thread parallel kernels for hybrid MPI + threads runs
+
+With fewer ranks than cores per node, for example when the padded work arrays
+of one rank per core do not fit in memory, each rank may use several threads.
+NumPy releases the GIL in its ufuncs, so pointwise kernels and reductions run
+in parallel when they are split into independent blocks. Each block writes to
+its own part of the output, so no locking is required.
+
+With one thread everything runs directly in the calling thread.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+__all__ = ['ThreadPool']
+
+class ThreadPool:
+    """Pool of threads for blocked kernels
+
+    Parameters
+    ----------
+    threads : int, optional
+        Number of threads
+    """
+    def __init__(self, threads=1):
+        assert threads >= 1
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(threads) if threads > 1 else None
+
+    def map(self, func, items):
+        """Return [func(item) for item in items], computed by the threads"""
+        if self.executor is None:
+            return [func(item) for item in items]
+        return list(self.executor.map(func, items))
+
+    def blocks(self, n):
+        """Return contiguous slices, one per thread, covering range(n)"""
+        edges = np.linspace(0, n, min(self.threads, n)+1).astype(int)
+        return [slice(edges[i], edges[i+1]) for i in range(len(edges)-1)]
+
+    def map_blocks(self, func, n):
+        """Call func(s) for each slice s of :meth:`blocks`"""
+        return self.map(func, self.blocks(n))
+
+    def _split(self, shape):
+        # Split along the longest axis, which is never short for slab decompositions
+        axis = int(np.argmax(shape))
+        return [(slice(None),)*axis+(s,) for s in self.blocks(shape[axis])]
+
+    def dot(self, out, a, b):
+        """Pointwise out = a[0]*b[0] + a[1]*b[1] + ...
+
+        Parameters
+        ----------
+        out : array
+        a, b : sequences of arrays of the same shape as out
+        """
+        def kernel(s):
+            o = out[s]
+            np.multiply(a[0][s], b[0][s], out=o)
+            for ai, bi in zip(a[1:], b[1:]):
+                o += ai[s]*bi[s]
+        self.map(kernel, self._split(out.shape))
+        return out
+
+    def cross(self, out, a, b):
+        """Pointwise out = a x b, where all arrays have shape (3, ...)"""
+        def kernel(s):
+            for i in range(3):
+                j, k = (i+1) % 3, (i+2) % 3
+                np.multiply(a[j][s], b[k][s], out=out[i][s])
+                out[i][s] -= a[k][s]*b[j][s]
+        self.map(kernel, self._split(out.shape[1:]))
+        return out
+
+    def outer(self, out, a, b):
+        """Pointwise out[i, j] = a[i]*b[j], where out has shape (len(a), len(b), ...)"""
+        def kernel(s):
+            for i in range(len(a)):
+                for j in range(len(b)):
+                    np.multiply(a[i][s], b[j][s], out=out[i, j][s])
+        self.map(kernel, self._split(out.shape[2:]))
+        return out
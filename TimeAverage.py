@@ -0,0 +1,137 @@
+"""Time averaged three-dimensional mean and rms fields
+
+The statistics of :class:`MKM_MicroPolar.Stats` are averaged over the
+homogeneous planes as well, which hides inhomogeneities and secondary
+structures, for example in channels with non-standard domain sizes. Here the
+full three-dimensional fields are averaged in time only.
+
+The mean is accumulated as a running sum of the spectral coefficients. Since
+the transforms are linear, the mean in physical space is the backward
+transform of the mean coefficients, so sampling the mean costs no
+transforms at all. The second moments are accumulated from the physical
+arrays the solver has already computed on the sampling steps, like those of
+the statistics, and combined with the mean to rms values when stored.
+
+Memory is one spectral and, with second moments, one physical array of
+each field. The mean and rms fields are written in chunked, compressed form,
+one chunk for each wall-normal plane. Parallel compression requires HDF5
+1.10.2 or newer, and may be turned off with compression=None.
+"""
+import numpy as np
+import h5py
+from mpi4py import MPI
+from shenfun import Function
+
+__all__ = ['TimeAverage']
+
+class TimeAverage:
+    """Running time averages of spectral vector Functions
+
+    Parameters
+    ----------
+    u : dict
+        Name: spectral vector Function, like {'U': u_, 'W': w_, 'curl': curl}
+    filename : str, optional
+        Averages are stored in f'{filename}.h5'
+    every : int, optional
+        Sample every this many time steps
+    second_moments : bool, optional
+        Accumulate squares of the physical arrays, for rms fields
+    compression : str or None, optional
+        Compression filter of the stored fields
+    comm : MPI communicator, optional
+
+    Example
+    -------
+    >>> avg = TimeAverage({'U': u_, 'W': w_}, 'MKM_average', every=10)
+    >>> avg(t, {'U': u_.backward(), 'W': w_.backward()}) # Add a sample
+    >>> avg.tofile()
+    """
+    def __init__(self, u, filename='', every=10, second_moments=True, compression='gzip', comm=MPI.COMM_WORLD):
+        self.u = u
+        self.fname = filename
+        self.every = every
+        self.second_moments = second_moments
+        self.compression = compression
+        self.comm = comm
+        self.num_samples = 0
+        self.t = np.array([np.nan, np.nan]) # First and last sample
+        self.sums = {name: np.zeros_like(f.v) for name, f in u.items()}
+        self.squares = dict.fromkeys(u) if second_moments else {} # Allocated at the first sample
+
+    def __call__(self, t, physical=None):
+        """Add a sample of the current solution at time t
+
+        Parameters
+        ----------
+        t : number
+            Time
+        physical : dict, optional
+            Name: physical array of the current solution on the regular
+            grid, for the second moments
+        """
+        self.num_samples += 1
+        if self.num_samples == 1:
+            self.t[0] = t
+        self.t[1] = t
+        for name, f in self.u.items():
+            self.sums[name] += f.v
+        if self.second_moments:
+            for name, a in physical.items():
+                a = np.asarray(a)
+                if self.squares[name] is None:
+                    self.squares[name] = np.zeros_like(a)
+                self.squares[name] += a*a
+
+    def mean(self, name):
+        """Return local physical mean of field name"""
+        f = self.u[name]
+        return Function(f.function_space(), buffer=self.sums[name]/max(self.num_samples, 1)).backward()
+
+    def rms(self, name, mean=None):
+        """Return local physical rms of the fluctuations of field name"""
+        mean = self.mean(name) if mean is None else mean
+        return np.sqrt(np.maximum(self.squares[name]/max(self.num_samples, 1)-mean**2, 0))
+
+    def get_state(self):
+        state = {'num_samples': self.num_samples, 't': self.t}
+        state.update({f'sum/{name}': val for name, val in self.sums.items()})
+        state.update({f'square/{name}': val for name, val in self.squares.items() if val is not None})
+        return state
+
+    def set_state(self, state):
+        self.num_samples = int(state['num_samples'])
+        self.t = np.array(state['t'])
+        for name in self.sums:
+            self.sums[name][:] = state[f'sum/{name}']
+            if f'square/{name}' in state and self.second_moments:
+                self.squares[name] = np.array(state[f'square/{name}'])
+
+    def tofile(self):
+        """Store mean and rms fields in f'{filename}.h5'
+
+        Each field is stored as 'name/mean' and 'name/rms', of global shape
+        (3, N[0], N[1], N[2]), with the mesh as 'x', 'y' and 'z'. The number
+        of samples and the first and last sample times are attributes.
+        """
+        if self.num_samples == 0:
+            return
+        f = h5py.File(self.fname+'.h5', 'w', driver='mpio', comm=self.comm)
+        f.attrs.create('num_samples', self.num_samples)
+        f.attrs.create('time', self.t)
+        T = list(self.u.values())[0].function_space().flatten()[0]
+        for xj, B in zip('xyz', T.bases):
+            f.create_dataset(xj, data=np.asarray(B.mesh()).ravel())
+        shape = tuple(T.shape(False))
+        s = T.local_slice(False)
+        for name in self.u:
+            mean = self.mean(name)
+            fields = {'mean': mean}
+            if self.squares.get(name) is not None:
+                fields['rms'] = self.rms(name, mean)
+            for key, val in fields.items():
+                d = f.create_dataset(f'{name}/{key}', shape=(len(val),)+shape, dtype=float,
+                                     chunks=(1, 1)+shape[1:], compression=self.compression)
+                with d.collective: # Required for parallel compression
+                    d[(slice(None),)+tuple(s)] = val
+        f.close()
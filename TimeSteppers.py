@@ -0,0 +1,92 @@
+"""Verify order and storage of the IMEX Runge-Kutta timesteppers
+
+Each timestepper integrates the manufactured problem
+
+    du/dt = nu d^2u/dx^2 + lam u,  u(-1) = u(1) = 0,  u(x, 0) = cos(pi x/2)
+
+with the diffusion implicit and lam u explicit, exactly like the viscous
+and nonlinear terms of the channel solvers. The exact solution is
+
+    u(x, t) = exp((lam - nu pi^2/4) t) cos(pi x/2)
+
+The spatial error is at machine precision, so the error at end_time
+measures the temporal error only. Halving dt gives the observed order.
+
+The registers of an equation are the arrays of the size of the solution
+that the timestepper owns for the stages, see also KMM.storage_report.
+The orders and registers are checked by tests/test_timesteppers.py. Print
+them with
+
+    python TimeSteppers.py
+
+"""
+from shenfun import *
+import ChannelFlow
+from ChannelFlow import TIMESTEPPERS, find_arrays, count_registers
+
+# Expected order for the combined IMEX scheme
+ORDER = {'IMEXRK3': 2, 'IMEXRK3LS': 2, 'IMEXRK222': 2, 'IMEXRK443': 3}
+
+# Expected registers per equation
+REGISTERS = {'IMEXRK3': 6, 'IMEXRK3LS': 2, 'IMEXRK222': 7, 'IMEXRK443': 11}
+
+def manufactured(timestepper, dt, N=24, nu=1, lam=1, end_time=1, family='C'):
+    """Return max error at end_time and number of registers
+
+    Parameters
+    ----------
+    timestepper : str
+        Name of the timestepper, like 'IMEXRK3'
+    dt : number
+        Timestep
+    N : int, optional
+        Number of quadrature points
+    nu, lam : numbers, optional
+        Coefficients of the implicit and the explicit term
+    end_time : number, optional
+        Integrate to this time
+    family : str, optional
+        Chebyshev or Legendre
+    """
+    PDE = getattr(ChannelFlow, timestepper)
+    D = FunctionSpace(N, family, bc=(0, 0))
+    x = D.mesh()
+    u = Function(D)
+    ua = Array(D)
+    ua[:] = np.cos(np.pi*x/2)
+    u = ua.forward(u)
+    sol = chebyshev.la.Helmholtz if D.family() == 'chebyshev' else la.Solver
+    pde = PDE(TestFunction(D),
+              u,
+              lambda f: nu*div(grad(f)),
+              lam*Expr(u),
+              dt=dt,
+              solver=sol)
+    pde.assemble()
+    for tstep in range(int(round(end_time/dt))):
+        for rk in range(PDE.steps()):
+            pde.compute_rhs(rk)
+            pde.solve_step(rk)
+    ue = np.exp((lam-nu*np.pi**2/4)*end_time)*np.cos(np.pi*x/2)
+    error = np.max(abs(u.backward()-ue))
+    shared = find_arrays({'u': u, 'D': D, 'x': x}) # Not owned by the timestepper
+    own = {key: val for key, val in find_arrays(pde, timestepper).items() if key not in shared}
+    registers = count_registers(own, u.nbytes)
+    return error, registers
+
+def convergence(timestepper, dts=(0.1, 0.05, 0.025, 0.0125), **kw):
+    """Return errors, observed orders and registers for a sequence of timesteps"""
+    errors = []
+    for dt in dts:
+        error, registers = manufactured(timestepper, dt, **kw)
+        errors.append(error)
+    errors = np.array(errors)
+    orders = np.log(errors[:-1]/errors[1:])/np.log(np.array(dts[:-1])/np.array(dts[1:]))
+    return errors, orders, registers
+
+if __name__ == '__main__':
+    dts = (0.1, 0.05, 0.025, 0.0125)
+    print(f"{'timestepper':<12}{'registers':>10}{'expected':>10}" + ''.join(f"{f'dt={dt}':>12}" for dt in dts) + f"{'order':>8}")
+    for name, description in TIMESTEPPERS.items():
+        errors, orders, registers = convergence(name, dts)
+        print(f"{name:<12}{registers:>10d}{ORDER[name]:>10d}" + ''.join(f"{e:12.4e}" for e in errors) + f"{orders[-1]:8.2f}")
@@ -0,0 +1,273 @@
+"""Lagrangian tracers and inertial particles
+
+Particles are distributed to ranks by the wall-normal slab that owns them in
+physical space, and migrated to a new owner when they cross a slab
+boundary. Each rank owns the interval from its first wall-normal plane to
+the first plane of the next rank, so interpolation only needs one halo
+plane from that rank. The walls, with zero velocity, close the intervals of
+the first and the last rank.
+
+The velocity, and optionally the angular velocity, is interpolated from the
+padded physical arrays of the nonlinear terms, linearly in all directions
+and vectorized over all particles of a rank. The cost per step is
+proportional to the number of particles per rank. With method='spectral'
+the fields are instead evaluated exactly from their spectral coefficients,
+which costs the number of particles times the number of coefficients, and
+is meant for verification and small numbers of particles.
+
+Tracers are advanced with the second order Adams-Bashforth method. Inertial
+particles with Stokes time tau follow dv/dt = (u-v)/tau, integrated
+exactly for constant u over a step. Particles are reflected at the walls.
+
+The particle state is kept in a single array with one row per particle,
+which is what is migrated and stored in the checkpoints.
+"""
+import numpy as np
+import h5py
+from mpi4py import MPI
+
+__all__ = ['Tracers']
+
+class Tracers:
+    """Particles advected by the flow
+
+    Parameters
+    ----------
+    T : TensorProductSpace
+        The padded space of the interpolated physical arrays
+    domain : 3-tuple of 2-tuples
+        The computational domain
+    number : int, optional
+        Number of particles, seeded uniformly in the channel, unless
+        positions are given
+    positions : array of shape (number, 3), optional
+        Global initial positions, the same on all ranks
+    tau : number, optional
+        Stokes time of inertial particles. None for tracers
+    micro : bool, optional
+        Interpolate the angular velocity to the particles as well
+    method : str, optional
+        'linear' or 'spectral' interpolation
+    near_wall : number, optional
+        Residence times are accumulated within this distance from the walls
+    every : int, optional
+        Store particles every this many time steps
+    filename : str, optional
+        Particles are stored in f'{filename}.h5'
+    comm : MPI communicator, optional
+    seed : int, optional
+        Seed for the random initial positions
+    """
+    # Initial position x0, velocity of the flow u, particle velocity v, angular velocity of the flow a
+    columns = ('id', 'x', 'y', 'z', 'x0', 'y0', 'z0', 'ux', 'uy', 'uz', 'vx', 'vy', 'vz', 'ax', 'ay', 'az', 'residence')
+
+    def __init__(self, T, domain, number=1000, positions=None, tau=None, micro=False, method='linear',
+                 near_wall=0.1, every=100, filename='', comm=MPI.COMM_WORLD, seed=1):
+        assert method in ('linear', 'spectral')
+        self.comm = comm
+        self.tau = tau
+        self.micro = micro
+        self.method = method
+        self.near_wall = near_wall
+        self.every = every
+        self.fname = filename
+        self.col = {name: i for i, name in enumerate(self.columns)}
+        self.steps = 0
+
+        # Grid of the padded physical arrays
+        s = T.local_slice(False)
+        x = np.asarray(T.bases[0].mesh()).ravel()
+        self.shape = T.shape(False)
+        self.L = np.array([d[1]-d[0] for d in domain])
+        self.origin = np.array([d[0] for d in domain])
+        self.reverse = x[0] > x[-1]
+        xa = x[s[0]][::-1] if self.reverse else x[s[0]] # Ascending
+        lows = np.array(comm.allgather(xa[0]))
+        order = np.argsort(lows)
+        pos = int(np.where(order == comm.Get_rank())[0][0])
+        self.lower = int(order[pos-1]) if pos > 0 else MPI.PROC_NULL
+        self.upper = int(order[pos+1]) if pos < len(order)-1 else MPI.PROC_NULL
+        self.first = pos == 0
+        # Extended ascending grid: wall or local planes, then halo plane or wall
+        upper = lows[order[pos+1]] if pos < len(order)-1 else 1.0
+        self.xe = np.concatenate((([-1.0],) if self.first else ())+(xa, [upper]))
+        self.bounds = np.concatenate(([-1.0], lows[order][1:], [1.0]))
+        self.order = order
+
+        # Initial particles
+        if positions is None:
+            rng = np.random.default_rng(seed+comm.Get_rank())
+            lo, hi = self.xe[0], self.xe[-1]
+            n = int(round(number*(hi-lo)/2))
+            positions = np.column_stack((rng.uniform(lo, hi, n),
+                                         self.origin[1]+self.L[1]*rng.random(n),
+                                         self.origin[2]+self.L[2]*rng.random(n)))
+        else:
+            positions = np.asarray(positions, dtype=float)
+            positions = positions[self.owner(positions[:, 0]) == comm.Get_rank()]
+        n = len(positions)
+        start = comm.exscan(n) or 0
+        self.p = np.zeros((n, len(self.columns)))
+        self.p[:, 0] = start+np.arange(n)
+        self.p[:, 1:4] = positions
+        self.p[:, 4:7] = positions
+
+    @property
+    def number(self):
+        return len(self.p)
+
+    def owner(self, x):
+        """Return rank owning wall-normal positions x"""
+        i = np.clip(np.searchsorted(self.bounds, x, side='right')-1, 0, len(self.order)-1)
+        return self.order[i]
+
+    def halo(self, f):
+        """Return the first (ascending) plane of the upper neighbour, zero at the wall"""
+        send = np.ascontiguousarray(f[:, -1] if self.reverse else f[:, 0])
+        recv = np.zeros_like(send)
+        self.comm.Sendrecv(send, dest=self.lower, recvbuf=recv, source=self.upper)
+        return recv
+
+    def interpolate(self, f, X):
+        """Return f of shape (c, M, Ny, Nz) linearly interpolated to positions X, shape (c, n)"""
+        h = self.halo(f)
+        if self.reverse:
+            f = f[:, ::-1]
+        M = f.shape[1]
+        xe = self.xe
+        e = np.clip(np.searchsorted(xe, X[:, 0], side='right')-1, 0, len(xe)-2)
+        tx = np.clip((X[:, 0]-xe[e])/(xe[e+1]-xe[e]), 0, 1)
+        off = 1 if self.first else 0 # Extended index of first local plane
+        idx = []
+        for d, n in ((1, f.shape[2]), (2, f.shape[3])):
+            y = (X[:, d]-self.origin[d])/self.L[d]*n
+            j = np.floor(y)
+            idx.append((j.astype(int) % n, (j.astype(int)+1) % n, y-j))
+        (j0, j1, ty), (k0, k1, tz) = idx
+        out = np.zeros((f.shape[0], len(X)))
+        for de, wx in ((0, 1-tx), (1, tx)):
+            i = e+de-off
+            for j, wy in ((j0, 1-ty), (j1, ty)):
+                for k, wz in ((k0, 1-tz), (k1, tz)):
+                    v = f[:, np.clip(i, 0, M-1), j, k]
+                    above = i >= M
+                    v[:, above] = h[:, j[above], k[above]]
+                    v[:, i < 0] = 0 # Wall
+                    out += v*(wx*wy*wz)
+        return out
+
+    def evaluate(self, u, X):
+        """Return spectral Function u evaluated at positions X, shape (c, n). Collective"""
+        counts = self.comm.allgather(len(X))
+        allX = np.concatenate(self.comm.allgather(X)) if sum(counts) > 0 else np.zeros((0, 3))
+        values = u.eval(np.ascontiguousarray(allX.T))
+        start = sum(counts[:self.comm.Get_rank()])
+        return values.reshape(-1, sum(counts))[:, start:start+len(X)]
+
+    def __call__(self, dt, up=None, wp=None, u_=None, w_=None):
+        """Advance particles one time step with the velocity at the start of the step
+
+        Parameters
+        ----------
+        dt : number
+            Timestep
+        up, wp : arrays, optional
+            Padded physical velocity and angular velocity, for linear
+            interpolation
+        u_, w_ : Functions, optional
+            Spectral velocity and angular velocity, for spectral evaluation
+        """
+        p = self.p
+        c = self.col
+        X = p[:, 1:4]
+        if self.method == 'linear':
+            U = self.interpolate(up, X).T
+            if self.micro:
+                p[:, c['ax']:c['ax']+3] = self.interpolate(wp, X).T
+        else:
+            U = self.evaluate(u_, X).T
+            if self.micro:
+                p[:, c['ax']:c['ax']+3] = self.evaluate(w_, X).T
+        Uprev = p[:, c['ux']:c['ux']+3]
+        if self.tau is None:
+            V = U if self.steps == 0 else 1.5*U-0.5*Uprev
+            X += dt*V
+        else:
+            v = p[:, c['vx']:c['vx']+3]
+            if self.steps == 0:
+                v[:] = U
+            vnew = U+(v-U)*np.exp(-dt/self.tau)
+            X += 0.5*dt*(v+vnew)
+            v[:] = vnew
+        Uprev[:] = U
+        # Reflect at the walls
+        for wall in (-1, 1):
+            hit = (X[:, 0]-wall)*wall > 0
+            X[hit, 0] = 2*wall-X[hit, 0]
+            p[hit, c['vx']] *= -1
+        p[1-np.abs(X[:, 0]) < self.near_wall, c['residence']] += dt
+        self.steps += 1
+        self.migrate()
+
+    def migrate(self):
+        """Send particles to the ranks that own them"""
+        P = self.comm.Get_size()
+        if P == 1:
+            return
+        dest = self.owner(self.p[:, 1])
+        order = np.argsort(dest, kind='stable')
+        send = np.ascontiguousarray(self.p[order])
+        sendcounts = np.bincount(dest, minlength=P)
+        recvcounts = np.zeros(P, dtype=sendcounts.dtype)
+        self.comm.Alltoall(sendcounts, recvcounts)
+        m = self.p.shape[1]
+        recv = np.empty((recvcounts.sum(), m))
+        sdispl = np.concatenate(([0], np.cumsum(sendcounts)[:-1]))
+        rdispl = np.concatenate(([0], np.cumsum(recvcounts)[:-1]))
+        self.comm.Alltoallv([send, sendcounts*m, sdispl*m, MPI.DOUBLE],
+                            [recv, recvcounts*m, rdispl*m, MPI.DOUBLE])
+        self.p = recv
+
+    def statistics(self):
+        """Return global dispersion and residence statistics. Collective
+
+        Returns
+        -------
+        Dict with number of particles, mean squared displacement in each
+        direction, and mean residence time near the walls
+        """
+        c = self.col
+        d = self.p[:, 1:4]-self.p[:, 4:7]
+        local = np.concatenate(([len(self.p)], np.sum(d*d, axis=0), [np.sum(self.p[:, c['residence']])]))
+        total = self.comm.allreduce(local)
+        n = max(total[0], 1)
+        return {'number': int(total[0]), 'msd': total[1:4]/n, 'residence': total[4]/n}
+
+    def get_state(self):
+        return {'p': self.p, 'steps': self.steps}
+
+    def set_state(self, state):
+        self.p = np.array(state['p']).reshape(-1, len(self.columns))
+        self.steps = int(state['steps'])
+
+    def tofile(self, tstep):
+        """Append all particles of time step tstep to f'{filename}.h5', sorted by rank
+
+        Particles stored for tstep before, by a run restarted from an earlier
+        checkpoint, are replaced.
+        """
+        n = len(self.p)
+        start = self.comm.exscan(n) or 0
+        total = self.comm.allreduce(n)
+        f = h5py.File(self.fname+'.h5', 'a', driver='mpio', comm=self.comm)
+        if 'columns' not in f.attrs:
+            f.attrs.create('columns', self.columns)
+        name = f'particles/{tstep}'
+        if name in f: # Written before a restart from an earlier checkpoint, replaced
+            del f[name]
+        d = f.create_dataset(name, shape=(total, len(self.columns)), dtype=float)
+        d[start:start+n] = self.p
+        stats = self.statistics()
+        d.attrs.create('msd', stats['msd'])
+        d.attrs.create('residence', stats['residence'])
+        f.close()
@@ -0,0 +1,313 @@
+"""Pipelined transforms that overlap the MPI exchanges with computations
+
+A distributed transform of a TensorProductSpace is a sequence of serial
+transforms along the local axes, separated by global redistributions of the
+data (all-to-all exchanges). Transforming a list of components one after
+another leaves the network idle during the serial transforms and the cores
+idle during the exchanges.
+
+:class:`PipelinedTransforms` instead runs the serial stages of component k+1,
+and possibly the pointwise products that create it, while the non-blocking
+exchange of component k is in flight. Up to `depth` components are in flight
+at the same time, each with its own exchange buffers.
+
+The transforms are built from the internals of shenfun's Transform
+(_xfftn, _transfer) and mpi4py-fft's Transfer (the subarray datatypes). If
+these are not available, or the MPI library has no Ialltoallw, the exchanges
+fall back to the regular blocking ones.
+
+:class:`StackedTransforms` instead exchanges all components together, in
+one all-to-all with datatypes that cover the whole stack. A transform of n
+components then costs the latency of a single exchange.
+"""
+from collections import deque
+from time import time
+import numpy as np
+from mpi4py import MPI
+from shenfun import TensorProductSpace
+
+__all__ = ['PipelinedTransforms', 'StackedTransforms', 'get_dealiased']
+
+def get_dealiased(space, padding_factor, **kw):
+    """Return padded TensorProductSpace of space, planned with the options kw
+
+    shenfun's get_dealiased does not pass planner options, like threads, on
+    to the padded space. The padded space is built here instead, and stored
+    in shenfun's cache of padded spaces of space, such that all padded
+    transforms of space, like u_.backward(padding_factor=...), use it.
+    """
+    padding_factor = tuple(padding_factor)
+    cache = getattr(space, '_padded_space', None)
+    if cache is None or all(p == 1 for p in padding_factor):
+        return space.get_dealiased(padding_factor)
+    if padding_factor not in cache:
+        bases = [base.get_dealiased(padding_factor=p) for p, base in zip(padding_factor, space.bases)]
+        cache[padding_factor] = TensorProductSpace(space.comm, bases, axes=tuple(ai for ax in space.axes for ai in ax),
+                                                   dtype=space.forward.output_array.dtype,
+                                                   backward_from_pencil=space.forward.output_pencil,
+                                                   coordinates=space.coors.coordinates, **kw)
+    return cache[padding_factor]
+
+class PipelinedTransforms:
+    """Transform many components with overlapping exchanges
+
+    Parameters
+    ----------
+    padding_factor : 3-tuple of numbers
+        Padding used by :meth:`backward`
+    depth : int, optional
+        Maximum number of components in flight
+    comm : MPI communicator, optional
+        Communicator used for the overlap report
+    threads : int, optional
+        Threads of the FFTW plans of padded spaces created here
+
+    Example
+    -------
+    >>> P = PipelinedTransforms((1, 1.5, 1.5), depth=3)
+    >>> up = P.backward([u_[0], u_[1], u_[2]], 'u')
+    >>> P.forward(TDp, [lambda: up[0]*up[1], lambda: up[1]*up[2]], [H[0], H[1]])
+    """
+    def __init__(self, padding_factor, depth=2, comm=MPI.COMM_WORLD, threads=1):
+        assert depth >= 1
+        self.padding_factor = padding_factor
+        self.depth = depth
+        self.comm = comm
+        self.threads = threads
+        self.padded = {}
+        self.arrays = {}
+        self.reset()
+
+    def reset(self):
+        """Reset the measured exchange times"""
+        self.transforms = 0  # Number of transformed components
+        self.count = 0       # Number of non-blocking exchanges
+        self.inflight = 0.0  # Time from start to completion of exchanges
+        self.blocked = 0.0   # Time spent waiting for exchanges to complete
+        self.blocking = 0    # Number of exchanges that fell back to blocking
+
+    def get_dealiased(self, space):
+        key = id(space)
+        if key not in self.padded:
+            self.padded[key] = (space, get_dealiased(space, self.padding_factor, threads=self.threads))
+        return self.padded[key][1]
+
+    def _array(self, key, shape, dtype):
+        a = self.arrays.get(key)
+        if a is None or a.shape != shape or a.dtype != dtype:
+            a = self.arrays[key] = np.zeros(shape, dtype=dtype)
+        return a
+
+    def backward(self, functions, name, **kw):
+        """Return padded backward transforms of functions
+
+        Parameters
+        ----------
+        functions : sequence of scalar Functions
+            The spectral coefficients. May belong to different spaces,
+            but the padded arrays must have the same shape
+        name : str
+            Key of the returned array. It is reused, and overwritten, by the
+            next call with the same name
+
+        Returns
+        -------
+        Array of shape (len(functions),) + padded shape
+        """
+        transforms = [self.get_dealiased(f.function_space()).backward for f in functions]
+        out = transforms[0].output_array
+        out = self._array(('backward', name), (len(functions),)+out.shape, out.dtype)
+        self.run(zip(transforms, functions, out), **kw)
+        return out
+
+    def forward(self, space, sources, outputs, **kw):
+        """Forward transform sources into outputs
+
+        Parameters
+        ----------
+        space : TensorProductSpace
+            The (padded) space of the sources
+        sources : sequence of arrays or callables
+            A callable is called without arguments right before its
+            transform, such that pointwise products overlap with the
+            exchanges of the previous components
+        outputs : sequence of arrays
+            The spectral coefficients
+        """
+        self.run([(space.forward, s, o) for s, o in zip(sources, outputs)], **kw)
+        return outputs
+
+    def run(self, tasks, **kw):
+        """Run transforms with at most self.depth components in flight
+
+        Parameters
+        ----------
+        tasks : iterable of 3-tuples (transform, source, output)
+            transform is a shenfun Transform, like T.backward
+        """
+        free = list(range(self.depth))
+        pending = deque()
+        for transform, src, dst in tasks:
+            self.transforms += 1
+            while not free:
+                self._complete(pending, free)
+            for _, _, (req, _) in pending:
+                req.Test() # Drives progress in MPI libraries without async progress
+            slot = free.pop()
+            self._step(self._stages(transform, src, dst, slot, kw), slot, pending, free)
+        while pending:
+            self._complete(pending, free)
+
+    def _complete(self, pending, free):
+        stages, slot, (req, t0) = pending.popleft()
+        t1 = time()
+        req.Wait()
+        t2 = time()
+        self.count += 1
+        self.blocked += t2-t1
+        self.inflight += t2-t0
+        self._step(stages, slot, pending, free)
+
+    def _step(self, stages, slot, pending, free):
+        req = next(stages, None)
+        if req is None:
+            free.append(slot)
+        else:
+            pending.append((stages, slot, req))
+
+    def _stages(self, transform, src, dst, slot, kw):
+        # Yields whenever an exchange has been started, and continues after it has completed
+        if callable(src):
+            src = src()
+        if not hasattr(transform, '_xfftn'):
+            transform(src, dst, **kw)
+            return
+        xfftn, transfer = transform._xfftn, transform._transfer
+        xfftn[0].input_array[...] = src
+        for i, exchange in enumerate(transfer):
+            xfftn[i](**kw)
+            # Plans are shared by components, so exchange through buffers owned by the slot
+            A = self._array(('A', i, slot), xfftn[i].output_array.shape, xfftn[i].output_array.dtype)
+            B = self._array(('B', i, slot), xfftn[i+1].input_array.shape, xfftn[i+1].input_array.dtype)
+            A[...] = xfftn[i].output_array
+            req = self._start(exchange, A, B)
+            if req is not None:
+                yield req
+            xfftn[i+1].input_array[...] = B
+        xfftn[-1](**kw)
+        dst[...] = xfftn[-1].output_array
+
+    def _start(self, exchange, A, B):
+        """Start non-blocking exchange from A to B, or complete a blocking one"""
+        T = getattr(exchange, '__self__', None)
+        try:
+            if exchange.__name__ == 'forward':
+                subA, subB = T._subarraysA, T._subarraysB
+            else:
+                subA, subB = T._subarraysB, T._subarraysA
+            req = T.comm.Ialltoallw([A, T._counts_displs, subA],
+                                    [B, T._counts_displs, subB])
+        except (AttributeError, NotImplementedError, MPI.Exception):
+            self.blocking += 1
+            exchange(A, B)
+            return None
+        return req, time()
+
+    def report(self, verbose=True):
+        """Return fraction of the exchange time hidden behind computations
+
+        The fraction is measured on each rank as 1 - blocked/inflight, where
+        inflight is the time from the start to the completion of an exchange,
+        and blocked is the part of it spent waiting. Returns the minimum over
+        all ranks.
+        """
+        local = 1-self.blocked/self.inflight if self.inflight > 0 else 0.0
+        overlap = self.comm.allreduce(local, op=MPI.MIN)
+        blocked = self.comm.allreduce(self.blocked, op=MPI.MAX)
+        inflight = self.comm.allreduce(self.inflight, op=MPI.MAX)
+        if verbose and self.comm.Get_rank() == 0:
+            print(f"Pipelined transforms (depth {self.depth}): {self.count} exchanges, "
+                  f"in flight {inflight:2.4e} s, blocked {blocked:2.4e} s, "
+                  f"overlap {overlap:2.2%}, blocking fallbacks {self.blocking}")
+        return overlap
+
+class StackedTransforms(PipelinedTransforms):
+    """Transform many components with one exchange for all of them
+
+    The serial transforms of each stage are run for all components, which
+    are then exchanged in one all-to-all. The datatypes of the exchange are
+    those of mpi4py-fft's Transfer for one component, repeated for each
+    component of the stack. All components must have the same shape in
+    each stage, like the padded arrays of the nonlinear terms.
+
+    Parameters
+    ----------
+    padding_factor : 3-tuple of numbers
+        Padding used by :meth:`backward`
+    comm : MPI communicator, optional
+    threads : int, optional
+        Threads of the FFTW plans of padded spaces created here
+
+    Example
+    -------
+    >>> S = StackedTransforms((1, 1.5, 1.5))
+    >>> bp = S.backward([u_[0], u_[1], u_[2], w_[0], w_[1], w_[2]], 'uw')
+    >>> S.forward(TDp, [bp[0]*bp[3], bp[1]*bp[4]], [H[0], H[1]])
+    """
+    def __init__(self, padding_factor, comm=MPI.COMM_WORLD, threads=1):
+        PipelinedTransforms.__init__(self, padding_factor, depth=1, comm=comm, threads=threads)
+        self.types = {}
+
+    def run(self, tasks, **kw):
+        tasks = [(transform, src() if callable(src) else src, dst) for transform, src, dst in tasks]
+        n = len(tasks)
+        self.transforms += n
+        if not all(hasattr(transform, '_xfftn') for transform, _, _ in tasks):
+            for transform, src, dst in tasks:
+                transform(src, dst, **kw)
+            return
+        xfftn = [transform._xfftn for transform, _, _ in tasks]
+        cur = [src for _, src, _ in tasks]
+        for i, exchange in enumerate(tasks[0][0]._transfer):
+            out = xfftn[0][i].output_array
+            A = self._array(('A', i, n), (n,)+out.shape, out.dtype)
+            for k, x in enumerate(xfftn): # Plans may be shared by components, so run them one by one
+                x[i].input_array[...] = cur[k]
+                x[i](**kw)
+                A[k] = x[i].output_array
+            B = self._array(('B', i, n), (n,)+xfftn[0][i+1].input_array.shape, out.dtype)
+            self._exchange(exchange, A, B)
+            cur = B
+        for k, (x, (_, _, dst)) in enumerate(zip(xfftn, tasks)):
+            x[-1].input_array[...] = cur[k]
+            x[-1](**kw)
+            dst[...] = x[-1].output_array
+
+    def _stacked(self, T, forward, n):
+        """Return send and receive datatypes of Transfer T for a stack of n components"""
+        key = (id(T), forward, n)
+        if key not in self.types:
+            subA = T._subtypesA if hasattr(T, '_subtypesA') else T._subarraysA
+            subB = T._subtypesB if hasattr(T, '_subtypesB') else T._subarraysB
+            def stack(types, shape):
+                stride = int(np.prod(shape))*T.dtype.itemsize
+                return [t.Create_hvector(n, 1, stride).Commit() for t in types]
+            A, B = stack(subA, T.subshapeA), stack(subB, T.subshapeB)
+            self.types[key] = (A, B) if forward else (B, A)
+        return self.types[key]
+
+    def _exchange(self, exchange, A, B):
+        """Exchange all components of A to B in one all-to-all"""
+        T = getattr(exchange, '__self__', None)
+        t0 = time()
+        try:
+            send, recv = self._stacked(T, exchange.__name__ == 'forward', len(A))
+            T.comm.Alltoallw([A, T._counts_displs, send], [B, T._counts_displs, recv])
+        except (AttributeError, NotImplementedError, MPI.Exception):
+            self.blocking += len(A)
+            for a, b in zip(A, B):
+                exchange(a, b)
+            return
+        self.count += 1
+        self.inflight += time()-t0
+        self.blocked += time()-t0
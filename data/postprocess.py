@@ -0,0 +1,163 @@
+"""Out-of-core post-processing of statistics and snapshot series
+
+Stats files (written by Stats.get_stats/tofile) and snapshot series (written
+by KMM.tofile) are read one wall-normal plane or one profile at a time, such
+that the memory use is independent of the number and size of snapshots.
+Snapshots are distributed over a pool of processes and the results of each
+snapshot are cached on disk.
+
+Examples
+--------
+Compare folded stats profiles with the reference data chan180.*
+
+    python postprocess.py stats KMM776statsc.h5 --ref chan180
+
+Mean, Reynolds stresses and 1D spectra of all velocity snapshots
+
+    python postprocess.py snapshots MKM_MP_64_64_32_U.h5 --processes 8 --out U.npz
+"""
+import os
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import h5py
+
+# Stats files written by older versions use shorter group names
+aliases = {'Average Velocity': 'Average',
+           'Reynolds Stress Velocity': 'Reynolds Stress'}
+
+def open_array(dset):
+    """Return memory map of contiguous dataset, or else the dataset itself
+
+    Both are read lazily, so only the parts that are sliced are read.
+    """
+    offset = dset.id.get_offset()
+    if dset.chunks is None and dset.compression is None and offset is not None:
+        return np.memmap(dset.file.filename, mode='r', dtype=dset.dtype,
+                         offset=offset, shape=dset.shape)
+    return dset
+
+def fold(a, parity=1):
+    """Average the two channel halves of profile(s) a along the last axis
+
+    parity is 1 for symmetric and -1 for antisymmetric quantities.
+    Returned profiles start at the wall.
+    """
+    a = np.asarray(a)
+    N = a.shape[-1]
+    return 0.5*(a[..., :N//2] + parity*a[..., ::-1][..., :N//2])
+
+def read_profile(f, group, name):
+    """Read one profile from open stats file f"""
+    if group not in f and group in aliases:
+        group = aliases[group]
+    return np.array(open_array(f[group][name]))
+
+def compare(x, y, xref, yref):
+    """Return relative L2 difference of profile y(x) and reference yref(xref)
+
+    Only the part of the profile covered by the reference is compared.
+    """
+    i = np.argsort(x)
+    x, y = np.asarray(x)[i], np.asarray(y)[i]
+    mask = (xref >= x[0]) & (xref <= x[-1])
+    d = np.interp(xref[mask], x, y)-yref[mask]
+    return np.sqrt(np.sum(d**2)/np.sum(yref[mask]**2))
+
+def stats_report(filename, ref=None):
+    """Fold stats profiles and compare with reference data ref.means and ref.reystress"""
+    with h5py.File(filename, 'r') as f:
+        N = f['x'].shape[0] if 'x' in f else read_profile(f, 'Average Velocity', 'V').shape[0]
+        x = np.array(f['x']) if 'x' in f else np.cos(np.pi*(2*np.arange(N)+1)/(2*N))
+        y = 1-fold(x, -1) # distance from wall
+        V = fold(read_profile(f, 'Average Velocity', 'V'))
+        R = {name: fold(read_profile(f, 'Reynolds Stress Velocity', name)) for name in ('UU', 'VV', 'WW')}
+    R['VV'] = R['VV']-V**2 # Stored as raw second moments
+    result = {'y': y, 'V': V, **R}
+    if ref is not None:
+        means = np.loadtxt(ref+'.means')
+        rss = np.loadtxt(ref+'.reystress')
+        print(f"{'':>4}{'rel. L2 diff':>14}")
+        print(f"{'V':>4}{compare(y, V, means[:, 0], means[:, 2]):14.4e}")
+        for i, name in enumerate(('UU', 'VV', 'WW')):
+            # Reference is ordered as uu, vv, ww with u streamwise and v wall-normal
+            ref_name = ('VV', 'UU', 'WW')[i]
+            print(f"{ref_name:>4}{compare(y, R[ref_name], rss[1:, 0], rss[1:, 2+i]):14.4e}")
+    return result
+
+def snapshot_steps(filename, name='u0'):
+    """Return sorted list of all steps stored in snapshot file"""
+    with h5py.File(filename, 'r') as f:
+        return sorted(f[name+'/3D'].keys(), key=int)
+
+def snapshot_stats(filename, step, names=('u0', 'u1', 'u2'), cache=None):
+    """Plane-by-plane statistics of one snapshot
+
+    Returns dict with the plane averages (mean), second moments (UU, the
+    symmetric combinations of components) and energy spectra in y and z (Ey,
+    Ez) of the fluctuations, for all wall-normal planes.
+    """
+    if cache is not None:
+        key = f"{os.path.basename(filename)}_{step}_{int(os.path.getmtime(filename))}.npz"
+        cfile = os.path.join(cache, key)
+        if os.path.exists(cfile):
+            with np.load(cfile) as d:
+                return dict(d)
+    with h5py.File(filename, 'r') as f:
+        u = [open_array(f[f'{name}/3D/{step}']) for name in names]
+        N = u[0].shape
+        pairs = [(i, j) for i in range(len(names)) for j in range(i, len(names))]
+        r = {'mean': np.zeros((len(names), N[0])),
+             'UU': np.zeros((len(pairs), N[0])),
+             'Ey': np.zeros((len(names), N[0], N[1]//2+1)),
+             'Ez': np.zeros((len(names), N[0], N[2]//2+1))}
+        for i in range(N[0]):
+            p = [np.array(ui[i], dtype=float) for ui in u]
+            for n, pn in enumerate(p):
+                r['mean'][n, i] = pn.mean()
+                pn -= r['mean'][n, i]
+                r['Ey'][n, i] = np.mean(np.abs(np.fft.rfft(pn, axis=0)/N[1])**2, axis=1)
+                r['Ez'][n, i] = np.mean(np.abs(np.fft.rfft(pn, axis=1)/N[2])**2, axis=0)
+            for n, (k, l) in enumerate(pairs):
+                r['UU'][n, i] = np.mean(p[k]*p[l])
+    if cache is not None:
+        os.makedirs(cache, exist_ok=True)
+        np.savez(cfile, **r)
+    return r
+
+def _snapshot_stats(args):
+    return snapshot_stats(*args)
+
+def snapshot_series(filename, names=('u0', 'u1', 'u2'), processes=None, cache=None, steps=None):
+    """Average :func:`snapshot_stats` over all snapshots
+
+    The snapshots are processed by a pool of processes and summed as they
+    come in, so only one result per process is held in memory.
+    """
+    steps = snapshot_steps(filename, names[0]) if steps is None else steps
+    total = None
+    with Pool(processes) as pool:
+        for r in pool.imap_unordered(_snapshot_stats, [(filename, step, names, cache) for step in steps]):
+            if total is None:
+                total = {key: np.zeros_like(val) for key, val in r.items()}
+            for key, val in r.items():
+                total[key] += val
+    return {key: val/len(steps) for key, val in total.items()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('kind', choices=('stats', 'snapshots'))
+    parser.add_argument('filename')
+    parser.add_argument('--ref', default=None, help='Reference data, e.g., chan180')
+    parser.add_argument('--names', default='u0,u1,u2', help='Snapshot components')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--cache', default='.ppcache', help='Folder for cached results')
+    parser.add_argument('--out', default=None, help='Store results in this npz-file')
+    args = parser.parse_args()
+    if args.kind == 'stats':
+        result = stats_report(args.filename, args.ref)
+    else:
+        result = snapshot_series(args.filename, tuple(args.names.split(',')), args.processes, args.cache)
+        result.update({'folded '+key: fold(val, 1) for key, val in result.items() if key == 'UU'})
+    if args.out:
+        np.savez(args.out, **result)
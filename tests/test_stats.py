@@ -0,0 +1,51 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('shenfun')
+from mpi4py import MPI
+from MKM_MicroPolar import Stats
+
+N = (8, 6, 4)
+
+def conditional_stats():
+    # Broadcast wall-normal mesh, like B0.mesh() of a TensorProductSpace
+    x = np.cos(np.pi*(np.arange(N[0])+0.5)/N[0])[:, None, None]
+    s = tuple(slice(0, n) for n in N)
+    stats = Stats(N, x, s, comm=MPI.COMM_SELF, conditional={})
+    stats.num_samples = 1
+    stats.UU[:3] = stats.Q # Unit rms
+    stats.WW[:3] = stats.Q
+    return stats
+
+def fluctuations(seed=1):
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((3,)+N), rng.standard_normal((3,)+N)
+
+def test_quadrants_block_equals_planes():
+    Up, Wp = fluctuations()
+    block = conditional_stats()
+    block.condition(Up, Wp, slice(None))
+    planes = conditional_stats()
+    for i in range(N[0]):
+        s = slice(i, i+1)
+        planes.condition(Up[:, s], Wp[:, s], s)
+    for name in ('quadrant_count', 'quadrant_uv', 'quadrant_W'):
+        assert np.allclose(getattr(block, name), getattr(planes, name)), name
+    for name in block.joint_pdf:
+        assert np.array_equal(block.joint_pdf[name], planes.joint_pdf[name]), name
+    # Without a hole each point is in exactly one quadrant
+    assert np.allclose(block.quadrant_count[0].sum(axis=0), N[1]*N[2])
+
+def test_mirrored_planes():
+    # A flow mirrored in the channel center has the same quadrants and joint PDFs
+    Up, Wp = fluctuations()
+    Up[:, N[0]//2:] = Up[:, N[0]//2-1::-1]
+    Up[0, N[0]//2:] *= -1
+    Wp[:, N[0]//2:] = Wp[:, N[0]//2-1::-1]
+    stats = conditional_stats()
+    stats.condition(Up, Wp, slice(None))
+    for name in ('quadrant_count', 'quadrant_uv', 'quadrant_W'):
+        a = getattr(stats, name)
+        assert np.allclose(a[..., N[0]//2:], a[..., N[0]//2-1::-1]), name
+    pdf = stats.joint_pdf['uv']
+    assert np.array_equal(pdf[N[0]//2:], pdf[N[0]//2-1::-1])
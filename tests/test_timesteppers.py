@@ -0,0 +1,22 @@
+import pytest
+
+pytest.importorskip('shenfun')
+from ChannelFlow import TIMESTEPPERS
+from TimeSteppers import ORDER, REGISTERS, convergence, manufactured
+
+@pytest.mark.parametrize('timestepper', TIMESTEPPERS)
+def test_order(timestepper):
+    errors, orders, registers = convergence(timestepper)
+    assert orders[-1] > ORDER[timestepper]-0.2
+
+@pytest.mark.parametrize('timestepper', TIMESTEPPERS)
+def test_registers(timestepper):
+    error, registers = manufactured(timestepper, 0.1)
+    assert registers == REGISTERS[timestepper]
+
+def test_low_storage_is_IMEXRK3():
+    # The same scheme, so the same solution up to roundoff
+    e0, r0 = manufactured('IMEXRK3', 0.05)
+    e1, r1 = manufactured('IMEXRK3LS', 0.05)
+    assert abs(e0-e1) < 1e-12
+    assert r1 < r0